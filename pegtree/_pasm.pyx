@@ -0,0 +1,651 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+import weakref
+from pegtree.pasm import charset
+
+# Typed versions of the hot combinators in pasm.py. Each combinator is a
+# Matcher whose match() is called through C, on a PContext with C ints for
+# the positions and characters read as Py_UCS4 from the str inputs.
+# Python callables (the combinators left in pasm.py, such as pNode) are
+# wrapped by PyMatcher, so that both kinds can be mixed in a grammar.
+#
+# pasm.py imports these over its own definitions when this module is
+# built (python setup.py build_ext --inplace); PEGTREE_PURE=1 disables it.
+# Matchers are not changed once built, except by pasm.link() while the
+# rules are generated, and that Ref and Lazy store the matcher of their
+# rule (self.pf) on the first match. Threads racing on it store the same
+# matcher (Lazy compiles under the grammar lock), which the GIL makes safe.
+# The module is not declared freethreading_compatible: the unlocked
+# self.pf stores have not been checked on a free-threaded (3.13t) build,
+# which therefore imports it with the GIL enabled.
+
+__all__ = [
+    'PContext', 'Matcher',
+    'pEmpty', 'pFail', 'pAny', 'pChar', 'pRange',
+    'pAnd', 'pNot', 'pMany', 'pMany1', 'pOption',
+    'pSeq2', 'pSeq3', 'pSeq4', 'pSeq',
+    'pOre2', 'pOre3', 'pOre4', 'pOre', 'pDispatch', 'pRef', 'pLazy',
+    'pAndChar', 'pNotChar', 'pManyChar', 'pMany1Char', 'pOptionChar',
+    'pAndRange', 'pNotRange', 'pManyRange', 'pMany1Range', 'pOptionRange',
+    'pRecogNot', 'pRecogMany', 'pRecogMany1', 'pRecogOption',
+    'pRecogOre2', 'pRecogOre3', 'pRecogOre4', 'pRecogOre', 'pRecogDispatch',
+]
+
+
+cdef class PContext:
+    cdef public object inputs, ast, state, memo, stats, dic, expected, urn
+    cdef public Py_ssize_t pos, epos, headpos, errpos
+
+    def __init__(self, inputs, spos, epos, urn='(unknown source)'):
+        self.memo = None  # allocated by pMemo
+        self.stats = None
+        self.dic = {}
+        self.reset(inputs, spos, epos, urn)
+
+    def reset(self, inputs, spos, epos, urn='(unknown source)'):
+        self.inputs = inputs
+        self.urn = urn
+        self.pos = spos
+        self.epos = epos
+        self.headpos = spos
+        self.ast = None
+        self.state = None
+        if self.memo is not None:
+            for m in self.memo:
+                m.key = -1
+        if len(self.dic) > 0:
+            self.dic = {}
+        self.errpos = -1
+        self.expected = 0
+
+    def clear(self):
+        '''
+        drops the inputs, trees and states of the last parse, which a pooled
+        context would otherwise keep alive
+        '''
+        self.inputs = None
+        self.ast = None
+        self.state = None
+        if self.memo is not None:
+            for m in self.memo:
+                m.key = -1
+                m.ast = None
+                m.prev = None
+        if len(self.dic) > 0:
+            self.dic = {}
+
+
+cdef class Matcher:
+    cdef object __weakref__  # for the combinator caches
+
+    cdef int match(self, PContext px) except -1:
+        return 0
+
+    def __call__(self, PContext px):
+        return self.match(px) == 1
+
+    def link(self, resolve):  # stores resolve(m) for each matcher m held
+        pass
+
+
+cdef class PyMatcher(Matcher):
+    cdef object pf
+
+    def __init__(self, pf):
+        self.pf = pf
+
+    cdef int match(self, PContext px) except -1:
+        return 1 if self.pf(px) else 0
+
+    def link(self, resolve):
+        self.pf = resolve(self.pf)
+
+
+cdef Matcher matcher(pf):
+    if isinstance(pf, Matcher):
+        return <Matcher>pf
+    return PyMatcher(pf)
+
+
+cdef inline void backtrack(PContext px, Py_ssize_t pos, object ast):
+    if px.pos > px.headpos:
+        px.headpos = px.pos
+    px.pos = pos
+    px.ast = ast
+
+
+cdef class Empty(Matcher):
+    cdef int match(self, PContext px) except -1:
+        return 1
+
+
+cdef class Fail(Matcher):
+    cdef int match(self, PContext px) except -1:
+        return 0
+
+
+cdef class Any(Matcher):
+    cdef int match(self, PContext px) except -1:
+        if px.pos < px.epos:
+            px.pos += 1
+            return 1
+        return 0
+
+
+EMPTY = Empty()
+FAIL = Fail()
+ANY = Any()
+
+
+def pEmpty():
+    return EMPTY
+
+
+def pFail():
+    return FAIL
+
+
+def pAny():
+    return ANY
+
+# Char
+
+
+cdef class CharMatcher(Matcher):
+    cdef str text
+    cdef Py_ssize_t clen
+
+    def __init__(self, str text):
+        self.text = text
+        self.clen = len(text)
+
+    cdef inline bint at(self, str s, Py_ssize_t pos):
+        cdef Py_ssize_t i
+        if pos + self.clen > len(s):
+            return False
+        for i in range(self.clen):
+            if s[pos + i] != self.text[i]:
+                return False
+        return True
+
+
+cdef class Char(CharMatcher):
+    cdef int match(self, PContext px) except -1:
+        if self.at(px.inputs, px.pos):
+            px.pos += self.clen
+            return 1
+        return 0
+
+
+cdef class AndChar(CharMatcher):
+    cdef int match(self, PContext px) except -1:
+        return 1 if self.at(px.inputs, px.pos) else 0
+
+
+cdef class NotChar(CharMatcher):
+    cdef int match(self, PContext px) except -1:
+        return 0 if self.at(px.inputs, px.pos) else 1
+
+
+cdef class ManyChar(CharMatcher):
+    cdef int match(self, PContext px) except -1:
+        cdef str s = px.inputs
+        while self.at(s, px.pos):
+            px.pos += self.clen
+        return 1
+
+
+cdef class Many1Char(CharMatcher):
+    cdef int match(self, PContext px) except -1:
+        cdef str s = px.inputs
+        if not self.at(s, px.pos):
+            return 0
+        px.pos += self.clen
+        while self.at(s, px.pos):
+            px.pos += self.clen
+        return 1
+
+
+cdef class OptionChar(CharMatcher):
+    cdef int match(self, PContext px) except -1:
+        if self.at(px.inputs, px.pos):
+            px.pos += self.clen
+        return 1
+
+
+CharCache = weakref.WeakValueDictionary({
+    '': EMPTY
+})
+
+
+def pChar(text):
+    pf = CharCache.get(text)
+    if pf is None:
+        pf = Char(text)
+        CharCache[text] = pf
+    return pf
+
+
+def pAndChar(text):
+    return AndChar(text)
+
+
+def pNotChar(text):
+    return NotChar(text)
+
+
+def pManyChar(text):
+    return ManyChar(text)
+
+
+def pMany1Char(text):
+    return Many1Char(text)
+
+
+def pOptionChar(text):
+    return OptionChar(text)
+
+# Range
+
+
+cdef class RangeMatcher(Matcher):
+    cdef unsigned char ascii[128]
+    cdef object cs
+
+    def __init__(self, chars, ranges):
+        cdef int c
+        self.cs = charset(chars, ranges)
+        for c in range(128):
+            self.ascii[c] = 1 if chr(c) in self.cs else 0
+
+    cdef inline bint at(self, PContext px, Py_ssize_t pos) except -1:
+        cdef str s
+        cdef Py_UCS4 c
+        if pos >= px.epos:
+            return False
+        s = px.inputs
+        c = s[pos]
+        if c < 128:
+            return self.ascii[c]
+        return c in self.cs
+
+
+cdef class Range(RangeMatcher):
+    cdef int match(self, PContext px) except -1:
+        if self.at(px, px.pos):
+            px.pos += 1
+            return 1
+        return 0
+
+
+cdef class AndRange(RangeMatcher):
+    cdef int match(self, PContext px) except -1:
+        return 1 if self.at(px, px.pos) else 0
+
+
+cdef class NotRange(RangeMatcher):
+    cdef int match(self, PContext px) except -1:
+        return 0 if self.at(px, px.pos) else 1
+
+
+cdef class ManyRange(RangeMatcher):
+    cdef int match(self, PContext px) except -1:
+        cdef Py_ssize_t pos = px.pos
+        while self.at(px, pos):
+            pos += 1
+        px.pos = pos
+        return 1
+
+
+cdef class Many1Range(RangeMatcher):
+    cdef int match(self, PContext px) except -1:
+        cdef Py_ssize_t pos = px.pos
+        if not self.at(px, pos):
+            return 0
+        pos += 1
+        while self.at(px, pos):
+            pos += 1
+        px.pos = pos
+        return 1
+
+
+cdef class OptionRange(RangeMatcher):
+    cdef int match(self, PContext px) except -1:
+        if self.at(px, px.pos):
+            px.pos += 1
+        return 1
+
+
+def pRange(chars, ranges):
+    return Range(chars, ranges)
+
+
+def pAndRange(chars, ranges):
+    return AndRange(chars, ranges)
+
+
+def pNotRange(chars, ranges):
+    return NotRange(chars, ranges)
+
+
+def pManyRange(chars, ranges):
+    return ManyRange(chars, ranges)
+
+
+def pMany1Range(chars, ranges):
+    return Many1Range(chars, ranges)
+
+
+def pOptionRange(chars, ranges):
+    return OptionRange(chars, ranges)
+
+# Unary
+
+
+cdef class Unary(Matcher):
+    cdef Matcher pf
+
+    def __init__(self, pf):
+        self.pf = matcher(pf)
+
+    def link(self, resolve):
+        self.pf = matcher(resolve(self.pf))
+
+
+cdef class And(Unary):
+    cdef int match(self, PContext px) except -1:
+        cdef Py_ssize_t pos = px.pos
+        if self.pf.match(px):
+            if px.pos > px.headpos:
+                px.headpos = px.pos
+            px.pos = pos
+            return 1
+        return 0
+
+
+cdef class Not(Unary):
+    cdef int match(self, PContext px) except -1:
+        cdef Py_ssize_t pos = px.pos
+        ast = px.ast
+        if not self.pf.match(px):
+            backtrack(px, pos, ast)
+            return 1
+        return 0
+
+
+cdef class Many(Unary):
+    cdef int match(self, PContext px) except -1:
+        cdef Py_ssize_t pos = px.pos
+        ast = px.ast
+        while self.pf.match(px) and pos < px.pos:
+            pos = px.pos
+            ast = px.ast
+        backtrack(px, pos, ast)
+        return 1
+
+
+cdef class Many1(Unary):
+    cdef int match(self, PContext px) except -1:
+        cdef Py_ssize_t pos
+        if not self.pf.match(px):
+            return 0
+        pos = px.pos
+        ast = px.ast
+        while self.pf.match(px) and pos < px.pos:
+            pos = px.pos
+            ast = px.ast
+        backtrack(px, pos, ast)
+        return 1
+
+
+cdef class Option(Unary):
+    cdef int match(self, PContext px) except -1:
+        cdef Py_ssize_t pos = px.pos
+        ast = px.ast
+        if not self.pf.match(px):
+            backtrack(px, pos, ast)
+        return 1
+
+
+def pAnd(pf):
+    return And(pf)
+
+
+def pNot(pf):
+    return Not(pf)
+
+
+def pMany(pf):
+    return Many(pf)
+
+
+def pMany1(pf):
+    return Many1(pf)
+
+
+def pOption(pf):
+    return Option(pf)
+
+# Seq
+
+
+cdef class Seq2(Matcher):
+    cdef Matcher pf, pf2
+
+    def __init__(self, pf, pf2):
+        self.pf = matcher(pf)
+        self.pf2 = matcher(pf2)
+
+    def link(self, resolve):
+        self.pf = matcher(resolve(self.pf))
+        self.pf2 = matcher(resolve(self.pf2))
+
+    cdef int match(self, PContext px) except -1:
+        return self.pf.match(px) and self.pf2.match(px)
+
+
+cdef class Seq3(Matcher):
+    cdef Matcher pf, pf2, pf3
+
+    def __init__(self, pf, pf2, pf3):
+        self.pf = matcher(pf)
+        self.pf2 = matcher(pf2)
+        self.pf3 = matcher(pf3)
+
+    def link(self, resolve):
+        self.pf = matcher(resolve(self.pf))
+        self.pf2 = matcher(resolve(self.pf2))
+        self.pf3 = matcher(resolve(self.pf3))
+
+    cdef int match(self, PContext px) except -1:
+        return self.pf.match(px) and self.pf2.match(px) and self.pf3.match(px)
+
+
+cdef class Seq(Matcher):
+    cdef tuple pfs
+
+    def __init__(self, pfs):
+        self.pfs = tuple(matcher(pf) for pf in pfs)
+
+    def link(self, resolve):
+        self.pfs = tuple(matcher(resolve(pf)) for pf in self.pfs)
+
+    cdef int match(self, PContext px) except -1:
+        for pf in self.pfs:
+            if not (<Matcher>pf).match(px):
+                return 0
+        return 1
+
+
+def pSeq2(pf, pf2):
+    return Seq2(pf, pf2)
+
+
+def pSeq3(pf, pf2, pf3):
+    return Seq3(pf, pf2, pf3)
+
+
+def pSeq4(pf, pf2, pf3, pf4):
+    return Seq((pf, pf2, pf3, pf4))
+
+
+def pSeq(*pfs):
+    return Seq(pfs)
+
+# Ore
+
+
+cdef class Ore2(Matcher):
+    cdef Matcher pf, pf2
+
+    def __init__(self, pf, pf2):
+        self.pf = matcher(pf)
+        self.pf2 = matcher(pf2)
+
+    def link(self, resolve):
+        self.pf = matcher(resolve(self.pf))
+        self.pf2 = matcher(resolve(self.pf2))
+
+    cdef int match(self, PContext px) except -1:
+        cdef Py_ssize_t pos = px.pos
+        ast = px.ast
+        if self.pf.match(px):
+            return 1
+        backtrack(px, pos, ast)
+        return self.pf2.match(px)
+
+
+cdef class Ore(Matcher):
+    cdef tuple pfs
+
+    def __init__(self, pfs):
+        self.pfs = tuple(matcher(pf) for pf in pfs)
+
+    def link(self, resolve):
+        self.pfs = tuple(matcher(resolve(pf)) for pf in self.pfs)
+
+    cdef int match(self, PContext px) except -1:
+        cdef Py_ssize_t pos = px.pos
+        ast = px.ast
+        for pf in self.pfs:
+            if (<Matcher>pf).match(px):
+                return 1
+            backtrack(px, pos, ast)
+        return 0
+
+
+cdef class Dispatch(Matcher):
+    cdef dict table
+    cdef tuple default
+
+    def __init__(self, table, default):
+        self.table = {c: tuple(matcher(pf) for pf in pfs) for c, pfs in table.items()}
+        self.default = tuple(matcher(pf) for pf in default)
+
+    def link(self, resolve):
+        self.table = {c: tuple(matcher(resolve(pf)) for pf in pfs) for c, pfs in self.table.items()}
+        self.default = tuple(matcher(resolve(pf)) for pf in self.default)
+
+    cdef int match(self, PContext px) except -1:
+        cdef Py_ssize_t pos = px.pos
+        cdef tuple pfs = self.default
+        ast = px.ast
+        if pos < px.epos:
+            pfs = self.table.get(px.inputs[pos], self.default)
+        for pf in pfs:
+            if (<Matcher>pf).match(px):
+                return 1
+            backtrack(px, pos, ast)
+        if pos > px.headpos:
+            px.headpos = pos
+        return 0
+
+
+def pOre2(pf, pf2):
+    return Ore2(pf, pf2)
+
+
+def pOre3(pf, pf2, pf3):
+    return Ore((pf, pf2, pf3))
+
+
+def pOre4(pf, pf2, pf3, pf4):
+    return Ore((pf, pf2, pf3, pf4))
+
+
+def pOre(*pfs):
+    return Ore(pfs)
+
+
+def pDispatch(table, default):
+    return Dispatch(table, default)
+
+# Ref
+# pasm.link() replaces references with their rules in the matchers holding
+# them (link()). A reference it has not reached binds to the generated
+# rule when first matched.
+
+
+cdef class Ref(Matcher):
+    cdef dict generated
+    cdef readonly str uname
+    cdef Matcher pf
+
+    def __init__(self, generated, uname):
+        self.generated = generated
+        self.uname = uname
+
+    cdef int match(self, PContext px) except -1:
+        cdef Matcher pf = self.pf  # link() may drop this reference meanwhile
+        if pf is None:
+            pf = matcher(self.generated[self.uname])
+            self.pf = pf
+        return pf.match(px)
+
+
+def pRef(generated, uname):
+    if uname not in generated:
+        generated[uname] = Ref(generated, uname)
+    return generated[uname]
+
+
+# A lazy stub compiles its rule when first matched, and binds to it as Ref.
+
+cdef class Lazy(Matcher):
+    cdef dict generated
+    cdef readonly str uname
+    cdef object compile
+    cdef Matcher pf
+
+    def __init__(self, generated, uname, compile):
+        self.generated = generated
+        self.uname = uname
+        self.compile = compile
+
+    cdef int match(self, PContext px) except -1:
+        cdef Lazy stub = self  # link() drops the references to the stub
+        cdef object pf
+        if stub.pf is None:
+            pf = stub.generated[stub.uname]
+            if pf is stub:
+                pf = stub.compile()  # once, even if called from threads
+            stub.pf = matcher(pf)
+        return stub.pf.match(px)
+
+
+def pLazy(generated, uname, compile):
+    generated[uname] = Lazy(generated, uname, compile)
+    return generated[uname]
+
+# Recognizer
+# Saving px.ast costs no more than a reference here, so the recognizer
+# variants are the same matchers.
+
+pRecogNot = pNot
+pRecogMany = pMany
+pRecogMany1 = pMany1
+pRecogOption = pOption
+pRecogOre2 = pOre2
+pRecogOre3 = pOre3
+pRecogOre4 = pOre4
+pRecogOre = pOre
+pRecogDispatch = pDispatch
@@ -0,0 +1,204 @@
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import pegtree
+from pegtree.pasm import PTree2Tuple
+
+# AsyncParser runs a generated parser in a worker pool so that parsing does
+# not block the event loop. Small requests are batched into a single job,
+# and the number of waiting requests is bounded (await parse() blocks when
+# the queue is full).
+
+
+def convert(parser, inputs, urn, result):
+    if result == 'compact':
+        return parser(inputs, urn, conv=PTree2Tuple)
+    t = parser(inputs, urn)
+    if result == 'repr':
+        return repr(t)
+    return t
+
+
+def parse_batch(parser, batch, result):
+    results = []
+    for inputs, urn in batch:
+        try:
+            results.append((True, convert(parser, inputs, urn, result)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+# Process workers rebuild the parser from the grammar file, since generated
+# parsers are closures and cannot be pickled.
+
+worker_parser = None
+
+
+def init_worker(grammar, options):
+    global worker_parser
+    peg = pegtree.grammar(grammar)
+    worker_parser = pegtree.generate(peg, **options)
+
+
+def parse_batch_in_worker(batch, result):
+    return parse_batch(worker_parser, batch, result)
+
+
+class AsyncParser(object):
+    def __init__(self, parser=None, grammar=None, processes=False, workers=None,
+                 batch_size=32, batch_bytes=4096, maxsize=1024, result='compact', **options):
+        '''
+        parser      a parser generated by pegtree.generate (thread pool only)
+        grammar     a grammar file, loaded in each worker when processes=True
+        result      'compact' (tuples), 'repr' (strings) or 'tree' (ParseTree)
+        '''
+        self.workers = workers or os.cpu_count() or 1
+        if processes:
+            if grammar is None:
+                raise ValueError('processes=True requires a grammar file')
+            self.executor = ProcessPoolExecutor(
+                self.workers, initializer=init_worker, initargs=(grammar, options))
+            self.run_batch = parse_batch_in_worker
+        else:
+            if parser is None:
+                parser = pegtree.generate(pegtree.grammar(grammar), **options)
+            self.executor = ThreadPoolExecutor(self.workers)
+            self.run_batch = functools.partial(parse_batch, parser)
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.maxsize = maxsize
+        self.result = result
+        self.queue = None
+        self.dispatcher = None
+        self.closed = False
+
+    def start(self):
+        if self.closed:
+            raise RuntimeError('AsyncParser is closed')
+        if self.dispatcher is None:
+            self.queue = asyncio.Queue(self.maxsize)
+            self.running = asyncio.Semaphore(self.workers)
+            self.dispatcher = asyncio.ensure_future(self.dispatch())
+
+    async def parse(self, inputs, urn='(unknown source)'):
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((inputs, urn, future))
+        if self.closed:  # closed while waiting for room in the queue
+            self.cancel_queued()
+        return await future
+
+    async def dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            batch = [item]
+            size = len(item[0])
+            while len(batch) < self.batch_size and size < self.batch_bytes:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                batch.append(item)
+                size += len(item[0])
+            try:
+                await self.running.acquire()
+            except asyncio.CancelledError:  # closed with the batch in hand
+                for _, _, future in batch:
+                    future.cancel()
+                raise
+            job = loop.run_in_executor(self.executor, self.run_batch,
+                                       [(inputs, urn) for inputs, urn, _ in batch], self.result)
+            job.add_done_callback(functools.partial(self.done, batch))
+
+    def done(self, batch, job):
+        self.running.release()
+        if job.cancelled():
+            for _, _, future in batch:
+                future.cancel()
+            return
+        if job.exception() is not None:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(job.exception())
+            return
+        for (_, _, future), (ok, value) in zip(batch, job.result()):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def cancel_queued(self):
+        # each get wakes a parse() waiting to put, which cancels in turn
+        while not self.queue.empty():
+            _, _, future = self.queue.get_nowait()
+            future.cancel()
+
+    async def close(self):
+        '''
+        cancels the requests not yet running, and waits for the running ones
+        '''
+        self.closed = True
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            try:
+                await self.dispatcher
+            except asyncio.CancelledError:
+                pass
+            self.dispatcher = None
+            self.cancel_queued()
+        # shutdown(wait=True) would block the loop until the running jobs end
+        await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self.executor.shutdown, wait=True))
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+# benchmark
+
+
+async def run_clients(parse, docs, clients, requests):
+    latencies = []
+
+    async def client(n):
+        for i in range(n, requests, clients):
+            st = time.perf_counter()
+            await parse(docs[i % len(docs)])
+            latencies.append(time.perf_counter() - st)
+    st = time.perf_counter()
+    await asyncio.gather(*(client(n) for n in range(clients)))
+    et = time.perf_counter()
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return requests / (et - st), p99
+
+
+async def benchmark(grammar, docs, clients=64, requests=2000, workers=None, **options):
+    parser = pegtree.generate(pegtree.grammar(grammar), **options)
+    results = []
+
+    executor = ThreadPoolExecutor(workers)
+    loop = asyncio.get_running_loop()
+
+    async def naive(inputs):
+        return await loop.run_in_executor(executor, convert, parser, inputs, '(unknown source)', 'compact')
+    results.append(('run_in_executor', await run_clients(naive, docs, clients, requests)))
+    executor.shutdown()
+
+    async with AsyncParser(parser, workers=workers) as aparser:
+        results.append(('AsyncParser(threads)', await run_clients(aparser.parse, docs, clients, requests)))
+
+    async with AsyncParser(grammar=grammar, processes=True, workers=workers, **options) as aparser:
+        await aparser.parse(docs[0])  # wait for workers
+        results.append(('AsyncParser(processes)', await run_clients(aparser.parse, docs, clients, requests)))
+    return results
@@ -0,0 +1,103 @@
+import csv
+import time
+import pegtree
+from pegtree.pasm import ParseTree
+
+# CSV records streamed from a file on the bundled csv.tpeg. Each #Line is
+# parsed by itself as the file is read in chunks, and comes out as a list
+# of its #Value strings:
+#
+#   import pegtree.csv
+#   with open('data.csv', newline='') as f:
+#       for row in pegtree.csv.reader(f):
+#           print(row)  # => ['1997', 'Ford', 'E350', 'ac, abs, moon']
+#
+# A dialect is a grammar whose start rule matches one record, built with
+# #Line and #Value nodes as in csv.tpeg.
+
+
+def Value(inputs, spos, epos, children, edges):
+    s = inputs[spos:epos]
+    if spos > 0 and inputs[spos-1] == '"':  # quoted
+        return s.replace('""', '"')
+    return s
+
+
+def Line(inputs, spos, epos, children, edges):
+    if spos == epos or inputs[spos] in '\r\n':  # an empty line has no fields
+        return []
+    return children
+
+
+ACTIONS = {
+    'Value': Value,
+    'Line': Line,
+}
+
+SPAN_ACTIONS = {
+    'Value': lambda inputs, spos, epos, children, edges: (spos, epos),
+    'Line': Line,
+}
+
+streams = {}  # {(grammar file, start, spans): stream parser}
+
+
+def generate(grammar='csv.tpeg', start='Line', spans=False):
+    if not isinstance(grammar, str):  # a Grammar caches its parsers itself
+        return pegtree.generate(grammar, start=start, stream=True,
+                                actions=SPAN_ACTIONS if spans else ACTIONS)
+    key = (grammar, start, spans)
+    if key not in streams:
+        streams[key] = generate(pegtree.grammar(grammar), start, spans)
+    return streams[key]
+
+
+def reader(f, grammar='csv.tpeg', start='Line', spans=False, chunksize=1 << 20):
+    '''
+    yields the rows of f (a file opened with newline='') as lists of
+    strings, or of (start, end) offsets of the fields in f if spans is True
+    '''
+    stream = generate(grammar, start, spans)
+    urn = getattr(f, 'name', '(unknown source)')
+    for offset, row in stream(iter(lambda: f.read(chunksize), ''), urn):
+        if isinstance(row, ParseTree) and row.isSyntaxError():
+            raise csv.Error(row.showing('Syntax Error'))
+        if spans:
+            row = [(offset + spos, offset + epos) for spos, epos in row]
+        yield row
+
+
+# benchmark
+
+
+def benchmark(files, repeat=3):
+    '''
+    measures throughput [MB/s] on files against the csv module
+    '''
+    def stdlib(f):
+        for _ in csv.reader(f):
+            pass
+
+    def peg(f):
+        for _ in reader(f):
+            pass
+
+    methods = [('csv.reader', stdlib), ('pegtree.csv.reader', peg)]
+    for file in files:  # warm up, and check
+        with open(file, newline='') as f, open(file, newline='') as f2:
+            for row, row2 in zip(reader(f), csv.reader(f2)):
+                assert row == row2, (row, row2)
+    size = 0
+    for file in files:
+        with open(file, 'rb') as f:
+            size += len(f.read())
+    size /= 1024 * 1024
+    times = [[] for _ in methods]
+    for _ in range(repeat):
+        for i, (_, m) in enumerate(methods):
+            st = time.perf_counter()
+            for file in files:
+                with open(file, newline='') as f:
+                    m(f)
+            times[i].append(time.perf_counter() - st)
+    return [(label, size / min(ts)) for (label, _), ts in zip(methods, times)]
@@ -0,0 +1,84 @@
+import json
+import time
+from json.decoder import scanstring
+import pegtree
+from pegtree.pasm import ParseTree
+
+# JSON on the bundled json.tpeg. Python values are built by semantic
+# actions while parsing, without any ParseTree:
+#
+#   import pegtree.json
+#   pegtree.json.loads('{"a": [1, 2.5, null]}')  # => {'a': [1, 2.5, None]}
+#
+# Syntax errors are raised as json.JSONDecodeError at the farthest failure
+# position of the grammar.
+
+
+def String(inputs, spos, epos, children, edges):
+    s = inputs[spos:epos]
+    if '\\' in s or not s.isprintable():  # escapes, or control characters
+        return scanstring(inputs, spos, True)[0]  # strict, as in json.loads
+    return s
+
+
+ACTIONS = {
+    'Object': lambda inputs, spos, epos, children, edges: dict(children),
+    'KV': lambda inputs, spos, epos, children, edges: (edges['key'], edges['value']),
+    'List': lambda inputs, spos, epos, children, edges: children,
+    'String': String,
+    'Int': lambda inputs, spos, epos, children, edges: int(inputs[spos:epos]),
+    'Float': lambda inputs, spos, epos, children, edges: float(inputs[spos:epos]),
+    'True': lambda inputs, spos, epos, children, edges: True,
+    'False': lambda inputs, spos, epos, children, edges: False,
+    'Null': lambda inputs, spos, epos, children, edges: None,
+    'Symbol': lambda inputs, spos, epos, children, edges: inputs[spos:epos],  # ObjectId
+}
+
+parser = None
+
+
+def generate(**options):
+    return pegtree.generate(pegtree.grammar('json.tpeg'), start='File',
+                            actions=ACTIONS, **options)
+
+
+def loads(s, urn='(unknown source)'):
+    global parser
+    if isinstance(s, (bytes, bytearray)):
+        s = s.decode('utf-8')
+    if parser is None:
+        parser = generate()
+    value = parser(s, urn)
+    if isinstance(value, ParseTree) and value.isSyntaxError():
+        raise json.JSONDecodeError('Syntax Error', s, value.spos_)
+    return value
+
+
+def load(f, urn=None):
+    return loads(f.read(), urn or getattr(f, 'name', '(unknown source)'))
+
+
+# benchmark
+
+
+def benchmark(docs, repeat=5):
+    '''
+    measures throughput [MB/s] on docs (a list of JSON texts)
+    '''
+    tree_parser = pegtree.generate(pegtree.grammar('json.tpeg'), start='File')
+    methods = [
+        ('json.loads', json.loads),
+        ('pegtree.json.loads', loads),
+        ('pegtree (ParseTree)', tree_parser),
+    ]
+    for doc in docs:  # warm up, and check
+        assert loads(doc) == json.loads(doc)
+    size = sum(len(doc.encode('utf-8')) for doc in docs) / (1024 * 1024)
+    times = [[] for _ in methods]
+    for _ in range(repeat):  # interleaved, so that noise affects all alike
+        for i, (_, f) in enumerate(methods):
+            st = time.perf_counter()
+            for doc in docs:
+                f(doc)
+            times[i].append(time.perf_counter() - st)
+    return [(label, size / min(ts)) for (label, _), ts in zip(methods, times)]
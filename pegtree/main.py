@@ -87,10 +87,19 @@ def parse_options(argv):
         'start': ['-s', '--start'],
         'parser': ['-p', '--parser'],
         'output': ['-o', '--output'],
+        'socket': ['--socket'],
+        'format': ['--format'],
         'verbose': ['--verbose'],
     }
 
     def parse_each(a, d):
+        if a[0].startswith('-D'):  # -D name[=value]
+            if len(a[0]) > 2:
+                define(a[0][2:], d)
+                return a[1:]
+            if len(a) > 1:
+                define(a[1], d)
+                return a[2:]
         if a[0].startswith('-'):
             if len(a) > 1:
                 for key, list in options.items():
@@ -104,13 +113,26 @@ def parse_options(argv):
             d['inputs'].append(a[0])
             return a[1:]
 
-    d = {'inputs': []}
+    d = {'inputs': [], 'defines': {}}
     while len(argv) > 0:
         argv = parse_each(argv, d)
     d['logger'] = log
     return d
 
 
+def define(s, d):
+    if '=' in s:
+        key, value = s.split('=', 1)
+        if value.isdigit():
+            value = int(value)
+        elif value.lower() in ('true', 'false'):
+            value = value.lower() == 'true'
+    else:
+        key, value = s, True
+    d[key] = value
+    d['defines'][key] = value
+
+
 class CommandUsageError(Exception):
     pass
 
@@ -120,19 +142,43 @@ def usage():
     print("  -g | --grammar <file>      specify a grammar file")
     print("  -s | --start <NAME>        specify a starting rule")
     print("  -o | --output <file>       specify an output file")
-    print("  -D                         specify an optional value")
+    print("  --socket <path>            specify a unix socket (serve/client)")
+    print("  --format json              print parse trees as JSON (parse)")
+    print("  -D <name>[=<value>]        specify an optional value")
     print()
 
     print("Example:")
     print("  pegtree parse -g math.tpeg <inputs>")
+    print("  pegtree parse -g math.tpeg --format json -D positions <inputs>")
     print("  pegtree example -g math.tpeg <inputs>")
     print("  pegtree pasm -g math.tpeg")
+    print("  pegtree factor -g java8.tpeg")
+    print("  pegtree bench -g math.tpeg -D expected <inputs>")
+    print("  pegtree bench -g java8.tpeg -D trees=false <inputs>")
+    print("  pegtree bench -g json.tpeg -D twophase=false <inputs>")
+    print("  pegtree bench.async -g math.tpeg -D clients=64 <inputs>")
+    print("  pegtree bench.bytes -g math.tpeg <inputs>")
+    print("  pegtree bench.deep -g math.tpeg -D depth=100000")
+    print("  pegtree bench.visitor -g tpeg.tpeg <inputs>")
+    print("  pegtree bench.json <inputs.json>")
+    print("  pegtree bench.csv <inputs.csv>")
+    print("  pegtree bench.grammars [<grammars>]")
+    print("  pegtree bench.startup -g java8.tpeg <inputs>")
+    print("  pegtree bench.generate [<grammars>]")
+    print("  pegtree bench.short -g math.tpeg <inputs>")
+    print("  pegtree bench.threads -g json.tpeg -D threads=8 <inputs>")
+    print("  pegtree serve -g math.tpeg --socket /tmp/pegtree.sock")
+    print("  pegtree client -g math.tpeg --socket /tmp/pegtree.sock <inputs>")
     print()
 
     print("The most commonly used pegtree commands are:")
     print(" parse      run an interactive parser")
     print(" pasm       generate a parser combinator function")
+    print(" factor     report left-factored choices")
     print(" example    test all examples")
+    print(" bench      measure parsing throughput (-D options are compared)")
+    print(" serve      run a parse server over a unix socket")
+    print(" client     parse files (or file names from stdin) with a server")
     print(" update     update pegtree (via pip)")
 
 
@@ -161,6 +207,9 @@ def parse(options, conv=None):
     peg = load_grammar(options)
     parser = generator(options)(peg, **options)
     inputs = options['inputs']
+    if options.get('format', None) == 'json':
+        parse_json(parser, inputs, options)
+        return
     if len(inputs) == 0:  # Interactive Mode
         try:
             while True:
@@ -178,6 +227,32 @@ def parse(options, conv=None):
             print(file, (et - st) * 1000.0, "[ms]:", t.gettag())
 
 
+def parse_json(parser, inputs, options):
+    # -D positions -D linecol -D text=false
+    if not options.get('trees', True):
+        log('error', None, '--format json needs trees (not -D trees=false)')
+        return
+    conv = pegtree.pasm.JSONWriter(None, options.get('positions', False),
+                                   options.get('linecol', False), options.get('text', True))
+    if len(inputs) == 0:  # Interactive Mode
+        try:
+            while True:
+                s = parser(readlines(bold('>>> ')), conv=conv)
+                print(conv.write(s) if isinstance(s, pegtree.ParseTree) else s)
+        except (EOFError, KeyboardInterrupt):
+            pass
+        return
+    f = open(options['output'], 'w') if 'output' in options else sys.stdout
+    conv.f = f
+    for file in inputs:  # one JSON document per line
+        t = parser(read_inputs(file), file, conv=conv)
+        if isinstance(t, pegtree.ParseTree):  # a syntax error
+            conv.write(t)
+        f.write('\n')
+    if f is not sys.stdout:
+        f.close()
+
+
 def dump(t, indent='  ', edge=''):
     tag = color('Blue', '#' + t.tag)
     if t.child is None:
@@ -197,14 +272,12 @@ def example(options):
     peg = load_grammar(options)
     if '@@example' not in peg:
         return
-    parsers = {}
     for testcase in peg['@@example']:
         name, doc = testcase
         if not name in peg:
             continue
-        if not name in parsers:
-            parsers[name] = generator(options)(peg, start=name)
-        res = parsers[name](doc.inputs_, doc.urn_, doc.spos_, doc.epos_)
+        parser = generator(options)(peg, start=name)  # cached by start
+        res = parser(doc.inputs_, doc.urn_, doc.spos_, doc.epos_)
         # print()
         ok = doc.inputs_[doc.spos_:res.epos_]
         fail = doc.inputs_[res.epos_:doc.epos_]
@@ -214,6 +287,12 @@ def example(options):
 
 
 def dumpError(lines, line, s):
+    if isinstance(s, pegtree.pasm.Recognition):  # -D trees=false
+        if s.ok:
+            return 0
+        prev = line[max(0, s.epos - 10):s.epos]
+        print(lines, color('Green', f'{prev}') + color('Red', f'{line[s.epos:]}'))
+        return 1
     errs = 0
     for t in s:
         cur = str(t)
@@ -244,6 +323,390 @@ def test(options):
         print(f'{fail}/{lines} {fail/lines} {(et - st) * 1000.0} ms')
 
 
+# bench command
+
+BENCH_OPTIONS = {'repeat', 'clients', 'requests', 'workers', 'depth', 'threads'}
+
+
+def measure(parsers, data, repeat):
+    times = [[] for _ in parsers]
+    results = [parser(data) for _, parser in parsers]  # warm up
+    for _ in range(repeat):
+        for i, (_, parser) in enumerate(parsers):
+            st = time.perf_counter()
+            parser(data)
+            et = time.perf_counter()
+            times[i].append(et - st)
+    return [min(ts) for ts in times], results
+
+
+def bench(options):
+    if options.get('ext') == 'async':
+        return bench_async(options)
+    if options.get('ext') == 'bytes':
+        return bench_bytes(options)
+    if options.get('ext') == 'deep':
+        return bench_deep(options)
+    if options.get('ext') == 'visitor':
+        return bench_visitor(options)
+    if options.get('ext') == 'json':
+        return bench_json(options)
+    if options.get('ext') == 'csv':
+        return bench_csv(options)
+    if options.get('ext') == 'grammars':
+        return bench_grammars(options)
+    if options.get('ext') == 'startup':
+        return bench_startup(options)
+    if options.get('ext') == 'generate':
+        return bench_generate(options)
+    if options.get('ext') == 'short':
+        return bench_short(options)
+    if options.get('ext') == 'threads':
+        return bench_threads(options)
+    peg = load_grammar(options)
+    defines = {key: value for key, value in options['defines'].items()
+               if key not in BENCH_OPTIONS}
+    repeat = options['defines'].get('repeat', 5)
+    start = options.get('start', peg.start())
+    # PEGTREE_PURE=1 compares with the pure Python combinators
+    print('pasm:', 'compiled (_pasm)' if pegtree.pasm.COMPILED else 'pure Python')
+    parsers = [('default', pegtree.generate(peg, start=start))]
+    if len(defines) > 0:
+        label = ','.join(f'{key}={value}' for key, value in defines.items())
+        parsers.append((label, pegtree.generate(peg, start=start, **defines)))
+    for file in options['inputs']:
+        data = read_inputs(file)
+        size = len(data.encode('utf-8')) / (1024 * 1024)
+        times, results = measure(parsers, data, repeat)
+        for (label, _), sec, t in zip(parsers, times, results):
+            ratio = f' ({sec / times[0] * 100.0:.1f}%)' if sec != times[0] else ''
+            print(f'{file} {label}: {sec * 1000.0:.3f} [ms] {size / sec:.3f} [MB/s]{ratio}',
+                  t if isinstance(t, pegtree.pasm.Recognition) else t.gettag())
+
+
+def timeit(f, repeat):
+    times = []
+    for _ in range(repeat):
+        st = time.perf_counter()
+        res = f()
+        et = time.perf_counter()
+        times.append(et - st)
+    return min(times), res
+
+
+def bench_bytes(options):
+    import pickle
+    from pegtree.pasm import ParseTree
+    peg = load_grammar(options)
+    parser = pegtree.generate(peg, **options)
+    repeat = options['defines'].get('repeat', 5)
+    for file in options['inputs']:
+        data = read_inputs(file)
+        t = parser(data)
+        formats = [
+            ('to_bytes', lambda: t.to_bytes(), lambda b: ParseTree.from_bytes(b)),
+            ('to_bytes(inputs=False)', lambda: t.to_bytes(False),
+             lambda b: ParseTree.from_bytes(b, data)),
+            ('pickle', lambda: pickle.dumps(t), pickle.loads),
+            ('repr', lambda: repr(t).encode('utf-8'), None),
+        ]
+        for label, encode, decode in formats:
+            esec, b = timeit(encode, repeat)
+            dsec = timeit(lambda: decode(b), repeat)[0] if decode is not None else 0
+            print(f'{file} {label}: {len(b)} [bytes] encode {esec * 1000.0:.3f} [ms]',
+                  f'decode {dsec * 1000.0:.3f} [ms]' if decode is not None else '')
+
+
+def bench_deep(options):
+    # a stress test on deeply folded trees, e.g., 1+1+...+1 (-D depth=100000)
+    from pegtree.pasm import PTree2Tuple, JSONWriter
+    peg = load_grammar(options, 'math.tpeg')
+    parser = pegtree.generate(peg, **options)
+    repeat = options['defines'].get('repeat', 5)
+    depth = options['defines'].get('depth', 100000)
+    data = '+'.join(['1'] * depth)
+    convs = [
+        ('PTree', lambda pt, urn, inputs: pt),
+        ('ParseTree', pegtree.pasm.PTree2ParseTree),
+        ('tuple', PTree2Tuple),
+        ('json', JSONWriter()),
+        ('dump', lambda pt, urn, inputs: pt.dump(inputs)),
+    ]
+    for label, conv in convs:
+        sec, _ = timeit(lambda: parser(data, conv=conv), repeat)
+        print(f'depth={depth} {label}: {sec * 1000.0:.3f} [ms]')
+
+
+def bench_json(options):
+    from pegtree.json import benchmark
+    docs = [read_inputs(file) for file in options['inputs']]
+    if len(docs) == 0:
+        raise CommandUsageError()
+    results = benchmark(docs, options['defines'].get('repeat', 5))
+    for label, mbps in results:
+        ratio = f' ({mbps / results[0][1] * 100.0:.2f}%)' if mbps != results[0][1] else ''
+        print(f'{label}: {mbps:.3f} [MB/s]{ratio}')
+
+
+def bench_csv(options):
+    from pegtree.csv import benchmark
+    if len(options['inputs']) == 0:
+        raise CommandUsageError()
+    results = benchmark(options['inputs'], options['defines'].get('repeat', 3))
+    for label, mbps in results:
+        ratio = f' ({mbps / results[0][1] * 100.0:.2f}%)' if mbps != results[0][1] else ''
+        print(f'{label}: {mbps:.3f} [MB/s]{ratio}')
+
+
+def bench_grammars(options):
+    # generates many grammars in one process, with and without hash-consing
+    import tracemalloc
+    from pegtree.pegtree import Generator, combinator_stats
+    files = options['inputs']
+    if len(files) == 0:
+        files = sorted(p.name for p in (Path(pegtree.pegtree.__file__).parent / 'grammar').glob('*.tpeg'))
+    pegs = [pegtree.grammar(file) for file in files]
+    modes = [{}, {'trees': False}, {'expected': True}]
+    for cons in (False, True):
+        parsers = []
+        tracemalloc.start()
+        st = time.perf_counter()
+        for peg in pegs:
+            for mode in modes:
+                g = Generator(**mode)
+                g.Ocons = cons
+                parsers.append(g.generate(peg))
+        et = time.perf_counter()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'hash-consing={cons}: {len(parsers)} parsers of {len(pegs)} grammars',
+              f'{(et - st) * 1000.0:.3f} [ms] {size / 1024:.1f} [KiB]')
+    print(combinator_stats())
+
+
+def bench_generate(options):
+    # generate() time of each grammar, which should grow no faster than its rules
+    from pegtree.pegtree import Generator, Combinators
+    files = options['inputs']
+    if len(files) == 0:
+        files = sorted(p.name for p in (Path(pegtree.pegtree.__file__).parent / 'grammar').glob('*.tpeg'))
+    repeat = options['defines'].get('repeat', 5)
+    for file in files:
+        peg = pegtree.grammar(file)
+        times = []
+        for _ in range(repeat):
+            Combinators.clear()  # compiles from scratch
+            g = Generator()
+            st = time.perf_counter()
+            g.generate(peg)
+            times.append(time.perf_counter() - st)
+        rules = max(len(g.generated), 1)
+        print(f'{file}: {rules} rules {min(times) * 1000.0:.3f} [ms]',
+              f'{min(times) * 1000000.0 / rules:.1f} [us/rule]')
+
+
+def bench_short(options):
+    # many short inputs: the lines of 10-200 characters in the inputs
+    from pegtree.pasm import PContext, PMemo, MEMO_SIZE
+    peg = load_grammar(options)
+    parser = pegtree.generate(peg, **options)
+    repeat = options['defines'].get('repeat', 5)
+    docs = []
+    for file in options['inputs']:
+        docs.extend(line for line in read_inputs(file).splitlines() if 10 <= len(line) <= 200)
+    if len(docs) == 0:
+        raise CommandUsageError()
+
+    def fresh():  # a new context with a full memo table for each input
+        for inputs in docs:
+            px = PContext(inputs, 0, len(inputs))
+            px.memo = [PMemo() for x in range(MEMO_SIZE)]
+    size = sum(len(inputs) for inputs in docs) / len(docs)
+    print(f'{len(docs)} inputs of {size:.1f} characters')
+    modes = [
+        ('allocating a context (no parsing)', fresh),
+        ('parser(inputs)', lambda: [parser(inputs) for inputs in docs]),
+        ('parser.parse_many', lambda: list(parser.parse_many(docs))),
+    ]
+    for label, f in modes:
+        sec, _ = timeit(f, repeat)
+        print(f'{label}: {sec * 1000000.0 / len(docs):.3f} [us/input]',
+              f'{len(docs) / sec:.1f} [inputs/s]')
+
+
+def bench_threads(options):
+    # one parser called from 1, 2, 4, ... threads, each parsing all inputs
+    # (it scales only on free-threaded builds, e.g., python3.13t)
+    import threading
+    peg = load_grammar(options)
+    parser = pegtree.generate(peg, start=options.get('start', peg.start()))
+    repeat = options['defines'].get('repeat', 3)
+    maxthreads = options['defines'].get('threads', os.cpu_count() or 1)
+    docs = [read_inputs(file) for file in options['inputs']]
+    if len(docs) == 0:
+        raise CommandUsageError()
+    size = sum(len(inputs.encode('utf-8')) for inputs in docs) / (1024 * 1024)
+    expected = [repr(parser(inputs)) for inputs in docs]
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print('pasm:', 'compiled (_pasm)' if pegtree.pasm.COMPILED else 'pure Python',
+          'GIL enabled' if gil else 'free-threaded')
+    bad = []
+
+    def work():
+        for inputs, res in zip(docs, expected):
+            if repr(parser(inputs)) != res:
+                bad.append(inputs)
+    n = 1
+    base = None
+    while n <= maxthreads:
+        def run():
+            threads = [threading.Thread(target=work) for _ in range(n)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        sec, _ = timeit(run, repeat)
+        mbps = size * n / sec
+        base = base or mbps
+        print(f'threads={n}: {sec * 1000.0:.3f} [ms] {mbps:.3f} [MB/s]',
+              f'x{mbps / base:.2f}', 'ok' if len(bad) == 0 else f'{len(bad)} wrong trees')
+        n *= 2
+
+
+def bench_startup(options):
+    # time to the first parse, with all rules compiled ahead or on demand
+    from pegtree.pegtree import Generator, Combinators
+    peg = load_grammar(options)
+    start = options.get('start', peg.start())
+    data = [read_inputs(file) for file in options['inputs']]
+    for lazy in (False, True):
+        Combinators.clear()  # compiles from scratch
+        st = time.perf_counter()
+        parser = Generator(lazy=lazy).generate(peg, start=start)
+        gt = time.perf_counter()
+        for inputs in data:
+            parser(inputs)
+        ft = time.perf_counter()
+        for inputs in data:
+            parser(inputs)
+        et = time.perf_counter()
+        print(f'lazy={lazy}: generate {(gt - st) * 1000.0:.3f} [ms]',
+              f'first parse {(ft - gt) * 1000.0:.3f} [ms]',
+              f'total {(ft - st) * 1000.0:.3f} [ms]',
+              f'next parse {(et - ft) * 1000.0:.3f} [ms]')
+
+
+def bench_visitor(options):
+    # converts trees into tuples (getattr dispatch vs Transformer vs fusion)
+    from pegtree.pasm import ParseTree
+    from pegtree.visitor import Transformer
+
+    class GetattrConv(object):  # as in TPEGLoader.conv
+        def conv(self, t):
+            tag = t.gettag()
+            if hasattr(self, tag):
+                return getattr(self, tag)(t)
+            return self.undefined(t)
+
+        def undefined(self, t):
+            children = tuple(self.conv(child) for child in t)
+            edges = tuple((key, self.conv(v)) for key, v in t.__dict__.items()
+                          if isinstance(v, ParseTree))
+            if len(children) == 0 and len(edges) == 0:
+                return (t.tag_, str(t))
+            return (t.tag_, children, edges)
+
+    class TupleTransformer(Transformer):
+        def undefined(self, node):
+            if len(node.children) == 0 and len(node.edges) == 0:
+                return (node.tag, str(node))
+            return (node.tag, tuple(node.children), tuple(node.edges.items()))
+
+    peg = load_grammar(options, 'tpeg.tpeg')
+    parser = pegtree.generate(peg, **options)
+    repeat = options['defines'].get('repeat', 5)
+    getattr_conv = GetattrConv()
+    transformer = TupleTransformer()
+    convs = [
+        ('getattr', lambda data: getattr_conv.conv(parser(data))),
+        ('Transformer', lambda data: transformer.transform(parser(data))),
+        ('conv=Transformer', lambda data: parser(data, conv=transformer)),
+    ]
+    for file in options['inputs']:
+        data = read_inputs(file)
+        results = [f(data) for _, f in convs]
+        assert all(res == results[0] for res in results)
+        times = [timeit(lambda: f(data), repeat)[0] for _, f in convs]
+        sec, _ = timeit(lambda: parser(data, conv=lambda pt, urn, inputs: pt), repeat)
+        print(f'{file} (parsing only): {sec * 1000.0:.3f} [ms]')
+        for (label, _), sec in zip(convs, times):
+            ratio = f' ({sec / times[0] * 100.0:.1f}%)' if sec != times[0] else ''
+            print(f'{file} {label}: {sec * 1000.0:.3f} [ms]{ratio}')
+
+
+def bench_async(options):
+    import asyncio
+    from pegtree.aio import benchmark
+    if 'grammar' not in options:
+        raise CommandUsageError()
+    docs = [read_inputs(file) for file in options['inputs']]
+    if len(docs) == 0:
+        raise CommandUsageError()
+    defines = options['defines']
+    generate_options = {key: value for key, value in defines.items()
+                        if key not in BENCH_OPTIONS}
+    if 'start' in options:
+        generate_options['start'] = options['start']
+    results = asyncio.run(benchmark(options['grammar'], docs,
+                                    clients=defines.get('clients', 64),
+                                    requests=defines.get('requests', 2000),
+                                    workers=defines.get('workers', None),
+                                    **generate_options))
+    for label, (throughput, p99) in results:
+        print(f'{label}: {throughput:.1f} [req/s] p99 {p99 * 1000.0:.3f} [ms]')
+
+
+# serve/client command
+
+
+def serve(options):
+    from pegtree.server import ParseServer
+    if 'socket' not in options:
+        raise CommandUsageError()
+    generate_options = dict(options['defines'])
+    if 'start' in options:
+        generate_options['start'] = options['start']
+    try:
+        server = ParseServer(options['socket'], options.get('grammar', None), **generate_options)
+    except FileExistsError as e:
+        print(color('Red', '[error] ') + str(e))
+        return
+    with server:
+        print(bold('serving'), options['socket'])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def client(options):
+    import json
+    from pegtree.server import ParseClient
+    if 'socket' not in options:
+        raise CommandUsageError()
+    grammar = options.get('grammar', None)
+    if grammar is not None and Path(grammar).exists():
+        grammar = str(Path(grammar).resolve())
+    files = options['inputs']
+    if len(files) == 0:
+        files = (line.strip() for line in sys.stdin if line.strip() != '')
+    tree = options['defines'].get('tree', False)
+    with ParseClient(options['socket']) as c:
+        for file in files:
+            res = c.parse_file(file, grammar, options.get('start', None), tree)
+            print(json.dumps(res, ensure_ascii=False))
+
+
 def peg(options):
     peg = load_grammar(options)
     print(peg)
@@ -262,6 +725,18 @@ def pasm(options):
     parsec(peg, **options)
 
 
+def factor(options):
+    # reports the choices left-factored in each rule, in the pass the
+    # parser matches with (untracked, when parsing in two phases)
+    peg = load_grammar(options)
+    g = pegtree.pegtree.Generator()
+    g.generate(peg, start=options.get('start', peg.start()))
+    for name, n in g.factored.items():
+        print(f'{name}: {n}')
+    print(f'{options["grammar"]}: {sum(g.factored.values())} choices factored',
+          f'in {len(g.factored)} rules')
+
+
 def update(options):
     try:
         # pip3 install -U git+https://github.com/KuramitsuLab/pegpy.git
@@ -38,6 +38,7 @@ class Parsec(Generator):
         self.prefix = os.environ.get('PREFIX', 'p')
         self.PASM = set(PASMS[options.get('optimized', 1)])
         self.rules = None
+        self.Ocons = False  # the emitted code is not shared as combinators are
 
     def setup(self, spec):
         self.apply = spec.get('apply', '{}({})')
@@ -50,6 +51,17 @@ class Parsec(Generator):
         self.rules = []
         spec['rules'] = self.rules
 
+    def generate(self, peg, **option):
+        # emits each rule as code, with no combinators to link or parse with
+        self.peg = peg
+        start = peg.newRef(option.get('start', peg.start()))
+        for ref in self.rulesToEmit(start):
+            self.generating_nonterminal = ref.uname()
+            self.generating_rule = ref.name
+            self.emitRule(ref)
+        self.generating_nonterminal = ''
+        return self.emitParser(start)
+
     def emitRule(self, ref):
         name = self.getref(ref.uname(self.peg))
         rule = self.rule.format(self.emitApply(
@@ -1,4 +1,11 @@
+import os
+import re
+import threading
+import weakref
 from collections import namedtuple
+from bisect import bisect_right
+from json.encoder import encode_basestring
+from types import FunctionType
 
 
 def pRule(peg, name, pf):
@@ -29,14 +36,16 @@ def pAny():
     return match_any
 
 
-CharCache = {
+# held weakly, so that matchers go away with the last parser using them
+CharCache = weakref.WeakValueDictionary({
     '': match_empty
-}
+})
 
 
 def pChar(text):
-    if text in CharCache:
-        return CharCache[text]
+    pf = CharCache.get(text)
+    if pf is not None:
+        return pf
     clen = len(text)
 
     def match_char(px):
@@ -48,60 +57,85 @@ def pChar(text):
     return match_char
 
 # Range
+# A character class is compiled to the cheapest membership test for its
+# size: a frozenset of its characters (one hashed lookup, without ord()),
+# which covers ASCII as well as BMP blocks such as kanji, or for larger
+# classes such as [\x80-\U0010ffff], the sorted bounds of its intervals
+# searched by bisection.
 
+LARGE_CHARSET = 65536
 
-def unique_range(chars, ranges, memo=None):
-    cs = 0
-    for c in chars:
-        cs |= 1 << ord(c)
-    r = ranges
-    while len(r) > 1:
-        for c in range(ord(r[0]), ord(r[1])+1):
-            cs |= 1 << c
-        r = r[2:]
-    if memo is not None:
-        if cs in memo:
-            return memo[cs]
-        memo[cs] = cs
-    return cs
+
+class Intervals(object):
+    __slots__ = ['bounds']
+
+    def __init__(self, bounds):
+        self.bounds = bounds  # [start, end+1, start, end+1, ...]
+
+    def __contains__(self, c):
+        return bisect_right(self.bounds, ord(c)) & 1 == 1
 
 
-def minimum_range(chars, ranges):
-    cs = 0xffff
-    for c in chars:
-        cs = min(cs, ord(c))
+def intervals(chars, ranges):
+    rs = [(ord(c), ord(c)) for c in chars]
     r = ranges
     while len(r) > 1:
-        cs = min(cs, ord(r[0]))
-        cs = min(cs, ord(r[1]))
+        rs.append((ord(r[0]), ord(r[1])))
         r = r[2:]
-    return cs
+    rs.sort()
+    merged = []
+    for start, end in rs:
+        if len(merged) > 0 and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
 
 
-BitmapCache = {}
+CharsetCache = {}  # frozensets cannot be weakly referenced
+CHARSET_CACHE_SIZE = 1024
+CharsetLock = threading.Lock()
 
 
-def bitmap(chars, ranges):
+def charset(chars, ranges):
     key = (chars, ranges)
-    if key in BitmapCache:
-        return BitmapCache[key]
-    offset = minimum_range(chars, ranges)
-    bitset = unique_range(chars, ranges) >> offset
-    BitmapCache[key] = (bitset, offset)
-    return BitmapCache[key]
+    cs = CharsetCache.get(key)
+    if cs is not None:
+        return cs
+    rs = intervals(chars, ranges)
+    if sum(end - start + 1 for start, end in rs) > LARGE_CHARSET:
+        cs = Intervals([b for start, end in rs for b in (start, end + 1)])
+    else:
+        cs = frozenset(chr(c) for start, end in rs for c in range(start, end + 1))
+    with CharsetLock:
+        if len(CharsetCache) >= CHARSET_CACHE_SIZE:
+            del CharsetCache[next(iter(CharsetCache))]  # the oldest
+        CharsetCache[key] = cs
+    return cs
 
 
 def pRange(chars, ranges):
-    bitset, offset = bitmap(chars, ranges)
+    cs = charset(chars, ranges)
 
-    def match_bitset(px):
-        if px.pos < px.epos:
-            shift = ord(px.inputs[px.pos]) - offset
-            if shift >= 0 and (bitset & (1 << shift)) != 0:
-                px.pos += 1
-                return True
+    def match_range(px):
+        if px.pos < px.epos and px.inputs[px.pos] in cs:
+            px.pos += 1
+            return True
         return False
-    return match_bitset
+    return match_range
+
+
+def pRegex(pattern):  # lexical fast path (a possessive regex as PEG)
+    match = re.compile(pattern, re.DOTALL).match
+
+    def match_regex(px):
+        m = match(px.inputs, px.pos, px.epos)
+        if m is None:
+            px.headpos = max(px.pos, px.headpos)
+            return False
+        px.pos = m.end()
+        return True
+    return match_regex
 
 
 def pAnd(pf):
@@ -269,6 +303,288 @@ def pOre(*pfs):
     return match_ore
 
 
+# A choice dispatched on the next character; table maps a character to
+# the alternatives that can start with it, and default holds the ones that
+# may start with any character.
+
+
+def pDispatch(table, default):
+    def match_dispatch(px):
+        pos = px.pos
+        ast = px.ast
+        pfs = table.get(px.inputs[pos], default) if pos < px.epos else default
+        for pf in pfs:
+            if pf(px):
+                return True
+            px.headpos = max(px.pos, px.headpos)
+            px.pos = pos
+            px.ast = ast
+        px.headpos = max(pos, px.headpos)
+        return False
+    return match_dispatch
+
+# Recognizer
+# generate(peg, trees=False) compiles tree construction away, so px.ast is
+# never set; these variants backtrack px.pos alone.
+
+
+def pRecogNot(pf):
+    def match_not(px):
+        pos = px.pos
+        if not pf(px):
+            px.headpos = max(px.pos, px.headpos)
+            px.pos = pos
+            return True
+        return False
+    return match_not
+
+
+def pRecogMany(pf):
+    def match_many(px):
+        pos = px.pos
+        while pf(px) and pos < px.pos:
+            pos = px.pos
+        px.headpos = max(px.pos, px.headpos)
+        px.pos = pos
+        return True
+    return match_many
+
+
+def pRecogMany1(pf):
+    def match_many1(px):
+        if pf(px):
+            pos = px.pos
+            while pf(px) and pos < px.pos:
+                pos = px.pos
+            px.headpos = max(px.pos, px.headpos)
+            px.pos = pos
+            return True
+        return False
+    return match_many1
+
+
+def pRecogOption(pf):
+    def match_option(px):
+        pos = px.pos
+        if not pf(px):
+            px.headpos = max(px.pos, px.headpos)
+            px.pos = pos
+        return True
+    return match_option
+
+
+def pRecogOre2(pf, pf2):
+    def match_ore2(px):
+        pos = px.pos
+        if pf(px):
+            return True
+        px.headpos = max(px.pos, px.headpos)
+        px.pos = pos
+        return pf2(px)
+    return match_ore2
+
+
+def pRecogOre3(pf, pf2, pf3):
+    def match_ore3(px):
+        pos = px.pos
+        if pf(px):
+            return True
+        px.headpos = max(px.pos, px.headpos)
+        px.pos = pos
+        if pf2(px):
+            return True
+        px.headpos = max(px.pos, px.headpos)
+        px.pos = pos
+        return pf3(px)
+    return match_ore3
+
+
+def pRecogOre4(pf, pf2, pf3, pf4):
+    def match_ore4(px):
+        pos = px.pos
+        if pf(px):
+            return True
+        px.headpos = max(px.pos, px.headpos)
+        px.pos = pos
+        if pf2(px):
+            return True
+        px.headpos = max(px.pos, px.headpos)
+        px.pos = pos
+        if pf3(px):
+            return True
+        px.headpos = max(px.pos, px.headpos)
+        px.pos = pos
+        return pf4(px)
+    return match_ore4
+
+
+def pRecogOre(*pfs):
+    def match_ore(px):
+        pos = px.pos
+        for pf in pfs:
+            if pf(px):
+                return True
+            px.headpos = max(px.pos, px.headpos)
+            px.pos = pos
+        return False
+    return match_ore
+
+
+def pRecogDispatch(table, default):
+    def match_dispatch(px):
+        pos = px.pos
+        pfs = table.get(px.inputs[pos], default) if pos < px.epos else default
+        for pf in pfs:
+            if pf(px):
+                return True
+            px.headpos = max(px.pos, px.headpos)
+            px.pos = pos
+        px.headpos = max(pos, px.headpos)
+        return False
+    return match_dispatch
+
+# Untracked
+# Variants that leave px.headpos alone. headpos is only needed for the
+# error position, so generate() runs a parser built on these first, and
+# reruns the tracked one only when it fails.
+
+
+def pFastAnd(pf):
+    def match_and(px):
+        pos = px.pos
+        if pf(px):
+            px.pos = pos
+            return True
+        return False
+    return match_and
+
+
+def pFastNot(pf):
+    def match_not(px):
+        pos = px.pos
+        ast = px.ast
+        if not pf(px):
+            px.pos = pos
+            px.ast = ast
+            return True
+        return False
+    return match_not
+
+
+def pFastMany(pf):
+    def match_many(px):
+        pos = px.pos
+        ast = px.ast
+        while pf(px) and pos < px.pos:
+            pos = px.pos
+            ast = px.ast
+        px.pos = pos
+        px.ast = ast
+        return True
+    return match_many
+
+
+def pFastMany1(pf):
+    def match_many1(px):
+        if pf(px):
+            pos = px.pos
+            ast = px.ast
+            while pf(px) and pos < px.pos:
+                pos = px.pos
+                ast = px.ast
+            px.pos = pos
+            px.ast = ast
+            return True
+        return False
+    return match_many1
+
+
+def pFastOption(pf):
+    def match_option(px):
+        pos = px.pos
+        ast = px.ast
+        if not pf(px):
+            px.pos = pos
+            px.ast = ast
+        return True
+    return match_option
+
+
+def pFastOre2(pf, pf2):
+    def match_ore2(px):
+        pos = px.pos
+        ast = px.ast
+        if pf(px):
+            return True
+        px.pos = pos
+        px.ast = ast
+        return pf2(px)
+    return match_ore2
+
+
+def pFastOre3(pf, pf2, pf3):
+    def match_ore3(px):
+        pos = px.pos
+        ast = px.ast
+        if pf(px):
+            return True
+        px.pos = pos
+        px.ast = ast
+        if pf2(px):
+            return True
+        px.pos = pos
+        px.ast = ast
+        return pf3(px)
+    return match_ore3
+
+
+def pFastOre4(pf, pf2, pf3, pf4):
+    def match_ore4(px):
+        pos = px.pos
+        ast = px.ast
+        if pf(px):
+            return True
+        px.pos = pos
+        px.ast = ast
+        if pf2(px):
+            return True
+        px.pos = pos
+        px.ast = ast
+        if pf3(px):
+            return True
+        px.pos = pos
+        px.ast = ast
+        return pf4(px)
+    return match_ore4
+
+
+def pFastOre(*pfs):
+    def match_ore(px):
+        pos = px.pos
+        ast = px.ast
+        for pf in pfs:
+            if pf(px):
+                return True
+            px.pos = pos
+            px.ast = ast
+        return False
+    return match_ore
+
+
+def pFastDispatch(table, default):
+    def match_dispatch(px):
+        pos = px.pos
+        ast = px.ast
+        pfs = table.get(px.inputs[pos], default) if pos < px.epos else default
+        for pf in pfs:
+            if pf(px):
+                return True
+            px.pos = pos
+            px.ast = ast
+        return False
+    return match_dispatch
+
+
 def make_trie(dic):
     if '' in dic or len(dic) < 10:
         return dic
@@ -312,22 +628,83 @@ def pDict(words):
 
 
 def pRef(generated, uname):
-    if uname not in generated:
-        fs = None
-
-        def match_deref(px):
-            nonlocal fs
-            if fs is None:
-                fs = generated[uname]
-            return fs(px)
-        generated[uname] = match_deref
+    if uname not in generated:  # a forward reference, until link()
+        def match_ref(px):
+            return generated[uname](px)
+        match_ref.uname = uname
+        generated[uname] = match_ref
     return generated[uname]
 
 
-def pRef(generated, uname):
-    if uname not in generated:
-        generated[uname] = lambda px: generated[uname](px)
-    return generated[uname]
+def pLazy(generated, uname, compile):
+    '''
+    a stub of the rule uname, which compile() generates into generated
+    when the stub is first matched
+    '''
+    def match_lazy(px):
+        pf = generated[uname]
+        if pf is match_lazy:
+            pf = compile()
+        return pf(px)
+    match_lazy.uname = uname
+    generated[uname] = match_lazy
+    return match_lazy
+
+
+def link(pf, generated):
+    '''
+    replaces the forward references in the combinators reachable from pf
+    with the functions they refer to, once all rules are generated
+    (the closures are patched, so setup.py leaves this module to Python)
+    '''
+    def deref(f):
+        for _ in range(len(generated)):  # A = B, B = A never ends
+            uname = getattr(f, 'uname', None)
+            if uname is None or generated.get(uname, f) is f:
+                break
+            f = generated[uname]
+        return f
+
+    def resolve(v):
+        if isinstance(v, tuple):
+            return tuple(resolve(x) for x in v)
+        if isinstance(v, dict):  # dispatch tables
+            for key, x in v.items():
+                if isinstance(x, tuple) or callable(x):
+                    v[key] = resolve(x)
+            return v
+        if callable(v):
+            v = deref(v)
+            if hasattr(v, 'uname'):  # an unresolved reference
+                return v
+            if isinstance(v, FunctionType) and v.__module__ == __name__ \
+                    or COMPILED and isinstance(v, Matcher):
+                stack.append(v)
+        return v
+
+    seen = set()
+    stack = []
+    resolve(pf)
+    while len(stack) > 0:
+        f = stack.pop()
+        if id(f) in seen:
+            continue
+        seen.add(id(f))
+        if not isinstance(f, FunctionType):  # the typed matchers of _pasm
+            f.link(resolve)
+            continue
+        if f.__closure__ is None:
+            continue
+        for cell in f.__closure__:
+            try:
+                v = cell.cell_contents
+            except ValueError:  # not yet assigned
+                continue
+            if isinstance(v, tuple) or isinstance(v, dict) or callable(v):
+                v2 = resolve(v)
+                if v2 is not v:
+                    cell.cell_contents = v2
+    return deref(pf)
 
 
 class PMemo(object):
@@ -342,27 +719,35 @@ class PMemo(object):
         self.result = False
 
 
-def pMemo(fs, mp, mpsize):
-    disabled = False
-    hit = 0
-    miss = 0
+MEMO_SIZE = 1789
+
+
+def memo_table(px, mpsize):  # allocated by the first memoized match
+    px.memo = [PMemo() for x in range(MEMO_SIZE)]
+    # [hits, misses, disabled] of each memoized rule, kept by the context
+    # (and so by its parser's pool) instead of the shared combinators
+    px.stats = [[0, 0, False] for x in range(mpsize)]
+    return px.memo
+
 
+def pMemo(fs, mp, mpsize):
     def match_memo(px):
-        nonlocal disabled, hit, miss
-        if disabled:
+        memo = px.memo or memo_table(px, mpsize)
+        stat = px.stats[mp]
+        if stat[2]:  # disabled
             return fs(px)
         key = (mpsize * px.pos) + mp
-        m = px.memo[key % 1789]
+        m = memo[key % MEMO_SIZE]
         if m.key == key:
             if m.treeState:
                 if m.prev == px.ast:
                     px.pos = m.pos
                     px.ast = m.ast
-                    hit += 1
+                    stat[0] += 1
                     return m.result
             else:
                 px.pos = m.pos
-                hit += 1
+                stat[0] += 1
                 return m.result
         prev = px.ast
         m.result = fs(px)
@@ -374,36 +759,32 @@ def pMemo(fs, mp, mpsize):
             m.ast = px.ast
         else:
             m.treeState = False
-        miss += 1
-        if miss % 100 == 0:
-            if hit / miss < 5:
-                disabled = True
+        stat[1] += 1
+        if stat[1] % 100 == 0:
+            if stat[0] / stat[1] < 5:
+                stat[2] = True
         return m.result
     return match_memo
 
 
-def pMemoDebug(name, fs, mp, mps):
-    disabled = False
-    hit = 0
-    miss = 0
-    mpsize = len(mps)
-
+def pMemoDebug(fs, mp, mpsize):
+    # pMemo that never disables itself; px.stats[mp] counts every call, and
+    # is marked disabled where pMemo would have given up
     def match_memo(px):
-        nonlocal disabled, hit, miss
-        if disabled:
-            return fs(px)
+        memo = px.memo or memo_table(px, mpsize)
+        stat = px.stats[mp]
         key = (mpsize * px.pos) + mp
-        m = px.memo[key % 1789]
+        m = memo[key % MEMO_SIZE]
         if m.key == key:
             if m.treeState:
                 if m.prev == px.ast:
                     px.pos = m.pos
                     px.ast = m.ast
-                    hit += 1
+                    stat[0] += 1
                     return m.result
             else:
                 px.pos = m.pos
-                hit += 1
+                stat[0] += 1
                 return m.result
         prev = px.ast
         m.result = fs(px)
@@ -415,12 +796,9 @@ def pMemoDebug(name, fs, mp, mps):
             m.ast = px.ast
         else:
             m.treeState = False
-        miss += 1
-        if miss % 100 == 0:
-            if hit / miss < 5:
-                mps.remove(name)
-                print('enabled', mps)
-                disabled = True
+        stat[1] += 1
+        if stat[1] % 100 == 0 and stat[0] / stat[1] < 5:
+            stat[2] = True
         return m.result
     return match_memo
 
@@ -428,6 +806,45 @@ def pMemoDebug(name, fs, mp, mps):
 # Tree Construction
 
 
+# Tags and edge labels are interned into process-wide integer ids, which
+# PTree stores instead of strings. The empty tag '' is always 0.
+
+TAGS = ['']
+TAG_IDS = {'': 0}
+
+
+TagLock = threading.Lock()
+
+
+def tag_id(tag):
+    tid = TAG_IDS.get(tag)
+    if tid is None:
+        with TagLock:  # interned once, even from threads at the same time
+            if tag not in TAG_IDS:
+                TAGS.append(tag)
+                TAG_IDS[tag] = len(TAGS) - 1
+            tid = TAG_IDS[tag]
+    return tid
+
+
+def tag_name(tid):
+    return TAGS[tid]
+
+
+ERR = tag_id('err')
+
+
+def dispatch_table(obj, default):
+    '''
+    a list of obj.<tag> (or default), indexed by tag ids
+    '''
+    table = []
+    for tag in TAGS:
+        f = getattr(obj, tag, None) if tag != '' else None
+        table.append(f if callable(f) else default)
+    return table
+
+
 class PTree(object):
     __slots__ = ['prev', 'tag', 'spos', 'epos', 'child']
 
@@ -443,15 +860,25 @@ class PTree(object):
 
     def dump(self, inputs):
         sb = []
-        if self.prev is not None:
-            sb.append(self.prev.dump(inputs))
-            sb.append(',')
-        sb.append(f'{{#{self.tag} ')
-        if self.child is None:
-            sb.append(repr(inputs[self.spos:self.epos]))
-        else:
-            sb.append(self.child.dump(inputs))
-        sb.append('}')
+        stack = [self]
+        while len(stack) > 0:
+            pt = stack.pop()
+            if isinstance(pt, str):
+                sb.append(pt)
+                continue
+            chain = []
+            while pt is not None:
+                chain.append(pt)
+                pt = pt.prev
+            for i, pt in enumerate(chain):  # pushed last-first, popped first-first
+                stack.append('}')
+                if pt.child is None:
+                    stack.append(repr(inputs[pt.spos:pt.epos]))
+                else:
+                    stack.append(pt.child)
+                stack.append(f'{{#{TAGS[pt.tag]} ')
+                if i < len(chain) - 1:
+                    stack.append(',')
         return ''.join(sb)
 
 
@@ -460,7 +887,7 @@ def splitPTree(pt):
         return None, None
     if pt.prev is None:
         return None, pt
-    return pt.prev, PTree(None, pt.tag, pt.spos, pt.epos, pt.child)
+    return pt.prev, pt.__class__(None, pt.tag, pt.spos, pt.epos, pt.child)
 
 
 def makePTree(pt: PTree, inputs: str):
@@ -470,7 +897,7 @@ def makePTree(pt: PTree, inputs: str):
             child = repr(inputs[pt.spos:pt.epos])
         else:
             child = makePTree(pt.child)
-        child = (pt.tag, child)
+        child = (TAGS[pt.tag], child)
         ns.append(child)
         pt = pt.prev
     if len(ns) == 1:
@@ -479,6 +906,8 @@ def makePTree(pt: PTree, inputs: str):
 
 
 def pNode(pf, tag, shift):
+    tag = tag_id(tag)
+
     def make_tree(px):
         pos = px.pos
         prev = px.ast
@@ -491,6 +920,8 @@ def pNode(pf, tag, shift):
 
 
 def pEdge(edge, pf):
+    edge = tag_id(edge)
+
     def match_edge(px):
         pos = px.pos
         prev = px.ast
@@ -503,6 +934,7 @@ def pEdge(edge, pf):
 
 
 def pFold(edge, pf, tag, shift):
+    tag = tag_id(tag)
     if edge == '':
         def match_fold(px):
             pos = px.pos
@@ -513,6 +945,8 @@ def pFold(edge, pf, tag, shift):
             return False
         return match_fold
     else:
+        edge = tag_id(edge)
+
         def match_fold2(px):
             pos = px.pos
             # pprev = px.ast
@@ -525,6 +959,117 @@ def pFold(edge, pf, tag, shift):
         return match_fold2
 
 
+# Semantic actions
+#
+# With actions ({tag: f}), pNodeAction and pFoldAction call
+# f(inputs, spos, epos, children, edges) when a node is made, and keep the
+# value in a PValue entry instead of its subtree. children is a list of the
+# values of unlabeled children, and edges is a dict of labeled ones. Tags
+# without an action make a ParseTree whose children are values.
+# Backtracking just drops entries, so actions should have no side effects;
+# they may be called for nodes that are discarded later.
+
+
+class PValue(PTree):
+    __slots__ = []
+
+
+def subvalues(pt, inputs, urn, actions):
+    entries = []
+    while pt is not None:
+        entries.append(pt)
+        pt = pt.prev
+    children = []
+    edges = {}
+    for i in range(len(entries) - 1, -1, -1):
+        pt = entries[i]
+        if pt.__class__ is PValue:
+            children.append(pt.child)
+            continue
+        v = chainvalue(pt.child, pt.spos, abs(pt.epos), inputs, urn, actions)
+        if pt.tag == 0:
+            children.append(v)
+        elif TAGS[pt.tag] not in edges:  # the first one wins
+            edges[TAGS[pt.tag]] = v
+    return children, edges
+
+
+def chainvalue(pt, spos, epos, inputs, urn, actions):
+    if pt is not None and pt.prev is None and pt.__class__ is PValue:
+        return pt.child
+    children, edges = subvalues(pt, inputs, urn, actions)
+    action = actions.get('', None)
+    if action is not None:
+        return action(inputs, spos, epos, children, edges)
+    return treevalue('', 0, inputs, spos, epos, urn, children, edges)
+
+
+def treevalue(tag, tid, inputs, spos, epos, urn, children, edges):
+    t = ParseTree(tag, inputs, spos, epos, urn, tid)
+    t.extend(children)
+    for key, v in edges.items():
+        setattr(t, key, v)
+    return t
+
+
+def pNodeAction(pf, tag, shift, actions):
+    tid = tag_id(tag)
+    action = actions.get(tag, None)
+
+    def make_value(px):
+        pos = px.pos
+        prev = px.ast
+        px.ast = None
+        if pf(px):
+            spos = pos + shift
+            if px.ast is None:
+                children, edges = [], {}
+            else:
+                children, edges = subvalues(px.ast, px.inputs, px.urn, actions)
+            if action is None:
+                value = treevalue(tag, tid, px.inputs, spos, px.pos, px.urn, children, edges)
+            else:
+                value = action(px.inputs, spos, px.pos, children, edges)
+            px.ast = PValue(prev, tid, spos, px.pos, value)
+            return True
+        return False
+    return make_value
+
+
+def pFoldAction(edge, pf, tag, shift, actions):
+    tid = tag_id(tag)
+    action = actions.get(tag, None)
+    edge = tag_id(edge)
+
+    def fold_value(px):
+        pos = px.pos
+        prev, pt = splitPTree(px.ast)
+        px.ast = pt if edge == 0 else PTree(None, edge, 0, -pos, pt)
+        if pf(px):
+            spos = pos + shift
+            children, edges = subvalues(px.ast, px.inputs, px.urn, actions)
+            if action is None:
+                value = treevalue(tag, tid, px.inputs, spos, px.pos, px.urn, children, edges)
+            else:
+                value = action(px.inputs, spos, px.pos, children, edges)
+            px.ast = PValue(prev, tid, spos, px.pos, value)
+            return True
+        return False
+    return fold_value
+
+
+def PTree2Value(actions):
+    def conv(pt, urn, inputs):
+        if pt.__class__ is PValue and pt.prev is None:
+            return pt.child
+        if pt.tag == ERR and pt.__class__ is PTree:
+            return PTree2ParseTree(pt, urn, inputs)
+        if pt.prev is None and pt.tag == 0:  # no node, as PTree2ParseTree reads it
+            return chainvalue(pt.child, pt.spos, pt.epos, inputs, urn, actions)
+        return chainvalue(pt, pt.spos, pt.epos, inputs, urn, actions)
+    return conv
+
+
 def pAbs(pf):
     def match_abs(px):
         ast = px.ast
@@ -677,69 +1222,205 @@ def pOptionChar(text):
 
 
 def pAndRange(chars, ranges):
-    bitset, offset = bitmap(chars, ranges)  # >> offset
-
-    def match_andbitset(px):
-        if px.pos < px.epos:
-            shift = ord(px.inputs[px.pos])  # - offset
-            if shift >= 0 and (bitset & (1 << shift)) != 0:
-                return True
-        return False
-    return match_andbitset
-
-
-def pAndRange(chars, ranges):
-    bitset, offset = bitmap(chars, ranges)  # >> offset
+    cs = charset(chars, ranges)
 
-    def match_andbitset(px):
-        if px.pos < px.epos:
-            shift = ord(px.inputs[px.pos]) - offset
-            if shift >= 0 and (bitset & (1 << shift)) != 0:
-                return True
-        return False
-    return match_andbitset
+    def match_andrange(px):
+        return px.pos < px.epos and px.inputs[px.pos] in cs
+    return match_andrange
 
 
 def pNotRange(chars, ranges):
-    bitset, offset = bitmap(chars, ranges)  # >> offset
+    cs = charset(chars, ranges)
 
-    def match_notbitset(px):
-        if px.pos < px.epos:
-            shift = ord(px.inputs[px.pos]) - offset
-            if shift >= 0 and (bitset & (1 << shift)) != 0:
-                return False
-        return True
-    return match_notbitset
+    def match_notrange(px):
+        return px.pos >= px.epos or px.inputs[px.pos] not in cs
+    return match_notrange
 
 
 def pManyRange(chars, ranges):
-    bitset, offset = bitmap(chars, ranges)  # >> offset
+    cs = charset(chars, ranges)
 
-    def match_manybitset(px):
-        while px.pos < px.epos:
-            shift = ord(px.inputs[px.pos]) - offset
-            if shift >= 0 and (bitset & (1 << shift)) != 0:
-                px.pos += 1
-            else:
-                break
+    def match_manyrange(px):
+        inputs = px.inputs
+        pos = px.pos
+        epos = px.epos
+        while pos < epos and inputs[pos] in cs:
+            pos += 1
+        px.pos = pos
         return True
-    return match_manybitset
+    return match_manyrange
 
 
 def pMany1Range(chars, ranges):
-    return pSeq2(pRange(chars, ranges), pManyRange(chars, ranges))
+    cs = charset(chars, ranges)
+
+    def match_many1range(px):
+        inputs = px.inputs
+        pos = px.pos
+        epos = px.epos
+        if pos < epos and inputs[pos] in cs:
+            pos += 1
+            while pos < epos and inputs[pos] in cs:
+                pos += 1
+            px.pos = pos
+            return True
+        return False
+    return match_many1range
 
 
 def pOptionRange(chars, ranges):
-    bitset, offset = bitmap(chars, ranges)  # >> offset
+    cs = charset(chars, ranges)
 
-    def match_optionbitset(px):
-        if px.pos < px.epos:
-            shift = ord(px.inputs[px.pos]) - offset
-            if shift >= 0 and (bitset & (1 << shift)) != 0:
-                px.pos += 1
+    def match_optionrange(px):
+        if px.pos < px.epos and px.inputs[px.pos] in cs:
+            px.pos += 1
         return True
-    return match_optionbitset
+    return match_optionrange
+
+# Expected
+
+# Expected-set tracking records the terminals (and the rules containing them)
+# that failed at the farthest failure position. Each terminal is numbered by
+# the generator, and the set is kept as a bitset (px.expected) so that
+# failures stay cheap.
+
+
+def pExpectAny(bit):
+    def match_any_expected(px):
+        pos = px.pos
+        if pos < px.epos:
+            px.pos = pos + 1
+            return True
+        errpos = px.errpos
+        if pos >= errpos:
+            if pos > errpos:
+                px.errpos = pos
+                px.expected = bit
+            else:
+                px.expected |= bit
+        return False
+    return match_any_expected
+
+
+def pExpectChar(text, bit):
+    clen = len(text)
+
+    def match_char_expected(px):
+        pos = px.pos
+        if px.inputs.startswith(text, pos):
+            px.pos = pos + clen
+            return True
+        errpos = px.errpos
+        if pos >= errpos:
+            if pos > errpos:
+                px.errpos = pos
+                px.expected = bit
+            else:
+                px.expected |= bit
+        return False
+    return match_char_expected
+
+
+def pExpectMany1Char(text, bit):
+    clen = len(text)
+
+    def match_many1char_expected(px):
+        pos = px.pos
+        inputs = px.inputs
+        if inputs.startswith(text, pos):
+            pos += clen
+            while inputs.startswith(text, pos):
+                pos += clen
+            px.pos = pos
+            return True
+        errpos = px.errpos
+        if pos >= errpos:
+            if pos > errpos:
+                px.errpos = pos
+                px.expected = bit
+            else:
+                px.expected |= bit
+        return False
+    return match_many1char_expected
+
+
+def pExpectRange(chars, ranges, bit):
+    cs = charset(chars, ranges)
+
+    def match_range_expected(px):
+        pos = px.pos
+        if pos < px.epos and px.inputs[pos] in cs:
+            px.pos = pos + 1
+            return True
+        errpos = px.errpos
+        if pos >= errpos:
+            if pos > errpos:
+                px.errpos = pos
+                px.expected = bit
+            else:
+                px.expected |= bit
+        return False
+    return match_range_expected
+
+
+def pExpectMany1Range(chars, ranges, bit):
+    cs = charset(chars, ranges)
+
+    def match_many1range_expected(px):
+        pos = px.pos
+        epos = px.epos
+        inputs = px.inputs
+        if pos < epos and inputs[pos] in cs:
+            pos += 1
+            while pos < epos and inputs[pos] in cs:
+                pos += 1
+            px.pos = pos
+            return True
+        errpos = px.errpos
+        if pos >= errpos:
+            if pos > errpos:
+                px.errpos = pos
+                px.expected = bit
+            else:
+                px.expected |= bit
+        return False
+    return match_many1range_expected
+
+
+def pExpectDict(words, bit):
+    if isinstance(words, str):
+        words = words.split(' ')
+    dic = make_trie(words)
+
+    def match_dict_expected(px):
+        pos = px.pos
+        if match_trie(px, dic):
+            return True
+        errpos = px.errpos
+        if pos >= errpos:
+            if pos > errpos:
+                px.errpos = pos
+                px.expected = bit
+            else:
+                px.expected |= bit
+        return False
+    return match_dict_expected
+
+
+def expected_names(expected, symbols):
+    terminals = []
+    rules = []
+    i = 0
+    while expected != 0:
+        if expected & 1:
+            terminal, rule = symbols[i]
+            if terminal not in terminals:
+                terminals.append(terminal)
+            if rule not in rules:
+                rules.append(rule)
+        expected >>= 1
+        i += 1
+    return terminals + rules
 
 # generate
 
@@ -749,17 +1430,73 @@ def pOptionRange(chars, ranges):
 
 class PContext:
     __slots__ = ['inputs', 'pos', 'epos',
-                 'headpos', 'ast', 'state', 'memo', 'dic']
+                 'headpos', 'ast', 'state', 'memo', 'stats', 'dic',
+                 'errpos', 'expected', 'urn']
 
-    def __init__(self, inputs, spos, epos):
+    def __init__(self, inputs, spos, epos, urn='(unknown source)'):
+        self.memo = None
+        self.stats = None
+        self.dic = {}
+        self.reset(inputs, spos, epos, urn)
+
+    def reset(self, inputs, spos, epos, urn='(unknown source)'):
+        '''
+        makes the context ready for another parse, keeping its memo table
+        and memo statistics
+        '''
         self.inputs = inputs
+        self.urn = urn
         self.pos = spos
         self.epos = epos
         self.headpos = spos
         self.ast = None
         self.state = None
-        self.memo = [PMemo() for x in range(1789)]
-        self.dic = {}
+        if self.memo is not None:
+            for m in self.memo:
+                m.key = -1
+        if len(self.dic) > 0:
+            self.dic = {}
+        self.errpos = -1
+        self.expected = 0
+
+    def clear(self):
+        '''
+        drops the inputs, trees and states of the last parse, which a pooled
+        context would otherwise keep alive
+        '''
+        self.inputs = None
+        self.ast = None
+        self.state = None
+        if self.memo is not None:
+            for m in self.memo:
+                m.key = -1
+                m.ast = None
+                m.prev = None
+        if len(self.dic) > 0:
+            self.dic = {}
+
+
+# Context pooling
+# A parser keeps up to POOL_SIZE contexts, which are reset for the next
+# parse instead of allocated again. list.pop() and list.append() are
+# atomic, so a parser can be called from threads at the same time.
+
+POOL_SIZE = 8
+
+
+def acquire(pool, inputs, pos, epos, urn):
+    try:
+        px = pool.pop()
+    except IndexError:
+        return PContext(inputs, pos, epos, urn)
+    px.reset(inputs, pos, epos, urn)
+    return px
+
+
+def release(pool, px):
+    if len(pool) < POOL_SIZE:
+        px.clear()
+        pool.append(px)
 
 # ParseTree
 
@@ -777,8 +1514,9 @@ UNKNOWN_SOURCE = '(unknown source)'
 
 
 class ParseTree(list):
-    def __init__(self, tag, inputs, spos=0, epos=None, urn=UNKNOWN_SOURCE):
+    def __init__(self, tag, inputs, spos=0, epos=None, urn=UNKNOWN_SOURCE, tagid=None):
         self.tag_ = tag
+        self.id_ = tagid if tagid is not None else tag_id(tag)
         self.inputs_ = inputs
         self.spos_ = spos
         self.epos_ = epos if epos is not None else len(inputs)
@@ -787,6 +1525,10 @@ class ParseTree(list):
     def gettag(self):
         return self.tag_
 
+    @property
+    def tag_id(self):
+        return self.id_
+
     def start(self):
         return rowcol(self.urn_, self.inputs_, self.spos_)
 
@@ -819,7 +1561,10 @@ class ParseTree(list):
 
     def showing(self, msg='Syntax Error'):
         urn, pos, linenum, cols, line, mark = self.decode()
-        return '{} ({}:{}:{}+{})\n{}\n{}'.format(msg, urn, linenum, cols, pos, line, mark)
+        s = '{} ({}:{}:{}+{})\n{}\n{}'.format(msg, urn, linenum, cols, pos, line, mark)
+        if hasattr(self, 'expected_'):
+            s += '\nexpected: ' + ' / '.join(self.expected_)
+        return s
 
     def __eq__(self, tag):
         return self.tag_ == tag
@@ -828,8 +1573,40 @@ class ParseTree(list):
         return self.tag_ == 'err'
 
     def __str__(self):
-        s = self.inputs_[self.spos_:self.epos_]
-        return s.decode('utf-8') if isinstance(s, bytes) else s
+        s = self.__dict__.get('text_', None)
+        if s is None:  # sliced once, and cached
+            s = self.inputs_[self.spos_:self.epos_]
+            if isinstance(s, bytes):
+                s = s.decode('utf-8')
+            self.text_ = s
+        return s
+
+    def view(self):
+        '''
+        returns the token text without copying bytes inputs (memoryview).
+        '''
+        if isinstance(self.inputs_, bytes):
+            return memoryview(self.inputs_)[self.spos_:self.epos_]
+        return str(self)
+
+    def tokens(self):
+        '''
+        yields (tag, spos, epos) of the leaves in the order of the inputs.
+        '''
+        stack = [self]
+        while len(stack) > 0:
+            t = stack.pop()
+            subs = list(t)
+            for v in t.__dict__.values():
+                if isinstance(v, ParseTree):
+                    subs.append(v)
+            if len(subs) == 0:
+                yield (t.tag_, t.spos_, t.epos_)
+                continue
+            if len(subs) > len(t):
+                subs.sort(key=lambda t: t.spos_)
+            subs.reverse()
+            stack.extend(subs)
 
     def __repr__(self):
         if self.isSyntaxError():
@@ -847,70 +1624,669 @@ class ParseTree(list):
             print("".join(sb))
 
     def strOut(self, sb, indent='\n  ', tab='  ', tag=nop, edge=nop, token=nop):
-        sb.append("[" + tag(f'#{self.tag_}'))
-        hasContent = False
-        next_indent = indent + tab
-        for child in self:
-            hasContent = True
-            sb.append(indent)
-            if hasattr(child, 'strOut'):
-                child.strOut(sb, next_indent, tab, tag, edge, token)
+        stack = [(self, indent)]
+        while len(stack) > 0:
+            t, indent = stack.pop()
+            if isinstance(t, str):
+                sb.append(t)
+                continue
+            sb.append("[" + tag(f'#{t.tag_}'))
+            items = []
+            next_indent = indent + tab
+            for child in t:
+                items.append((indent, None))
+                if isinstance(child, ParseTree):
+                    items.append((child, next_indent))
+                else:
+                    items.append((repr(child), None))
+            for key in t.__dict__:
+                v = t.__dict__[key]
+                if isinstance(v, ParseTree):
+                    items.append((indent + edge(key) + ': ', None))
+                    items.append((v, next_indent))
+            if len(items) == 0:
+                items.append((' ' + token(repr(str(t))), None))
+            stack.append(("]", None))
+            items.reverse()
+            stack.extend(items)
+
+    def to_json(self, f=None, positions=False, linecol=False, text=True):
+        return JSONWriter(f, positions, linecol, text).write(self)
+
+    def to_bytes(self, inputs=True):
+        buf = bytearray(MAGIC)
+        TreeEncoder().encode(buf, self, inputs)
+        return bytes(buf)
+
+    @classmethod
+    def from_bytes(cls, data, inputs=None, urn=UNKNOWN_SOURCE):
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('not a binary parse tree')
+        t, _ = TreeDecoder().decode(data, len(MAGIC), inputs, urn)
+        return t
+
+
+# Binary
+
+# A tree record is: flags, [urn, inputs], and then nodes in pre-order.
+# Each node is: tag, spos, epos-spos, #children, #edges, children...,
+# (edge, node)... Integers are varints. Tags and edge labels are interned;
+# a string is written as 0 + length + utf-8 at its first occurrence and
+# then referred to as its index+1. A stream (TreeWriter) shares the table
+# among trees.
+
+MAGIC = b'PTB1'
+HAS_INPUTS = 1
+BYTES_INPUTS = 2
+
+
+def write_varint(buf, n):
+    while n >= 0x80:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def read_varint(data, pos):
+    b = data[pos]
+    pos += 1
+    if b < 0x80:
+        return b, pos
+    n = b & 0x7f
+    shift = 7
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def write_bytes(buf, b):
+    write_varint(buf, len(b))
+    buf += b
+
+
+def read_bytes(data, pos):
+    size, pos = read_varint(data, pos)
+    return data[pos:pos+size], pos + size
+
+
+class TreeEncoder(object):
+    def __init__(self):
+        self.strings = {}
+
+    def string(self, buf, s):
+        if s in self.strings:
+            write_varint(buf, self.strings[s])
+        else:
+            self.strings[s] = len(self.strings) + 1
+            buf.append(0)
+            write_bytes(buf, s.encode('utf-8'))
+
+    def encode(self, buf, t, inputs=True):
+        flags = 0
+        if inputs:
+            flags |= HAS_INPUTS
+            if isinstance(t.inputs_, bytes):
+                flags |= BYTES_INPUTS
+        write_varint(buf, flags)
+        if inputs:
+            write_bytes(buf, t.urn_.encode('utf-8'))
+            write_bytes(buf, t.inputs_ if isinstance(t.inputs_, bytes)
+                        else t.inputs_.encode('utf-8'))
+        strings = self.strings
+        append = buf.append
+        stack = [t]
+        while len(stack) > 0:
+            t = stack.pop()
+            if isinstance(t, str):  # edge label
+                self.string(buf, t)
+                continue
+            edges = [(key, v) for key, v in t.__dict__.items()
+                     if isinstance(v, ParseTree)]
+            tag = t.tag_
+            if tag in strings and strings[tag] < 0x80:
+                append(strings[tag])
+            else:
+                self.string(buf, tag)
+            for n in (t.spos_, t.epos_ - t.spos_, len(t), len(edges)):
+                if n < 0x80:
+                    append(n)
+                else:
+                    write_varint(buf, n)
+            for key, v in reversed(edges):
+                stack.append(v)
+                stack.append(key)
+            for child in reversed(t):
+                if not isinstance(child, ParseTree):
+                    raise TypeError(f'unable to encode {type(child).__name__}')
+                stack.append(child)
+
+
+class TreeDecoder(object):
+    def __init__(self):
+        self.strings = []
+
+    def string(self, data, pos):
+        n, pos = read_varint(data, pos)
+        if n == 0:
+            s, pos = read_bytes(data, pos)
+            s = bytes(s).decode('utf-8')
+            self.strings.append(s)
+            return s, pos
+        return self.strings[n-1], pos
+
+    def decode(self, data, pos, inputs=None, urn=UNKNOWN_SOURCE):
+        flags, pos = read_varint(data, pos)
+        if flags & HAS_INPUTS:
+            s, pos = read_bytes(data, pos)
+            urn = bytes(s).decode('utf-8')
+            s, pos = read_bytes(data, pos)
+            s = bytes(s)
+            if inputs is None:
+                inputs = s if flags & BYTES_INPUTS else s.decode('utf-8')
+        elif inputs is None:
+            raise ValueError('inputs are required to decode this tree')
+        strings = self.strings
+        root = None
+        stack = []  # [tree, #children, #edges]
+        label = None
+        while True:
+            n = data[pos]
+            if 0 < n < 0x80:
+                tag = strings[n-1]
+                pos += 1
+            else:
+                tag, pos = self.string(data, pos)
+            header = []
+            for _ in range(4):
+                n = data[pos]
+                if n < 0x80:
+                    header.append(n)
+                    pos += 1
+                else:
+                    n, pos = read_varint(data, pos)
+                    header.append(n)
+            spos, size, nchild, nedge = header
+            t = ParseTree(tag, inputs, spos, spos + size, urn)
+            if len(stack) == 0:
+                root = t
+            else:
+                top = stack[-1]
+                if top[1] > 0:
+                    top[0].append(t)
+                    top[1] -= 1
+                else:
+                    setattr(top[0], label, t)
+                    top[2] -= 1
+            if nchild > 0 or nedge > 0:
+                stack.append([t, nchild, nedge])
+            while len(stack) > 0 and stack[-1][1] == 0 and stack[-1][2] == 0:
+                stack.pop()
+            if len(stack) == 0:
+                return root, pos
+            if stack[-1][1] == 0:
+                label, pos = self.string(data, pos)
+
+
+class TreeWriter(object):
+    def __init__(self, f, inputs=True):
+        self.f = f
+        self.inputs = inputs
+        self.encoder = TreeEncoder()
+        f.write(MAGIC)
+
+    def write(self, t):
+        buf = bytearray()
+        self.encoder.encode(buf, t, self.inputs)
+        size = bytearray()
+        write_varint(size, len(buf))
+        self.f.write(size)
+        self.f.write(buf)
+
+
+class TreeReader(object):
+    def __init__(self, f, inputs=None, urn=UNKNOWN_SOURCE):
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a binary parse tree stream')
+        self.f = f
+        self.inputs = inputs
+        self.urn = urn
+        self.decoder = TreeDecoder()
+
+    def read(self):
+        n = 0
+        shift = 0
+        while True:
+            b = self.f.read(1)
+            if len(b) == 0:
+                if shift == 0:
+                    return None
+                raise EOFError('truncated tree stream')
+            n |= (b[0] & 0x7f) << shift
+            if b[0] < 0x80:
+                break
+            shift += 7
+        data = self.f.read(n)
+        t, _ = self.decoder.decode(data, 0, self.inputs, self.urn)
+        return t
+
+    def __iter__(self):
+        while True:
+            t = self.read()
+            if t is None:
+                return
+            yield t
+
+
+# TagVisitor dispatches on integer tag ids rather than tag strings;
+# self.<tag>(t) is called, or self.undefined(t) for unknown tags. The table
+# of methods is built once per class, and replaced (not appended to) when
+# new tags have been interned, so that threads can share it.
+
+
+class TagVisitor(object):
+    table = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.table = ()  # one table per class
+
+    @classmethod
+    def dispatch(cls):
+        table = cls.table
+        if len(table) < len(TAGS):  # new tags have been interned since
+            table = tuple(dispatch_table(cls, cls.undefined))
+            cls.table = table
+        return table
+
+    def visit(self, t):
+        table = self.table
+        if t.id_ >= len(table):
+            table = self.dispatch()
+        return table[t.id_](self, t)
+
+    def undefined(self, t):
+        return t
+
+
+# JSON
+
+# {"tag": "Infix", "pos": [0, 5], "line": [1, 0], "children": [
+#   {"edge": "left", "tag": "Int", "text": "1"}, ...]}
+# Unlabeled children come first, and then labeled ones ("edge"), one for
+# each label. A syntax error always has its position and a message:
+# {"tag": "err", "pos": [3, 3], "line": [1, 3], "message": "Syntax Error
+#  (urn:1:3+3)", "expected": [...]} (expected with generate(expected=True)).
+# As a conv, JSONWriter returns the ParseTree of a syntax error, as
+# PTree2Value does, so that write() includes the expected set.
+
+
+class JSONWriter(object):
+    def __init__(self, f=None, positions=False, linecol=False, text=True):
+        self.f = f
+        self.positions = positions
+        self.linecol = linecol
+        self.text = text
+        self.tags = {}
+
+    def __call__(self, pt: PTree, urn, inputs):  # as conv
+        if pt.prev != None:
+            node = ('', '', pt.spos, pt.epos, pt)
+        elif pt.tag == ERR:  # to be written with its expected set
+            return PTree2ParseTree(pt, urn, inputs)
+        else:
+            node = ('', TAGS[pt.tag], pt.spos, pt.epos, pt.child)
+        return self.emit(node, inputs, self.subnodes)
+
+    def write(self, t):
+        if t.isSyntaxError():
+            return self.error(t)
+        return self.emit(('', t), t.inputs_, self.subtrees)
+
+    def error(self, t):
+        inputs, spos = t.inputs_, t.spos_
+        LF = b'\n' if isinstance(inputs, bytes) else '\n'
+        linenum = inputs.count(LF, 0, spos) + 1
+        column = spos - (inputs.rfind(LF, 0, spos) + 1)
+        message = f'Syntax Error ({t.urn_}:{linenum}:{column}+{spos})'
+        s = (f'{{"tag": "err", "pos": [{spos}, {t.epos_}], "line": [{linenum}, {column}], '
+             f'"message": {encode_basestring(message)}')
+        if hasattr(t, 'expected_'):
+            s += ', "expected": [' + ', '.join(map(encode_basestring, t.expected_)) + ']'
+        s += '}'
+        if self.f is None:
+            return s
+        self.f.write(s)
+
+    @classmethod
+    def subnodes(cls, node):
+        edge, tag, spos, epos, subnode = node
+        children = []
+        edges = []
+        while subnode != None:
+            if subnode.isEdge():
+                if subnode.child == None:
+                    sub = ('', subnode.spos, abs(subnode.epos), None)
+                elif subnode.child.prev != None:
+                    pt = subnode.child
+                    sub = ('', pt.spos, pt.epos, pt)
+                else:
+                    pt = subnode.child
+                    sub = (TAGS[pt.tag], pt.spos, pt.epos, pt.child)
+                if subnode.tag == 0:
+                    children.append(('',) + sub)
+                else:
+                    edges.append((TAGS[subnode.tag],) + sub)
             else:
-                sb.append(repr(child))
-        for key in self.__dict__:
-            v = self.__dict__[key]
-            if isinstance(v, ParseTree):
-                hasContent = True
-                sb.append(indent)
-                sb.append(edge(key) + ': ')
-                v.strOut(sb, next_indent, tab, tag, edge, token)
-        if not hasContent:
-            sb.append(' ' + token(repr(str(self))))
-        sb.append("]")
+                children.append(('', TAGS[subnode.tag], subnode.spos,
+                                 abs(subnode.epos), subnode.child))
+            subnode = subnode.prev
+        children.reverse()
+        edges.reverse()
+        if len(edges) > 1:  # the first of the same label wins
+            labels = {}
+            for e in edges:
+                labels.setdefault(e[0], e)
+            edges = list(labels.values())
+        return edge, tag, spos, epos, children + edges
+
+    @classmethod
+    def subtrees(cls, node):
+        edge, t = node
+        edges = [(key, v) for key, v in t.__dict__.items() if isinstance(v, ParseTree)]
+        edges.sort(key=lambda e: e[1].spos_)
+        return edge, t.tag_, t.spos_, t.epos_, [('', child) for child in t] + edges
+
+    def quote(self, tag):
+        if tag not in self.tags:
+            self.tags[tag] = encode_basestring(tag)
+        return self.tags[tag]
+
+    def emit(self, node, inputs, subnodes):
+        lines = None
+        if self.linecol:
+            LF = b'\n' if isinstance(inputs, bytes) else '\n'
+            lines = [0]
+            pos = inputs.find(LF)
+            while pos != -1:
+                lines.append(pos + 1)
+                pos = inputs.find(LF, pos + 1)
+        f = self.f
+        sb = []
+        stack = [node]
+        while len(stack) > 0:
+            node = stack.pop()
+            if isinstance(node, str):
+                sb.append(node)
+                continue
+            edge, tag, spos, epos, children = subnodes(node)
+            if edge != '':
+                sb.append('{"edge": ' + self.quote(edge) + ', "tag": ' + self.quote(tag))
+            else:
+                sb.append('{"tag": ' + self.quote(tag))
+            if self.positions:
+                sb.append(f', "pos": [{spos}, {epos}]')
+            if lines is not None:
+                linenum = bisect_right(lines, spos)
+                sb.append(f', "line": [{linenum}, {spos - lines[linenum-1]}]')
+            if len(children) == 0:
+                if self.text:
+                    s = inputs[spos:epos]
+                    if isinstance(s, bytes):
+                        s = s.decode('utf-8', errors='replace')
+                    sb.append(', "text": ' + encode_basestring(s))
+                sb.append('}')
+            else:
+                sb.append(', "children": [')
+                stack.append(']}')
+                for i in range(len(children)-1, 0, -1):
+                    stack.append(children[i])
+                    stack.append(', ')
+                stack.append(children[0])
+            if f is not None and len(sb) > 4096:
+                f.write(''.join(sb))
+                sb = []
+        if f is None:
+            return ''.join(sb)
+        f.write(''.join(sb))
+
+
+# The conversion below uses an explicit stack instead of recursion, so that
+# deeply nested trees (e.g., long ^{} folds) never hit the recursion limit.
+# The entries of a child chain are linked backwards (prev); they are pushed
+# in that order so that they are popped, and appended, in the forward order.
+# If a node has an edge label more than once, the first subtree (in the
+# inputs) is kept; so do JSONWriter, actions and Transformer, while tuples
+# keep every (edge, child) in order.
 
 
 def PTree2ParseTree(pt: PTree, urn, inputs):
     if pt.prev != None:
-        return PTree2ParseTreeImpl('', urn, inputs, pt.spos, pt.epos, pt)
+        t = ParseTree('', inputs, pt.spos, pt.epos, urn, 0)
+        subnode = pt
     else:
-        return PTree2ParseTreeImpl(pt.tag, urn, inputs, pt.spos, pt.epos, pt.child)
+        t = ParseTree(TAGS[pt.tag], inputs, pt.spos, pt.epos, urn, pt.tag)
+        subnode = pt.child
+    root = t
+    stack = []
+    while True:
+        while subnode != None:
+            stack.append((t, subnode))
+            subnode = subnode.prev
+        if len(stack) == 0:
+            return root
+        parent, subnode = stack.pop()
+        edge = 0
+        if subnode.isEdge():
+            edge = subnode.tag
+            pt = subnode.child
+            if pt == None:
+                t = ParseTree('', inputs, subnode.spos, abs(subnode.epos), urn, 0)
+                subnode = None
+            elif pt.prev != None:
+                t = ParseTree('', inputs, pt.spos, pt.epos, urn, 0)
+                subnode = pt
+            else:
+                t = ParseTree(TAGS[pt.tag], inputs, pt.spos, pt.epos, urn, pt.tag)
+                subnode = pt.child
+        else:
+            tag = subnode.tag
+            t = ParseTree(TAGS[tag], inputs, subnode.spos, abs(subnode.epos), urn, tag)
+            subnode = subnode.child
+        if edge == 0:
+            parent.append(t)
+        elif TAGS[edge] not in parent.__dict__:  # the first one wins
+            setattr(parent, TAGS[edge], t)
+
+
+# A compact form of parse trees: (tag, spos, epos, ((edge, child), ...))
+# It holds no reference to the inputs, so it is cheap to pickle.
 
 
-def PTree2ParseTreeImpl(tag, urn, inputs, spos, epos, subnode):
-    t = ParseTree(tag, inputs, spos, epos, urn)
-    while subnode != None:
+def PTree2Tuple(pt: PTree, urn, inputs):
+    if pt.prev != None:
+        frame = ['', '', pt.spos, pt.epos, pt, []]
+    else:
+        frame = ['', TAGS[pt.tag], pt.spos, pt.epos, pt.child, []]
+    stack = []
+    while True:
+        edge, tag, spos, epos, subnode, children = frame
+        if subnode == None:  # all children are done
+            children.reverse()
+            tt = (tag, spos, epos, tuple(children))
+            if len(stack) == 0:
+                return tt
+            frame = stack.pop()
+            frame[5].append((edge, tt))
+            continue
+        frame[4] = subnode.prev
+        stack.append(frame)
         if subnode.isEdge():
-            if subnode.child == None:
-                tt = PTree2ParseTreeImpl(
-                    '', urn, inputs, subnode.spos, abs(subnode.epos), None)
-            else:
-                tt = PTree2ParseTree(subnode.child, urn, inputs)
-            if subnode.tag == '':
-                t.append(tt)
+            edge = TAGS[subnode.tag]
+            pt = subnode.child
+            if pt == None:
+                frame = [edge, '', subnode.spos, abs(subnode.epos), None, []]
+            elif pt.prev != None:
+                frame = [edge, '', pt.spos, pt.epos, pt, []]
             else:
-                setattr(t, subnode.tag, tt)
+                frame = [edge, TAGS[pt.tag], pt.spos, pt.epos, pt.child, []]
         else:
-            t.append(PTree2ParseTreeImpl(subnode.tag, urn, inputs,
-                                         subnode.spos, abs(subnode.epos), subnode.child))
-        subnode = subnode.prev
-    for i in range(len(t)//2):
-        t[i], t[-(1+i)] = t[-(1+i)], t[i]
-    return t
+            frame = ['', TAGS[subnode.tag], subnode.spos, abs(subnode.epos), subnode.child, []]
 
 
-def generate(pf):
+def generate(pf, symbols=None, conv=PTree2ParseTree, fast=None):
     # pf = self.generated[start.uname()]
-    def parse(inputs, urn='(unknown source)', pos=0, epos=None, conv=PTree2ParseTree):
+    # fast is the same parser built on the untracked variants, if any
+    # The parser is reentrant and can be called from many threads at once:
+    # each call parses on a context of its own, and combinators keep no
+    # state of their own.
+    pool = []
+
+    def run(px, inputs, urn, pos, epos, conv):
+        if fast is None or not fast(px):
+            if fast is not None:  # again, for the error position
+                px.reset(inputs, pos, epos, urn)
+            if not pf(px):
+                result = PTree(None, ERR, px.headpos, px.headpos, None)
+                t = conv(result, urn, inputs)
+                if symbols is not None and isinstance(t, ParseTree):
+                    t.expected_ = expected_names(px.expected, symbols)
+                return t
+        result = px.ast if px.ast is not None else PTree(None,
+                                                         0, pos, px.pos, None)
+        return conv(result, urn, inputs)
+
+    def parse(inputs, urn='(unknown source)', pos=0, epos=None, conv=conv):
         if epos is None:
             epos = len(inputs)
-        px = PContext(inputs, pos, epos)
-        if not pf(px):
-            result = PTree(None, "err", px.headpos, px.headpos, None)
-        else:
-            result = px.ast if px.ast is not None else PTree(None,
-                                                             "", pos, px.pos, None)
-        return conv(result, urn, inputs)
+        px = acquire(pool, inputs, pos, epos, urn)
+        t = run(px, inputs, urn, pos, epos, conv)
+        release(pool, px)
+        return t
+
+    def parse_many(docs, urn='(unknown source)', conv=conv):
+        '''
+        yields the parse trees of docs (an iterable of inputs), all parsed
+        on one context
+        '''
+        px = None
+        for inputs in docs:
+            if px is None:
+                px = acquire(pool, inputs, 0, len(inputs), urn)
+            else:
+                px.reset(inputs, 0, len(inputs), urn)
+            yield run(px, inputs, urn, 0, len(inputs), conv)
+        if px is not None:
+            release(pool, px)
+    parse.parse_many = parse_many
     return parse
 
 
+# ok, the end of the match (the error position if not ok), and the farthest
+# position reached by any failed attempt
+Recognition = namedtuple('Recognition', 'ok epos headpos')
+
+
+def recognizer(pf):
+    pool = []
+
+    def run(px, inputs):
+        if pf(px):
+            return Recognition(True, px.pos, px.headpos)
+        return Recognition(False, px.headpos, px.headpos)
+
+    def recognize(inputs, urn='(unknown source)', pos=0, epos=None):
+        if epos is None:
+            epos = len(inputs)
+        px = acquire(pool, inputs, pos, epos, urn)
+        r = run(px, inputs)
+        release(pool, px)
+        return r
+
+    def parse_many(docs, urn='(unknown source)'):
+        px = None
+        for inputs in docs:
+            if px is None:
+                px = acquire(pool, inputs, 0, len(inputs), urn)
+            else:
+                px.reset(inputs, 0, len(inputs), urn)
+            yield run(px, inputs)
+        if px is not None:
+            release(pool, px)
+    recognize.parse_many = parse_many
+    return recognize
+
+
+# Streaming records
+# The start rule is matched repeatedly against a buffer filled from a
+# stream of chunks. A record is taken only when neither its match nor its
+# farthest lookahead came within lookahead characters of the buffer end;
+# otherwise the next chunk is appended and the record is parsed again.
+
+
+def generate_stream(pf, conv=PTree2ParseTree, lookahead=64):
+    def parse_stream(chunks, urn='(unknown source)', conv=conv):
+        '''
+        yields (offset, record) for each record in chunks (an iterable of
+        str or bytes), where offset is the position of record's inputs
+        in the stream
+        '''
+        chunks = iter(chunks)
+        inputs, offset, pos, eof = None, 0, 0, False
+        px = None
+        while True:
+            if px is None:
+                # reads at least as much as is left, so that a long record
+                # is copied and parsed again only O(log n) times
+                parts = [] if inputs is None else [inputs[pos:]]
+                need, size = max(len(parts[0]) if parts else 0, 1), 0
+                while size < need:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        eof = True
+                        break
+                    parts.append(chunk)
+                    size += len(chunk)
+                if len(parts) == 0:
+                    return
+                if size > 0:
+                    inputs = parts[0][:0].join(parts)
+                    offset += pos
+                    pos = 0
+                px = PContext(inputs, pos, len(inputs), urn)
+            if eof and pos >= len(inputs):
+                return
+            px.pos = pos
+            px.headpos = pos
+            px.ast = None
+            px.state = None
+            ok = pf(px)
+            # more inputs can change the result only within the lookahead
+            if not eof and max(px.pos, px.headpos) + lookahead >= len(inputs):
+                px = None  # needs more inputs
+                continue
+            if not ok or px.pos == pos:
+                yield offset, conv(PTree(None, ERR, px.headpos, px.headpos, None), urn, inputs)
+                return
+            result = px.ast if px.ast is not None else PTree(None, 0, pos, px.pos, None)
+            pos = px.pos
+            yield offset, conv(result, urn, inputs)
+    return parse_stream
+
+
 # TPEG
+
+# Compiled combinators
+# _pasm.pyx has typed versions of the hot combinators and PContext above;
+# when it is built, they replace the pure Python ones here.
+
+COMPILED = False
+if os.environ.get('PEGTREE_PURE', '') == '':
+    try:
+        from pegtree._pasm import *
+        COMPILED = True
+    except ImportError:
+        pass
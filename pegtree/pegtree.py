@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 import sys
 import os
+import re
 import errno
 import inspect
+import itertools
+import threading
+import weakref
 from pathlib import Path
 import pegtree.pasm as pasm
 from pegtree.tpeg import TPEGGrammar
@@ -216,6 +220,13 @@ def appendChoice(choices, pe):
         DEBUG('IGNORED', pe)
 
 
+def prefixLen(s, s2):
+    n = 0
+    while n < len(s) and n < len(s2) and s[n] == s2[n]:
+        n += 1
+    return n
+
+
 def optimizedChoice(choices, pe):
     start = pe
     while isinstance(pe, PRef):
@@ -353,6 +364,9 @@ EMPTY = PChar('')
 ANY = PAny()
 FAIL = PNot(EMPTY)
 
+# unary expressions that make no trees
+PURE_UNARY = (PAnd, PNot, PMany, PMany1, POption)
+
 '''
 def pEmpty(): return EMPTY
 
@@ -432,13 +446,20 @@ def ss(e):
 
 GrammarId = 0
 
+# Grammars are loaded, generated and lazily compiled by one thread at a
+# time; generated parsers can be called from many threads at once.
+GrammarLock = threading.RLock()
+
 
 class Grammar(dict):
     def __init__(self, source=None):
         global GrammarId
-        self.ns = str(GrammarId)
+        with GrammarLock:
+            self.ns = str(GrammarId)
+            GrammarId += 1
         self.N = []
-        GrammarId += 1
+        self.generators = {}  # {generator options: Generator}
+        self.parsers = {}  # {(start, options): parser}, by generate()
         super().__setitem__('@@example', [])
 
     def __repr__(self):
@@ -471,6 +492,30 @@ class Grammar(dict):
             self['EMPTY'] = EMPTY
         return self.N[0]
 
+    def tags(self):
+        '''
+        the symbol table of tags and edge labels, {name: tag id}
+        '''
+        names = {}
+        visited = set()
+        stack = [self[name] for name in self.N if name in self]
+        while len(stack) > 0:
+            pe = stack.pop()
+            if isinstance(pe, PRef):
+                key = pe.uname()
+                if key not in visited and pe.name in pe.peg:
+                    visited.add(key)
+                    stack.append(pe.deref())
+                continue
+            if isinstance(pe, PNode) or isinstance(pe, PFold):
+                names[pe.tag] = pasm.tag_id(pe.tag)
+            if isinstance(pe, PEdge) or isinstance(pe, PFold):
+                names[pe.edge] = pasm.tag_id(pe.edge)
+            if isinstance(pe, PExpr) and len(pe) > 0:
+                stack.extend(pe)
+        names.pop('', None)
+        return dict(sorted(names.items(), key=lambda x: x[1]))
+
 
 # def pRule(peg, name, pf):
 #     peg[name] = pf
@@ -577,6 +622,94 @@ class Optimizer(object):
     def join(self, *es):
         return PSeq.new(*es)
 
+    def seq(self, *es):  # flattening sequences
+        ls = []
+        for e in es:
+            ls.extend(e if isinstance(e, PSeq) else [e])
+        return PSeq.new(*ls)
+
+    # left factoring
+    # A B / A C => A (B / C), if A has no side effects. Since A matches the
+    # same way each time, the ordered choice is kept. Splitting a common
+    # string prefix ('ab' / 'ac' => 'a' ('b' / 'c')) moves the farthest
+    # failure (px.headpos) past 'a', so it is done only when untracked.
+
+    def factor(self, pe: POre):
+        groups = []  # [(head, [tail, ...]), ...]
+        for e in pe:
+            es = list(e) if isinstance(e, PSeq) else [e]
+            head, tail = es[0], PSeq.new(*es[1:])
+            if len(groups) > 0:
+                head2, tails = groups[-1]
+                if isinstance(head, PChar) and isinstance(head2, PChar) and not self.tracking:
+                    n = prefixLen(head.text, head2.text)
+                    if n > 0:
+                        if n < len(head2.text):
+                            rest = PChar(head2.text[n:])
+                            tails = [self.seq(rest, t) for t in tails]
+                        if n < len(head.text):  # no '' left to factor again
+                            tail = self.seq(PChar(head.text[n:]), tail)
+                        tails.append(tail)
+                        groups[-1] = (PChar(head.text[:n]), tails)
+                        continue
+                if self.same(head, head2) and self.isPure(head):
+                    tails.append(tail)
+                    continue
+            groups.append((head, [tail]))
+        if len(groups) == len(pe):
+            return pe
+        choices = []
+        for head, tails in groups:
+            if len(tails) == 1:
+                choices.append(self.seq(head, tails[0]))
+                continue
+            counts = self.factorings[self.tracking]
+            counts[self.generating_rule] = counts.get(self.generating_rule, 0) + 1
+            tail = POre.new(*tails)
+            if isinstance(tail, POre):
+                tail = self.factor(tail)
+            choices.append(self.seq(head, tail))
+        return POre.new(*choices)
+
+    def same(self, pe, pe2):
+        if pe.__class__ is not pe2.__class__:
+            return False
+        if isinstance(pe, PChar):
+            return pe.text == pe2.text
+        if isinstance(pe, PRange):
+            return pe.chars == pe2.chars and pe.ranges == pe2.ranges
+        if isinstance(pe, PRef):
+            return pe.uname() == pe2.uname()
+        if isinstance(pe, PTuple):
+            return len(pe) == len(pe2) and all(self.same(e, e2) for e, e2 in zip(pe, pe2))
+        if isinstance(pe, PAny):
+            return True
+        if isinstance(pe, PUnary) and pe.__class__ in PURE_UNARY:
+            return self.same(pe.e, pe2.e)
+        return False
+
+    def isPure(self, pe, visited=()):
+        '''
+        True if pe neither makes trees nor touches states
+        '''
+        if isinstance(pe, PChar) or isinstance(pe, PRange) or isinstance(pe, PAny):
+            return True
+        if isinstance(pe, PRef):
+            uname = pe.uname()
+            if uname in visited:
+                return True
+            if uname in self.pures:
+                return self.pures[uname]
+            res = self.isPure(pe.deref(), visited + (uname,))
+            if len(visited) == 0:  # assumed pure on the way
+                self.pures[uname] = res
+            return res
+        if isinstance(pe, PTuple):
+            return all(self.isPure(e, visited) for e in pe)
+        if pe.__class__ in PURE_UNARY:
+            return self.isPure(pe.e, visited)
+        return False
+
     def fixedExpr(self, e):
         es = [e]
         fixed = []
@@ -588,7 +721,7 @@ class Optimizer(object):
             if e is None:
                 break
             fixed.append(e)
-            size += lsize
+            size = lsize  # fixedEach adds up the sizes
         return size, fixed, es
 
     def fixedEach(self, size, es):
@@ -620,95 +753,249 @@ class Optimizer(object):
             return size+lsize, PSeq.new(*lfixed), [PFold(e.edge, PSeq.new(*les), e.tag, -lsize)]+es[1:]
         return size, None, es
 
-    def sort(self, refs):
-        newrefs = []
-        unsolved = []
-        for ref in refs:
-            names = set([])
-            self.makerefs(ref.deref(), names)
-            if len(names) == 0:
-                newrefs.append(ref)
-            else:
-                unsolved.append((ref, set(names)))
-        return self.solve(newrefs, unsolved)
-
-    def makerefs(self, e, names):
+    # first characters (for choice dispatch)
+
+    def first(self, pe, visited=()):
+        '''
+        the set of characters that a non-empty match of pe starts with,
+        or None if unknown (or pe can match the empty string)
+        '''
+        if isinstance(pe, PChar):
+            return frozenset(pe.text[0]) if len(pe.text) > 0 else None
+        if isinstance(pe, PRange):
+            cs = set(pe.chars)
+            r = pe.ranges
+            while len(r) > 1:
+                if ord(r[1]) - ord(r[0]) > 256:
+                    return None
+                cs.update(chr(c) for c in range(ord(r[0]), ord(r[1])+1))
+                r = r[2:]
+            return frozenset(cs)
+        if isinstance(pe, PRef):
+            uname = pe.uname()
+            if uname in visited:  # left recursion
+                return None
+            if uname not in self.firsts:  # the same from any visited
+                self.firsts[uname] = self.first(pe.deref(), visited + (uname,))
+            return self.firsts[uname]
+        if isinstance(pe, PSeq):
+            cs = frozenset()
+            for e in pe:
+                if isinstance(e, PAnd) or isinstance(e, PNot):
+                    continue
+                fs = self.first(e, visited)
+                if fs is None:
+                    return None
+                cs |= fs
+                if e.minLen() > 0:
+                    return cs
+            return None
+        if isinstance(pe, POre):
+            cs = frozenset()
+            for e in pe:
+                fs = self.first(e, visited)
+                if fs is None:
+                    return None
+                cs |= fs
+            return cs
+        if isinstance(pe, PMany1) or isinstance(pe, PNode) or isinstance(pe, PEdge) \
+                or isinstance(pe, PFold) or isinstance(pe, PAbs):
+            return self.first(pe.e, visited)
+        return None
+
+    # lexical expressions (into possessive regular expressions)
+
+    def lexical(self, pe, visited=()):
+        '''
+        a regex that matches exactly as pe does, or None if pe makes trees
+        or is not lexical
+        '''
+        if sys.version_info < (3, 11):  # no atomic groups/possessive quantifiers
+            return None
+        if isinstance(pe, PChar):
+            return re.escape(pe.text)
+        if isinstance(pe, PRange):
+            sb = ['[']
+            sb.extend(re.escape(c) for c in pe.chars)
+            r = pe.ranges
+            while len(r) > 1:
+                sb.append(re.escape(r[0]) + '-' + re.escape(r[1]))
+                r = r[2:]
+            sb.append(']')
+            return ''.join(sb) if len(sb) > 2 else '(?!)'
+        if isinstance(pe, PAny):
+            return '.'
+        if isinstance(pe, PRef):
+            uname = pe.uname()
+            if uname in visited:
+                return None
+            if uname not in self.lexicals:  # the same from any visited
+                self.lexicals[uname] = self.lexical(pe.deref(), visited + (uname,))
+            return self.lexicals[uname]
+        if isinstance(pe, PSeq) or isinstance(pe, POre):
+            res = [self.lexical(e, visited) for e in pe]
+            if None in res:
+                return None
+            if isinstance(pe, PSeq):
+                return ''.join(f'(?:{r})' for r in res)
+            return '(?>' + '|'.join(res) + ')'
+        ops = [(PMany, '(?:{})*+'), (PMany1, '(?:{})++'), (POption, '(?:{})?+'),
+               (PAnd, '(?={})'), (PNot, '(?!{})')]
+        for cls, fmt in ops:
+            if pe.__class__ is cls:
+                r = self.lexical(pe.e, visited)
+                return fmt.format(r) if r is not None else None
+        return None
+
+    # dependency graph
+    # Rules are ordered by the strongly connected components of their
+    # references (Tarjan's algorithm), each component after the ones it
+    # refers to.
+
+    def refs(self, ref):
+        uname = ref.uname()
+        if uname not in self.deps:
+            refs = {}
+            self.makerefs(ref.deref(), refs)
+            self.deps[uname] = list(refs.values())
+        return self.deps[uname]
+
+    def makerefs(self, e, refs):
         if isinstance(e, PTuple):
             for e2 in e:
-                self.makerefs(e2, names)
+                self.makerefs(e2, refs)
         elif hasattr(e, 'e'):
-            self.makerefs(e.e, names)
+            self.makerefs(e.e, refs)
         elif isinstance(e, PRef):
-            names.add(e.uname())
-
-    def removeSolvedName(self, unsolved, uname):
-        removed = False
-        for _, names in unsolved:
-            if uname in names:
-                removed = True
-                names.remove(uname)
-        return removed
-
-    def solve(self, refs, unsolved):
-        removed = False
-        # print(refs)
-        for ref in refs:
-            removed |= self.removeSolvedName(unsolved, ref.uname())
-        max = 0
-        while max < 10:
-            removed = True
-            while removed:
-                removed = False
-                newrefs = []
-                stillUnsolved = []
-                for ref, names in unsolved:
-                    if len(names) <= max:
-                        refs.append(ref)
-                        newrefs.append(ref)
-                    else:
-                        stillUnsolved.append((ref, names))
-                unsolved = stillUnsolved
-                #print(max, newrefs)
-                for ref in newrefs:
-                    removed |= self.removeSolvedName(unsolved, ref.uname())
-                if removed:
-                    max = 0
-            max += 1
-        for ref, _ in unsolved:
-            refs.append(ref)
-        return refs
+            refs.setdefault(e.uname(), e)
+
+    def components(self, start):
+        '''
+        the strongly connected components of the rules reachable from start,
+        callees first
+        '''
+        index = {start.uname(): 0}
+        low = {start.uname(): 0}
+        stack = [start]
+        onstack = {start.uname()}
+        work = [(start, iter(self.refs(start)))]
+        comps = []
+        while len(work) > 0:
+            ref, refs = work[-1]
+            uname = ref.uname()
+            for ref2 in refs:
+                u2 = ref2.uname()
+                if u2 not in index:
+                    index[u2] = low[u2] = len(index)
+                    stack.append(ref2)
+                    onstack.add(u2)
+                    work.append((ref2, iter(self.refs(ref2))))
+                    break
+                if u2 in onstack:
+                    low[uname] = min(low[uname], index[u2])
+            else:
+                work.pop()
+                if len(work) > 0:
+                    u = work[-1][0].uname()
+                    low[u] = min(low[u], low[uname])
+                if low[uname] == index[uname]:
+                    comp = []
+                    while len(comp) == 0 or comp[-1] is not ref:
+                        comp.append(stack.pop())
+                        onstack.discard(comp[-1].uname())
+                    recursive = len(comp) > 1 or any(r.uname() == uname for r in self.refs(ref))
+                    for r in comp:
+                        self.recursives[r.uname()] = recursive
+                    comps.append(comp)
+        return comps
+
+    def isRecursive(self, ref):
+        if ref.uname() not in self.recursives:
+            self.components(ref)
+        return self.recursives[ref.uname()]
+
+
+# rules up to this many expressions are inlined into sequences and choices
+INLINE_SIZE = 12
+
+# Hash-consing
+# Structurally identical subexpressions, in any rule of any grammar,
+# compile to one shared combinator. Combinators are held weakly, so they
+# go away with the last parser using them.
+
+Combinators = weakref.WeakValueDictionary()
+CombinatorStats = {'hits': 0, 'misses': 0}
+GeneratorIds = itertools.count()
+
+
+def combinator_stats():
+    return dict(CombinatorStats, size=len(Combinators))
 
 
 class Generator(Optimizer):
-    def __init__(self):
+    @classmethod
+    def __init_subclass__(cls, **kwargs):  # overriding emitters
+        super().__init_subclass__(**kwargs)
+        cls.emitters = emitterTable(cls)
+
+    def __init__(self, expected=False, actions=None, trees=True, lazy=False):
         self.peg = None
         self.generated = {}
+        self.untracked = {}  # generated with tracking=False
         self.generating_nonterminal = ''
+        self.generating_rule = ''
         self.sids = {}
         self.memos = []
         self.Ooox = True
         self.Olex = True
+        self.Odispatch = True
+        self.Oinline = True
+        self.inlinables = {}
+        self.Ofactor = True
+        self.Ocons = True
+        self.gid = next(GeneratorIds)  # rules are generated per generator
+        self.keys = {}  # {id(pe): (pe, structural key)}
+        # {rule name: the number of choices factored}, in the pass that the
+        # last parser generated matches with, of the counts by tracking
+        self.factored = {}
+        self.factorings = {True: {}, False: {}}
+        # analyses memoized by rule
+        self.pures = {}
+        self.firsts = {}
+        self.lexicals = {}
+        self.deps = {}  # {uname: [PRef, ...]}
+        self.recursives = {}
+        # expected-set tracking ((terminal, rule) indexed by bit)
+        self.symbols = [] if expected else None
+        # semantic actions ({tag: f(inputs, spos, epos, children, edges)})
+        self.actions = actions
+        # trees=False compiles a recognizer without tree construction
+        self.trees = trees
+        # tracking=False leaves px.headpos alone (the fast pass of parsing)
+        self.tracking = True
+        self.skips = False
+        # lazy=True compiles each rule when it is first matched, except with
+        # expected sets, whose bits are numbered in the order of compilation
+        self.lazy = lazy and not expected
+        self.pending = {}  # {(tracking, uname): compile} of the lazy stubs
 
     def getsid(self, name):
         if not name in self.sids:
             self.sids[name] = len(self.sids)
         return self.sids[name]
 
-    def makelist(self, pe, v: dict, ps: list):
-        if isinstance(pe, PRef):
-            u = pe.uname()
-            if u not in self.generated and u not in v:
-                v[u] = pe
-                self.makelist(pe.deref(), v, ps)
-                ps.append(pe)
-            return ps
-        if isinstance(pe, PUnary) or isinstance(pe, PTuple):
-            for e in pe:
-                self.makelist(e, v, ps)
-        return ps
+    def getbit(self, pe):
+        key = (repr(pe), self.generating_rule)
+        if key not in self.symbols:
+            self.symbols.append(key)
+        # index() keeps the bit a Python int where Cython compiles this
+        # module; 1 << (len(self.symbols) - 1) is a C shift there, which
+        # overflows past 31 symbols
+        return 1 << self.symbols.index(key)
 
     def generate(self, peg, **option):
         self.peg = peg
+        self.keys = {}
         name = option.get('start', peg.start())
         start = peg.newRef(name)
         # if 'memos' in option and not isinstance(option['memos'], list):
@@ -719,15 +1006,46 @@ class Generator(Optimizer):
             else:
                 self.memos = peg.N
             # print(self.memos)
-        ps = self.makelist(start, {}, [])
-        ps = self.sort(ps)
+        self.skips = self.reachesSkip(start, set())
+        self.emitRules(self.rulesToEmit(start), start)
+
+        if option.get('stream', False):
+            return self.compiles(self.emitStream(start), start)
+        fast = None
+        # two-phase parsing; the compiled combinators track headpos for free
+        if option.get('twophase', not pasm.COMPILED) and self.trees \
+                and self.symbols is None and not self.skips:
+            fast = self.emitUntracked(start)
+        self.factored = self.factorings[fast is None]
+        return self.compiles(self.emitParser(start, fast), start)
+
+    def rulesToEmit(self, start):
+        if self.lazy:  # the rules referred to are compiled on demand
+            return [start] if start.uname() not in self.generated else []
+        return [ref for comp in self.components(start) for ref in comp
+                if ref.uname() not in self.generated]
+
+    def emitRules(self, ps, start):
         for ref in ps:
             assert isinstance(ref, PRef)
             self.generating_nonterminal = ref.uname()
+            self.generating_rule = ref.name
             self.emitRule(ref)
             self.generating_nonterminal = ''
-
-        return self.emitParser(start)
+        # a start rule such as A = B is a reference itself
+        uname = start.uname()
+        self.generated[uname] = pasm.link(self.generated[uname], self.generated)
+
+    def emitUntracked(self, start):
+        generated = self.generated
+        self.generated = self.untracked
+        self.tracking = False
+        try:
+            self.emitRules(self.rulesToEmit(start), start)
+            return self.generated[start.uname()]
+        finally:
+            self.generated = generated
+            self.tracking = True
 
     def emitRule(self, ref):
         A = self.emit(ref.deref(), 0)
@@ -735,28 +1053,85 @@ class Generator(Optimizer):
             idx = self.memos.index(ref.name)
             if idx != -1:
                 A = pasm.pMemo(A, idx, len(self.memos))
-                # A = pasm.pMemoDebug(ref.name, A, idx, self.memos)
+                # A = pasm.pMemoDebug(A, idx, len(self.memos))  # px.stats[idx]
         self.generated[ref.uname()] = A
 
-    def emitParser(self, start):
-        return pasm.generate(self.generated[start.uname()])
+    def emitParser(self, start, fast=None):
+        if not self.trees:
+            return pasm.recognizer(self.generated[start.uname()])
+        if self.actions is not None:
+            return pasm.generate(self.generated[start.uname()], self.symbols,
+                                 pasm.PTree2Value(self.actions), fast)
+        return pasm.generate(self.generated[start.uname()], self.symbols, fast=fast)
+
+    def emitStream(self, start):
+        if self.actions is not None:
+            return pasm.generate_stream(self.generated[start.uname()],
+                                        pasm.PTree2Value(self.actions))
+        return pasm.generate_stream(self.generated[start.uname()])
 
     def emit(self, pe: PExpr, step: int):
         pe = self.inline(pe)
-        cname = pe.cname()
-        if hasattr(self, cname):
-            f = getattr(self, cname)
-            return f(pe, step)
-        print('@TODO(Generator)', cname, pe)
+        key = self.consKey(pe) if self.Ocons and self.symbols is None else None
+        if key is not None:
+            pf = Combinators.get(key)
+            if pf is not None:
+                CombinatorStats['hits'] += 1
+                return pf
+        f = self.emitters.get(pe.cname())
+        if f is not None:
+            pf = f(self, pe, step)
+            if key is not None:
+                CombinatorStats['misses'] += 1
+                try:
+                    Combinators[key] = pf
+                except TypeError:  # not weakly referable
+                    pass
+            return pf
+        print('@TODO(Generator)', pe.cname(), pe)
         return self.PChar(EMPTY, step)
 
+    def consKey(self, pe):
+        if id(pe) not in self.keys:
+            self.keys[id(pe)] = (pe, self.structure(pe))  # pe keeps its id
+        s = self.keys[id(pe)][1]
+        if s is None:
+            return None
+        return (s, self.trees, self.tracking, self.Olex, self.Odispatch, self.Oinline,
+                self.Ofactor, self.Ooox, id(self.actions) if self.actions is not None else None)
+
+    def structure(self, pe):
+        if isinstance(pe, PChar):
+            return ('', pe.text)
+        if isinstance(pe, PRange):
+            return ('[', pe.chars, pe.ranges)
+        if isinstance(pe, PAny):
+            return ('.',)
+        if isinstance(pe, PRef):
+            return ('=', self.gid, pe.uname())
+        if isinstance(pe, PAction):
+            return None  # states are numbered per generator
+        if isinstance(pe, PTuple) or isinstance(pe, PUnary):
+            es = tuple(self.structure(e) for e in pe)
+            if None in es:
+                return None
+            fields = tuple(getattr(pe, f) for f in ('edge', 'tag', 'shift') if hasattr(pe, f))
+            return (pe.cname(), fields, es)
+        return None
+
     def PAny(self, pe, step):
+        if self.symbols is not None:
+            return pasm.pExpectAny(self.getbit(pe))
         return pasm.pAny()
 
     def PChar(self, pe, step):
+        if self.symbols is not None and len(pe.text) > 0:
+            return pasm.pExpectChar(pe.text, self.getbit(pe))
         return pasm.pChar(pe.text)
 
     def PRange(self, pe, step):
+        if self.symbols is not None:
+            return pasm.pExpectRange(pe.chars, pe.ranges, self.getbit(pe))
         return pasm.pRange(pe.chars, pe.ranges)
 
     def PAnd(self, pe, step):
@@ -765,6 +1140,8 @@ class Generator(Optimizer):
             return pasm.pAndChar(e.text)
         if(self.Olex and isinstance(e, PRange)):
             return pasm.pAndRange(e.chars, e.ranges)
+        if not self.tracking:
+            return pasm.pFastAnd(self.emit(e, step))
         return pasm.pAnd(self.emit(e, step))
 
     def PNot(self, pe, step):
@@ -773,6 +1150,10 @@ class Generator(Optimizer):
             return pasm.pNotChar(e.text)
         if(self.Olex and isinstance(e, PRange)):
             return pasm.pNotRange(e.chars, e.ranges)
+        if not self.trees:
+            return pasm.pRecogNot(self.emit(e, step))
+        if not self.tracking:
+            return pasm.pFastNot(self.emit(e, step))
         return pasm.pNot(self.emit(e, step))
 
     def PMany(self, pe, step):
@@ -781,14 +1162,32 @@ class Generator(Optimizer):
             return pasm.pManyChar(e.text)
         if(self.Olex and isinstance(e, PRange)):
             return pasm.pManyRange(e.chars, e.ranges)
+        # a regex cannot report how far it looked (px.headpos), so only the
+        # untracked fast pass runs lexical repetitions as regexes
+        if(self.Olex and not self.tracking and self.symbols is None):
+            r = self.lexical(e)
+            if r is not None:
+                return pasm.pRegex(f'(?:{r})*+')
+        if not self.trees:
+            return pasm.pRecogMany(self.emit(e, step))
+        if not self.tracking:
+            return pasm.pFastMany(self.emit(e, step))
         return pasm.pMany(self.emit(e, step))
 
     def PMany1(self, pe, step):
         e = self.inline(pe.e)
+        if self.symbols is not None and isinstance(e, PChar):
+            return pasm.pExpectMany1Char(e.text, self.getbit(e))
+        if self.symbols is not None and isinstance(e, PRange):
+            return pasm.pExpectMany1Range(e.chars, e.ranges, self.getbit(e))
         if(self.Olex and isinstance(e, PChar)):
             return pasm.pMany1Char(e.text)
         if(self.Olex and isinstance(e, PRange)):
             return pasm.pMany1Range(e.chars, e.ranges)
+        if not self.trees:
+            return pasm.pRecogMany1(self.emit(e, step))
+        if not self.tracking:
+            return pasm.pFastMany1(self.emit(e, step))
         return pasm.pMany1(self.emit(e, step))
 
     def POption(self, pe, step):
@@ -797,9 +1196,17 @@ class Generator(Optimizer):
             return pasm.pOptionChar(e.text)
         if(self.Olex and isinstance(e, PRange)):
             return pasm.pOptionRange(e.chars, e.ranges)
+        if not self.trees:
+            return pasm.pRecogOption(self.emit(e, step))
+        if not self.tracking:
+            return pasm.pFastOption(self.emit(e, step))
         return pasm.pOption(self.emit(e, step))
 
     def PSeq(self, pe, step):
+        if self.Oinline and self.symbols is None:
+            pe = self.expand(pe)
+            if not isinstance(pe, PSeq):
+                return self.emit(pe, step)
         pfs = []
         for e in pe:
             pfs.append(self.emit(e, step))
@@ -807,17 +1214,52 @@ class Generator(Optimizer):
         pfs = tuple(pfs)
         if len(pfs) == 2:
             return pasm.pSeq2(pfs[0], pfs[1])
-        if len(pe) == 3:
+        if len(pfs) == 3:
             return pasm.pSeq3(pfs[0], pfs[1], pfs[2])
-        if len(pe) == 4:
+        if len(pfs) == 4:
             return pasm.pSeq4(pfs[0], pfs[1], pfs[2], pfs[3])
         return pasm.pSeq(*pfs)
 
     # Ore
     def POre(self, pe: POre, step):
+        if self.Oinline and self.symbols is None:
+            pe = self.expand(pe)
+            if not isinstance(pe, POre):
+                return self.emit(pe, step)
+        if self.Ofactor and self.symbols is None and not pe.isDict():
+            pe = self.factor(pe)
+            if not isinstance(pe, POre):
+                return self.emit(pe, step)
         if pe.isDict():
-            return pasm.pDict(pe.listDict())
+            words = pe.listDict()
+            if len(words) < len(pe):  # '' matches if no word does
+                if len(words) == 0:
+                    return self.emit(EMPTY, step)
+                return self.emit(POption(POre.new(*map(PChar, words))), step)
+            if self.symbols is not None:
+                return pasm.pExpectDict(words, self.getbit(pe))
+            return pasm.pDict(words)
         pfs = tuple(map(lambda e: self.emit(e, step), pe))
+        if self.Odispatch and self.symbols is None:
+            pf = self.dispatch(pe, pfs)
+            if pf is not None:
+                return pf
+        if not self.trees:
+            if len(pfs) == 2:
+                return pasm.pRecogOre2(pfs[0], pfs[1])
+            if len(pe) == 3:
+                return pasm.pRecogOre3(pfs[0], pfs[1], pfs[2])
+            if len(pe) == 4:
+                return pasm.pRecogOre4(pfs[0], pfs[1], pfs[2], pfs[3])
+            return pasm.pRecogOre(*pfs)
+        if not self.tracking:
+            if len(pfs) == 2:
+                return pasm.pFastOre2(pfs[0], pfs[1])
+            if len(pe) == 3:
+                return pasm.pFastOre3(pfs[0], pfs[1], pfs[2])
+            if len(pe) == 4:
+                return pasm.pFastOre4(pfs[0], pfs[1], pfs[2], pfs[3])
+            return pasm.pFastOre(*pfs)
         if len(pfs) == 2:
             return pasm.pOre2(pfs[0], pfs[1])
         if len(pe) == 3:
@@ -826,36 +1268,151 @@ class Generator(Optimizer):
             return pasm.pOre4(pfs[0], pfs[1], pfs[2], pfs[3])
         return pasm.pOre(*pfs)
 
+    def dispatch(self, pe: POre, pfs):
+        firsts = [self.first(e) for e in pe]
+        chars = set()
+        for fs in firsts:
+            if fs is not None:
+                chars |= fs
+        if len(chars) == 0 or len(chars) > 1024:
+            return None
+        table = {}
+        for c in chars:
+            table[c] = tuple(pf for pf, fs in zip(pfs, firsts) if fs is None or c in fs)
+        default = tuple(pf for pf, fs in zip(pfs, firsts) if fs is None)
+        if max(len(cands) for cands in table.values()) == len(pfs):
+            return None  # no alternatives are skipped
+        if not self.trees:
+            return pasm.pRecogDispatch(table, default)
+        if not self.tracking:
+            return pasm.pFastDispatch(table, default)
+        return pasm.pDispatch(table, default)
+
     def PRef(self, pe, step):
+        if self.lazy and pe.uname() not in self.generated:
+            return pasm.pLazy(self.generated, pe.uname(), self.compiler(pe))
         return pasm.pRef(self.generated, pe.uname())
 
+    # Lazy compilation
+
+    def compiler(self, ref):
+        generated, tracking = self.generated, self.tracking
+        key = (tracking, ref.uname())
+
+        def compile():
+            with GrammarLock:
+                if self.pending.pop(key, None) is None:
+                    return generated[ref.uname()]  # compiled already
+                saved = (self.generated, self.tracking)
+                self.generated, self.tracking = generated, tracking
+                try:
+                    self.emitRules([ref], ref)
+                    return generated[ref.uname()]
+                finally:
+                    self.generated, self.tracking = saved
+        self.pending[key] = compile
+        return compile
+
+    def compiles(self, parser, start):
+        def compile():
+            '''
+            compiles the rules left to the lazy stubs, ahead of parsing
+            '''
+            with GrammarLock:
+                while len(self.pending) > 0:
+                    next(iter(self.pending.values()))()
+                for generated in (self.generated, self.untracked):
+                    if start.uname() in generated:
+                        pasm.link(generated[start.uname()], generated)
+            return parser
+        parser.compile = compile
+        return parser
+
+    def reachesSkip(self, pe, visited):  # @skip() reads px.headpos
+        if isinstance(pe, PRef):
+            if pe.uname() in visited:
+                return False
+            visited.add(pe.uname())
+            return self.reachesSkip(pe.deref(), visited)
+        if pe.cname() == 'Skip':
+            return True
+        if isinstance(pe, PTuple):
+            return any(self.reachesSkip(e, visited) for e in pe)
+        if hasattr(pe, 'e'):
+            return self.reachesSkip(pe.e, visited)
+        return False
+
+    # Inlining small rules into sequences and choices
+
+    def expand(self, pe):
+        cls = pe.__class__
+        if not any(self.isInlinable(e, cls) for e in pe):
+            return pe
+        es = []
+        for e in pe:
+            if self.isInlinable(e, cls):
+                e = self.expand(e.deref())
+                es.extend(e if isinstance(e, cls) else [e])
+            else:
+                es.append(e)
+        return cls.new(*es)
+
+    def isInlinable(self, pe, cls):
+        if not isinstance(pe, PRef) or not isinstance(pe.deref(), cls):
+            return False
+        uname = pe.uname()
+        if uname not in self.inlinables:
+            self.inlinables[uname] = not (pe.peg == self.peg and pe.name in self.memos) \
+                and self.size(pe.deref()) <= INLINE_SIZE \
+                and not self.isRecursive(pe)
+        return self.inlinables[uname]
+
+    def size(self, pe):
+        if isinstance(pe, PTuple):
+            return 1 + sum(self.size(e) for e in pe)
+        if hasattr(pe, 'e'):
+            return 1 + self.size(pe.e)
+        return 1
+
     # Tree Construction
 
     def PNode(self, pe, step):
+        if not self.trees:
+            return self.emit(pe.e, step)
         _, fixed, es = self.fixedEach(0, [pe])
         # print(_, fixed, es)
         if fixed is None or not self.Ooox:
             fs = self.emit(pe.e, step)
+            if self.actions is not None:
+                return pasm.pNodeAction(fs, pe.tag, pe.shift, self.actions)
             return pasm.pNode(fs, pe.tag, pe.shift)
         else:
             # print('//OOD', self.join(fixed, *es))
             return self.emit(self.join(fixed, *es), step)
 
     def PEdge(self, pe, step):
+        if not self.trees:
+            return self.emit(pe.e, step)
         return pasm.pEdge(pe.edge, self.emit(pe.e, step))
 
     def PFold(self, pe, step):
+        if not self.trees:
+            return self.emit(pe.e, step)
         _, fixed, es = self.fixedEach(0, [pe])
         # print(_, fixed, es)
         # fixed = None
         if fixed is None or not self.Ooox:
             fs = self.emit(pe.e, step)
+            if self.actions is not None:
+                return pasm.pFoldAction(pe.edge, fs, pe.tag, pe.shift, self.actions)
             return pasm.pFold(pe.edge, fs, pe.tag, pe.shift)
         else:
             # print('//OOD', self.join(fixed, *es))
             return self.emit(self.join(fixed, *es), step)
 
     def PAbs(self, pe, step):
+        if not self.trees:
+            return self.emit(pe.e, step)
         return pasm.pAbs(self.emit(pe.e, step))
 
     def Skip(self, pe, step):  # @skip()
@@ -893,11 +1450,50 @@ class Generator(Optimizer):
         return pasm.pIn(name)
 
 
-generator = Generator()
+# emit() dispatches to the methods named after the expressions (cname()),
+# looked up in a table of each generator class, subclasses included
+
+def emitterTable(cls):
+    table = {}
+    for c in reversed(cls.__mro__):
+        table.update((name, f) for name, f in vars(c).items()
+                     if name[0].isupper() and callable(f))
+    return table
+
+
+Generator.emitters = emitterTable(Generator)
+
+
+# Each grammar has generators of its own, one for each set of generator
+# options, which compile its rules once for all start rules, and caches
+# the parsers generated by start rule and all the other options. Parsers
+# generated with options that cannot be hashed are not cached.
+
+GENERATOR_OPTIONS = ('expected', 'actions', 'trees', 'lazy', 'start')
 
 
 def generate(peg, **options):
-    return generator.generate(peg, **options)
+    expected = options.get('expected', False)
+    actions = options.get('actions', None)
+    trees = options.get('trees', True)
+    lazy = options.get('lazy', False)
+    gkey = (expected, id(actions) if actions is not None else None, trees, lazy)
+    key = (options.get('start', peg.start()), gkey) + \
+        tuple(sorted((name, value) for name, value in options.items()
+                     if name not in GENERATOR_OPTIONS))
+    try:
+        hash(key)
+    except TypeError:
+        key = None
+    with GrammarLock:
+        if key not in peg.parsers:
+            if gkey not in peg.generators:  # the generator keeps actions alive
+                peg.generators[gkey] = Generator(expected, actions, trees, lazy)
+            parser = peg.generators[gkey].generate(peg, **options)
+            if key is None:
+                return parser
+            peg.parsers[key] = parser
+        return peg.parsers[key]
 
 
 # ParseTree
@@ -1106,7 +1702,9 @@ class TPEGLoader(object):
             with file.open(encoding='utf-8_sig') as f:
                 ss = [x.strip('\r\n') for x in f.readlines()]
                 ds |= {x for x in ss if len(x) > 0 and not x.startswith('#')}
-        choice = [PChar(x) for x in sorted(ds, key=lambda x: len(x))[::-1]]
+        # the longest first, and words of a length in order, so that the
+        # choice (and its factoring) is the same whatever the set order
+        choice = [PChar(x) for x in sorted(ds, key=lambda x: (-len(x), x))]
         return POre(*choice)
 
     @classmethod
@@ -1123,7 +1721,7 @@ class TPEGLoader(object):
                 else:
                     ds |= {x for x in ss if len(
                         x) == n and not x.startswith('#')}
-        choice = [PChar(x) for x in ds]
+        choice = [PChar(x) for x in sorted(ds, key=lambda x: (-len(x), x))]
         return POre(*choice)
 
 
@@ -1177,12 +1775,13 @@ def grammar_factory():
         paths += os.environ.get('GRAMMAR', '').split(':')
         path = findpath(paths, urn)
         key = str(path)
-        if key in GrammarDB:
-            return GrammarDB[key]
-        peg = Grammar()
-        load_grammar(peg, path, **options)
-        GrammarDB[key] = peg
-        return peg
+        with GrammarLock:
+            if key in GrammarDB:
+                return GrammarDB[key]
+            peg = Grammar()
+            load_grammar(peg, path, **options)
+            GrammarDB[key] = peg
+            return peg
 
     return grammar
 
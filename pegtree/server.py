@@ -0,0 +1,151 @@
+import json
+import os
+import socket
+import socketserver
+import stat
+import threading
+from pathlib import Path
+import pegtree
+from pegtree.pasm import ERR, ParseTree, PTree2ParseTree, PTree2Tuple
+
+# A long-running parse server that keeps generated parsers warm.
+# Requests and responses are JSON lines over a Unix socket:
+#
+#  {"grammar": "math.tpeg", "start": "Expression", "inputs": "1+2", "tree": true}
+#  {"grammar": "math.tpeg", "file": "/path/to/input"}
+#
+#  {"urn": ..., "tag": "Infix", "spos": 0, "epos": 3, "tree": [...]}
+#  {"urn": ..., "tag": "err", "error": {"pos": 2, "line": 1, "column": 2, ...}}
+
+
+class ParserCache(object):
+    def __init__(self, **options):
+        self.options = options
+        self.parsers = {}
+        self.lock = threading.Lock()
+
+    def get(self, grammar, start=None):
+        key = (grammar, start)
+        with self.lock:
+            if key not in self.parsers:
+                peg = pegtree.grammar(grammar)
+                options = dict(self.options)
+                if start is not None:
+                    options['start'] = start
+                self.parsers[key] = pegtree.generate(peg, **options)
+            return self.parsers[key]
+
+
+def PTree2Response(pt, urn, inputs):
+    # a syntax error becomes a ParseTree, which decodes its position and
+    # carries the expected set; any other tree becomes tuples
+    if pt.prev is None and pt.tag == ERR:
+        return PTree2ParseTree(pt, urn, inputs)
+    return PTree2Tuple(pt, urn, inputs)
+
+
+def handle(parsers, request, grammar=None):
+    try:
+        parser = parsers.get(request.get('grammar', grammar), request.get('start', None))
+        if 'file' in request:
+            urn = request['file']
+            with open(urn, encoding='utf-8') as f:
+                inputs = f.read()
+        else:
+            urn = request.get('urn', '(unknown source)')
+            inputs = request['inputs']
+        t = parser(inputs, urn, conv=PTree2Response)
+        if isinstance(t, ParseTree):
+            response = {'urn': urn, 'tag': t.tag_, 'spos': t.spos_, 'epos': t.epos_}
+            _, pos, linenum, column, line, mark = t.decode()
+            response['error'] = {'pos': pos, 'line': linenum, 'column': column,
+                                 'message': t.showing('Syntax Error')}
+            if hasattr(t, 'expected_'):
+                response['error']['expected'] = t.expected_
+            return response
+        response = {'urn': urn, 'tag': t[0], 'spos': t[1], 'epos': t[2]}
+        if request.get('tree', False):
+            response['tree'] = t
+        return response
+    except Exception as e:
+        return {'urn': request.get('file', request.get('urn', None)),
+                'tag': 'exception', 'message': f'{type(e).__name__}: {e}'}
+
+
+class ParseRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                response = handle(server.parsers, request, server.grammar)
+            except ValueError as e:
+                response = {'tag': 'exception', 'message': f'invalid request: {e}'}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class ParseServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, grammar=None, **options):
+        try:  # a socket left by an earlier server, and nothing else
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            mode = None
+        if mode is not None:
+            if not stat.S_ISSOCK(mode):
+                raise FileExistsError(f'{path} exists and is not a socket')
+            os.unlink(path)
+        super().__init__(path, ParseRequestHandler)
+        self.grammar = grammar
+        self.parsers = ParserCache(**options)
+        if grammar is not None:
+            self.parsers.get(grammar, options.get('start', None))
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class ParseClient(object):
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('rb')
+        self.wfile = self.sock.makefile('wb')
+
+    def request(self, **request):
+        self.wfile.write(json.dumps(request).encode('utf-8') + b'\n')
+        self.wfile.flush()
+        return json.loads(self.rfile.readline())
+
+    def parse(self, inputs, grammar=None, start=None, urn='(unknown source)', tree=False):
+        return self.request(**request(grammar, start, tree, inputs=inputs, urn=urn))
+
+    def parse_file(self, file, grammar=None, start=None, tree=False):
+        return self.request(**request(grammar, start, tree, file=str(Path(file).resolve())))
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def request(grammar, start, tree, **request):
+    if grammar is not None:
+        request['grammar'] = grammar
+    if start is not None:
+        request['start'] = start
+    if tree:
+        request['tree'] = True
+    return request
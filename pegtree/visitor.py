@@ -0,0 +1,139 @@
+from pegtree.pasm import ParseTree, TAGS, TagVisitor
+
+# Visitor and Transformer dispatch on tag ids (self.<tag>, as in TPEGLoader)
+# through the table of TagVisitor, and walk trees with an explicit
+# stack, so that deep trees never hit the recursion limit.
+#
+# A Transformer rewrites a tree bottom-up; each method takes a Node whose
+# children and edges are already transformed. It can also be passed as
+# conv to a parser, building the results directly from the internal PTree
+# without any ParseTree:
+#
+#   class Calc(Transformer):
+#       def Int(self, node):
+#           return int(str(node))
+#
+#       def Infix(self, node):
+#           return node.left + node.right
+#
+#   parser('1+2', conv=Calc())  # => 3
+
+
+class Node(object):
+    __slots__ = ['tag', 'inputs', 'spos', 'epos', 'urn', 'children', 'edges']
+
+    def __init__(self, tag, inputs, spos, epos, urn, children, edges):
+        self.tag = tag
+        self.inputs = inputs
+        self.spos = spos
+        self.epos = epos
+        self.urn = urn
+        self.children = children
+        self.edges = edges
+
+    def __getattr__(self, label):  # node.left => node.edges['left']
+        try:
+            return self.edges[label]
+        except KeyError:
+            raise AttributeError(label)
+
+    def __str__(self):
+        s = self.inputs[self.spos:self.epos]
+        return s.decode('utf-8') if isinstance(s, bytes) else s
+
+    def __repr__(self):
+        if len(self.children) == 0 and len(self.edges) == 0:
+            return f'Node({self.tag!r}, {str(self)!r})'
+        return f'Node({self.tag!r}, {self.children!r}, {self.edges!r})'
+
+
+class Visitor(TagVisitor):
+    def walk(self, t):
+        '''
+        visits every node in the pre-order, without recursion
+        '''
+        stack = [t]
+        while len(stack) > 0:
+            t = stack.pop()
+            self.visit(t)
+            subs = list(t)
+            for v in t.__dict__.values():
+                if isinstance(v, ParseTree):
+                    subs.append(v)
+            subs.reverse()
+            stack.extend(subs)
+
+
+class Transformer(Visitor):
+    def transform(self, t: ParseTree):
+        table = self.dispatch()
+        stack = []  # (tree, edge, pending subtrees, children, edges)
+        edge = ''
+        while True:
+            subs = [('', child) for child in t]
+            for key, v in t.__dict__.items():
+                if isinstance(v, ParseTree):
+                    subs.append((key, v))
+            if len(subs) > 0:
+                subs.reverse()
+                stack.append((t, edge, subs, [], {}))
+            else:
+                value = table[t.id_](self, Node(t.tag_, t.inputs_, t.spos_, t.epos_, t.urn_, [], {}))
+                while True:  # completes the nodes whose subtrees are all done
+                    if len(stack) == 0:
+                        return value
+                    _, _, subs, children, edges = stack[-1]
+                    if edge == '':
+                        children.append(value)
+                    else:
+                        edges[edge] = value
+                    if len(subs) > 0:
+                        break
+                    t, edge, _, children, edges = stack.pop()
+                    value = table[t.id_](self, Node(t.tag_, t.inputs_, t.spos_, t.epos_,
+                                                    t.urn_, children, edges))
+            edge, t = stack[-1][2].pop()
+
+    def __call__(self, pt, urn, inputs):  # as conv
+        table = self.dispatch()
+        if pt.prev != None:
+            tid, spos, epos, subnode = 0, pt.spos, pt.epos, pt
+        else:
+            tid, spos, epos, subnode = pt.tag, pt.spos, pt.epos, pt.child
+        stack = []  # (tag id, spos, epos, edge, pending subnodes, children, edges)
+        edge = ''
+        while True:
+            if subnode != None:
+                subs = []
+                while subnode != None:  # backwards, so that pop() returns the first
+                    subs.append(subnode)
+                    subnode = subnode.prev
+                stack.append((tid, spos, epos, edge, subs, [], {}))
+            else:
+                value = table[tid](self, Node(TAGS[tid], inputs, spos, epos, urn, [], {}))
+                while True:
+                    if len(stack) == 0:
+                        return value
+                    _, _, _, _, subs, children, edges = stack[-1]
+                    if edge == '':
+                        children.append(value)
+                    elif edge not in edges:  # the first one wins, as in ParseTree
+                        edges[edge] = value
+                    if len(subs) > 0:
+                        break
+                    tid, spos, epos, edge, _, children, edges = stack.pop()
+                    value = table[tid](self, Node(TAGS[tid], inputs, spos, epos,
+                                                  urn, children, edges))
+            subnode = stack[-1][4].pop()
+            if subnode.isEdge():
+                edge = TAGS[subnode.tag]
+                pt = subnode.child
+                if pt == None:
+                    tid, spos, epos, subnode = 0, subnode.spos, abs(subnode.epos), None
+                elif pt.prev != None:
+                    tid, spos, epos, subnode = 0, pt.spos, pt.epos, pt
+                else:
+                    tid, spos, epos, subnode = pt.tag, pt.spos, pt.epos, pt.child
+            else:
+                edge = ''
+                tid, spos, epos, subnode = subnode.tag, subnode.spos, abs(subnode.epos), subnode.child
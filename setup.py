@@ -1,8 +1,11 @@
 from setuptools import setup
 import sys
 from pathlib import Path
-from Cython.Build import cythonize
-from Cython.Distutils import build_ext
+try:  # Cython is optional; pegtree falls back to pure Python
+    from Cython.Build import cythonize
+    from Cython.Distutils import build_ext
+except ImportError:
+    cythonize = None
 sys.path.append(str(Path(__file__).resolve().parent / 'tests'))
 
 setup(
@@ -31,7 +34,10 @@ setup(
         'Topic :: Text Processing',
     ],
     test_suite='test_all.suite',
-    cmdclass = {'build_ext': build_ext},
-    ext_modules = cythonize(['pegtree/parsec.py', 'pegtree/pasm.py', 'pegtree/pegtree.py', 'pegtree/tpeg.py'],
-                            compiler_directives={'language_level' : "3"})
+    cmdclass = {'build_ext': build_ext} if cythonize else {},
+    # pasm.py stays Python: pasm.link() patches its closures (__closure__),
+    # which Cython does not expose; _pasm.pyx compiles its hot combinators
+    ext_modules = cythonize(['pegtree/parsec.py', 'pegtree/pegtree.py', 'pegtree/tpeg.py',
+                             'pegtree/_pasm.pyx'],
+                            compiler_directives={'language_level' : "3"}) if cythonize else []
 )
@@ -1,5 +1,8 @@
 import unittest
-from pegpy.tpeg import STDLOG
+try:  # only the pegpy tests use exTest
+    from pegpy.tpeg import STDLOG
+except ImportError:
+    STDLOG = None
 
 def exTest(self, grammar, combinator):
 
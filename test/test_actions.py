@@ -0,0 +1,66 @@
+import unittest
+import pegtree
+from pegtree.pasm import ParseTree
+from pegtree.visitor import Transformer
+from test.test_parsers import samples
+
+MATH = {
+    'Int': lambda inputs, spos, epos, children, edges: int(inputs[spos:epos]),
+    'Infix': lambda inputs, spos, epos, children, edges: sum(children),
+}
+
+
+class Shape(Transformer):  # what actions make of every node
+    def undefined(self, node):
+        return (node.tag, node.spos, node.epos, node.children, sorted(node.edges.items()))
+
+
+def shape(tag):
+    def action(inputs, spos, epos, children, edges):
+        return (tag, spos, epos, children, sorted(edges.items()))
+    return action
+
+
+class TestActions(unittest.TestCase):
+
+    def test_values(self):
+        parser = pegtree.generate(pegtree.grammar('math.tpeg'), actions=MATH)
+        self.assertEqual(parser('1+2+3'), 6)
+        self.assertEqual(parser('(1+2)+3'), 6)
+        self.assertEqual(parser('42'), 42)
+
+    def test_trees(self):  # the same nodes as ParseTree, bottom-up
+        for file in ['math2.tpeg', 'json.tpeg', 'tpeg.tpeg', 'es4.tpeg']:
+            peg = pegtree.grammar(file)
+            actions = {tag: shape(tag) for tag in list(peg.tags()) + ['']}
+            for name, text in samples(peg):
+                t = pegtree.generate(peg, start=name)(text)
+                v = pegtree.generate(peg, start=name, actions=actions)(text)
+                if t.isSyntaxError():
+                    self.assertIsInstance(v, ParseTree)
+                    self.assertEqual(v.spos_, t.spos_)
+                    continue
+                self.assertEqual(v, Shape().transform(t), (name, text))
+
+    def test_backtracking(self):  # discarded nodes leave no values
+        peg = pegtree.grammar('''
+S = { A* #S }
+A = { 'x' #X } 'y' / { 'x' #Z } 'z'
+''')
+
+        def record(tag):
+            return lambda inputs, spos, epos, children, edges: (tag, spos, children)
+        parser = pegtree.generate(peg, start='S', actions={tag: record(tag) for tag in 'SXZ'})
+        self.assertEqual(parser('xzxyxz'), ('S', 0, [('Z', 0, []), ('X', 2, []), ('Z', 4, [])]))
+
+    def test_missing(self):  # a tag without an action still makes a ParseTree
+        parser = pegtree.generate(pegtree.grammar('math.tpeg'),
+                                  actions={'Int': MATH['Int']})
+        t = parser('1+2')
+        self.assertIsInstance(t, ParseTree)
+        self.assertEqual(t.tag_, 'Infix')
+        self.assertEqual(list(t), [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import asyncio
+import threading
+import unittest
+import pegtree
+from pegtree.aio import AsyncParser
+from pegtree.pasm import PTree2Tuple
+
+DOCS = ['1+2*3', '(1+2)*3', '1+', '8/4%3-1', '']
+
+
+class TestAsyncParser(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.parser = pegtree.generate(pegtree.grammar('math.tpeg'))
+
+    async def test_results(self):
+        for result, conv in [('compact', lambda s: self.parser(s, conv=PTree2Tuple)),
+                             ('repr', lambda s: repr(self.parser(s))),
+                             ('tree', self.parser)]:
+            async with AsyncParser(self.parser, workers=2, result=result) as aparser:
+                values = await asyncio.gather(*(aparser.parse(s) for s in DOCS * 20))
+            self.assertEqual(values, [conv(s) for s in DOCS * 20], result)
+
+    async def test_batches(self):  # a small queue blocks instead of failing
+        sizes = []
+
+        def parser(inputs, urn, conv=None):
+            return inputs
+
+        async with AsyncParser(parser, workers=1, maxsize=2, batch_size=4) as aparser:
+            run_batch = aparser.run_batch
+            aparser.run_batch = lambda batch, result: sizes.append(len(batch)) or run_batch(batch, result)
+            values = await asyncio.gather(*(aparser.parse(str(i)) for i in range(50)))
+        self.assertEqual(values, [str(i) for i in range(50)])
+        self.assertEqual(sum(sizes), 50)
+        self.assertLessEqual(max(sizes), 4)
+
+    async def test_exceptions(self):
+        def parser(inputs, urn, conv=None):
+            if inputs == 'bad':
+                raise ValueError(inputs)
+            return inputs
+
+        async with AsyncParser(parser, workers=1) as aparser:
+            results = await asyncio.gather(aparser.parse('ok'), aparser.parse('bad'),
+                                           aparser.parse('ok2'), return_exceptions=True)
+        self.assertEqual(results[0], 'ok')
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2], 'ok2')
+
+    async def test_close(self):  # every pending request is resolved
+        started = threading.Event()
+        blocked = threading.Event()
+        released = []
+
+        def parser(inputs, urn, conv=None):
+            started.set()
+            released.append(blocked.wait(5))
+            return inputs
+
+        aparser = AsyncParser(parser, workers=1, maxsize=2, batch_size=1)
+        tasks = [asyncio.ensure_future(aparser.parse(str(i))) for i in range(6)]
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        closing = asyncio.ensure_future(aparser.close())
+        await asyncio.sleep(0.01)
+        blocked.set()  # the loop still runs while close() waits
+        await closing
+        self.assertEqual(released, [True])
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        self.assertEqual(results[0], '0')
+        for r in results[1:]:
+            self.assertIsInstance(r, asyncio.CancelledError)
+        with self.assertRaises(RuntimeError):
+            await aparser.parse('1')
+
+    async def test_processes(self):
+        async with AsyncParser(grammar='math.tpeg', processes=True, workers=2) as aparser:
+            values = await asyncio.gather(*(aparser.parse(s) for s in DOCS))
+        self.assertEqual(values, [self.parser(s, conv=PTree2Tuple) for s in DOCS])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import csv
+import io
+import random
+import unittest
+import pegtree
+import pegtree.csv
+
+CHUNK_SIZES = [1, 2, 3, 7, 64, 1000, 1 << 20]
+
+
+def table(rows, seed=1):
+    rnd = random.Random(seed)
+    lines = []
+    for _ in range(rows):
+        fields = []
+        for _ in range(rnd.randint(1, 6)):
+            if rnd.random() < 0.3:
+                fields.append('"' + rnd.choice(['a,b', 'x""y', 'line\nbreak', '', 'q\r\nr']) + '"')
+            else:
+                fields.append(rnd.choice(['1997', 'Ford', '', 'E350', '3000.00', 'abc def']))
+        lines.append(','.join(fields))
+    return lines
+
+
+class TestReader(unittest.TestCase):
+
+    def test_rows(self):
+        lines = table(200)
+        for nl in ['\n', '\r\n']:
+            for tail in ['', nl]:
+                text = nl.join(lines) + tail
+                want = list(csv.reader(io.StringIO(text, newline='')))
+                for size in CHUNK_SIZES:
+                    with self.subTest(newline=nl, tail=tail, chunksize=size):
+                        f = io.StringIO(text, newline='')
+                        self.assertEqual(list(pegtree.csv.reader(f, chunksize=size)), want)
+
+    def test_spans(self):
+        text = '\n'.join(table(50, seed=2))
+        want = list(csv.reader(io.StringIO(text, newline='')))
+        for size in CHUNK_SIZES:
+            f = io.StringIO(text, newline='')
+            spans = list(pegtree.csv.reader(f, chunksize=size, spans=True))
+            self.assertEqual([[text[s:e].replace('""', '"') for s, e in row] for row in spans], want)
+
+    def test_grammar(self):  # a Grammar object, as well as a file name
+        peg = pegtree.grammar('csv.tpeg')
+        text = '\n'.join(table(50, seed=3))
+        want = list(csv.reader(io.StringIO(text, newline='')))
+        for size in CHUNK_SIZES:
+            f = io.StringIO(text, newline='')
+            self.assertEqual(list(pegtree.csv.reader(f, grammar=peg, chunksize=size)), want)
+        self.assertIs(pegtree.csv.generate(peg), pegtree.csv.generate(peg))
+        self.assertIs(pegtree.csv.generate(peg), pegtree.csv.generate('csv.tpeg'))
+
+    def test_empty(self):
+        self.assertEqual(list(pegtree.csv.reader(io.StringIO(''))), [])
+
+
+class TestStream(unittest.TestCase):
+
+    def test_records(self):
+        parser = pegtree.generate(pegtree.grammar('math.tpeg'), stream=True)
+        records = [(offset, t.tag_, t.epos_) for offset, t in parser(['1+', '2*3', '4'])]
+        self.assertEqual(records, [(0, 'Infix', 6)])
+
+    def test_error(self):  # reported without reading to the end
+        parser = pegtree.generate(pegtree.grammar('math.tpeg'), stream=True)
+        read = []
+
+        def chunks():
+            yield '1+2\n3*(4\n'
+            while len(read) < 1000:
+                read.append(1)
+                yield '5\n' * 100
+        results = list(parser(chunks()))
+        self.assertTrue(results[-1][1].isSyntaxError())
+        self.assertEqual(results[-1][1].spos_, 3)
+        self.assertLess(len(read), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
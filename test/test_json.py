@@ -0,0 +1,60 @@
+import io
+import json
+import random
+import unittest
+import pegtree
+import pegtree.json
+
+
+def value(r, depth=0):
+    kind = r.randrange(9 if depth < 4 else 6)
+    if kind == 0:
+        return r.randrange(-10 ** 6, 10 ** 6)
+    if kind == 1:
+        return r.uniform(-1e6, 1e6) * 10 ** r.randrange(-30, 30)
+    if kind == 2:
+        return ''.join(r.choice('ab "\\/\n\t\x01éあ\U0001f600') for _ in range(r.randrange(8)))
+    if kind == 3:
+        return r.choice([True, False, None])
+    if kind in (4, 5):
+        return r.choice(['', 'x', 0, 0.5, -0.0, 1e-7])
+    if kind in (6, 7):
+        return [value(r, depth + 1) for _ in range(r.randrange(5))]
+    return {value(r, 4) if kind == 0 else str(i): value(r, depth + 1) for i in range(r.randrange(5))}
+
+
+def corpus(seed=0, n=200):
+    r = random.Random(seed)
+    for i in range(n):
+        v = value(r)
+        yield json.dumps(v, ensure_ascii=i % 2 == 0, indent=(2 if i % 3 == 0 else None))
+
+
+class TestLoads(unittest.TestCase):
+
+    def test_corpus(self):  # the same values as json.loads
+        for doc in corpus():
+            self.assertEqual(pegtree.json.loads(doc), json.loads(doc), doc)
+        for doc in ['1E+2', '-0.5e-3', '"\\u00e9\\ud83d\\ude00"', ' [ ] ', '{"a":{}}']:
+            self.assertEqual(pegtree.json.loads(doc), json.loads(doc), doc)
+        self.assertEqual(pegtree.json.loads(b'[1, "\xc3\xa9"]'), [1, 'é'])
+
+    def test_errors(self):  # at the farthest failure of the grammar
+        parser = pegtree.generate(pegtree.grammar('json.tpeg'), start='File')
+        for doc, pos in [('[1, 2', 5), ('{"a" 1}', 5), ('[1,]', 3), ('', 0), ('01', 1),
+                         ('1.', 2), ('[1] x', None), ('{"a": tru}', None)]:
+            with self.assertRaises(json.JSONDecodeError) as e:
+                pegtree.json.loads(doc)
+            self.assertEqual(e.exception.pos, parser(doc).spos_, doc)
+            if pos is not None:
+                self.assertEqual(e.exception.pos, pos, doc)
+        with self.assertRaises(json.JSONDecodeError):  # strict, as json.loads
+            pegtree.json.loads('"\t"')
+
+    def test_load(self):
+        f = io.StringIO('{"a": [1, 2.5, null]}')
+        self.assertEqual(pegtree.json.load(f), {'a': [1, 2.5, None]})
+
+
+if __name__ == '__main__':
+    unittest.main()
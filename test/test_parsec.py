@@ -0,0 +1,51 @@
+import contextlib
+import io
+import unittest
+import pegtree
+from pegtree.parsec import Parsec
+from pegtree.pegtree import Generator
+
+MATH = [
+    'pRule(peg,"Int",pSeq2(pRange("","09"),pNode(pManyRange("","09"),"Int",-1)))',
+    'pRule(peg,"Value",pOre2(pRef(peg,"Int"),pSeq3(pChar("("),pRef(peg,"Expression"),pChar(")"))))',
+    'pRule(peg,"Product",pSeq2(pRef(peg,"Value"),pMany(pSeq2(pRange("*%/",""),'
+    'pFold("",pRef(peg,"Value"),"Infix",-1)))))',
+    'pRule(peg,"Expression",pSeq2(pRef(peg,"Product"),pMany(pSeq2(pRange("+-",""),'
+    'pFold("",pRef(peg,"Product"),"Infix",-1)))))',
+]
+
+
+def emitted(generator, peg):
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        generator.generate(peg)
+    return out.getvalue().splitlines()
+
+
+class TestParsec(unittest.TestCase):
+
+    def test_rules(self):
+        peg = pegtree.grammar('math.tpeg')
+        self.assertEqual(sorted(emitted(Parsec(), peg)), sorted(MATH))
+
+    def test_emitters(self):  # each class dispatches to its own methods
+        self.assertIs(Parsec.emitters['PChar'], Parsec.PChar)
+        self.assertIs(Generator.emitters['PChar'], Generator.PChar)
+
+        class Chars(Parsec):  # and inherits the others
+            def PChar(self, pe, step):
+                return self.emitApply('Chars', self.quote(pe.text))
+        self.assertIs(Chars.emitters['PRange'], Parsec.PRange)
+        peg = pegtree.grammar('math.tpeg')
+        self.assertTrue(any('pChars("(")' in line for line in emitted(Chars(), peg)))
+
+    def test_combinators(self):  # no code from or into the shared combinators
+        peg = pegtree.grammar('math.tpeg')
+        parser = Generator().generate(peg)
+        self.assertEqual(sorted(emitted(Parsec(), peg)), sorted(MATH))
+        self.assertEqual(parser('1+2').tag_, 'Infix')
+        self.assertEqual(Generator().generate(peg)('1+2').tag_, 'Infix')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,299 @@
+import gc
+import random
+import sys
+import unittest
+import pegtree
+from pegtree import pasm
+from pegtree.pasm import ParseTree, Recognition
+from pegtree.pegtree import Generator, combinator_stats
+
+# Parsers generated with different options must agree: the same trees, and
+# the same error positions (the farthest failure), on the examples of the
+# bundled grammars and on broken copies of them.
+
+GRAMMARS = ['a.tpeg', 'math.tpeg', 'math2.tpeg', 'json.tpeg', 'csv.tpeg',
+            'chibi.tpeg', 'tpeg.tpeg', 'es4.tpeg', 'java8.tpeg']
+
+MODES = [
+    {'expected': True},
+    {'trees': False},
+    {'twophase': True},
+    {'twophase': False},
+    {'lazy': True},
+]
+
+
+def canon(t):
+    edges = [(key, canon(v)) for key, v in t.__dict__.items() if isinstance(v, ParseTree)]
+    return (t.tag_, t.spos_, t.epos_, [canon(c) for c in t], sorted(edges))
+
+
+def outcome(t):
+    if isinstance(t, Recognition):
+        return ('ok',) if t.ok else ('err', t.epos)
+    if t.isSyntaxError():
+        return ('err', t.spos_)
+    return ('ok',)
+
+
+def samples(peg, seed=1):
+    '''
+    yields (start, inputs) for each example, and broken copies of it
+    '''
+    rnd = random.Random(seed)
+    for name, doc in peg['@@example']:
+        if name not in peg:
+            continue
+        text = doc.inputs_[doc.spos_:doc.epos_]
+        yield name, text
+        for _ in range(4):
+            i = rnd.randrange(len(text) + 1)
+            yield name, text[:i]
+            yield name, text[:i] + rnd.choice('"\'()[]{},;+-*/ x0\\\n') + text[i + 1:]
+
+
+class TestModes(unittest.TestCase):
+
+    def assertSame(self, t, t2, msg):
+        self.assertEqual(outcome(t2), outcome(t), msg)
+        if isinstance(t2, ParseTree) and not t.isSyntaxError():
+            self.assertEqual(canon(t2), canon(t), msg)
+
+    def test_modes(self):
+        for file in GRAMMARS:
+            peg = pegtree.grammar(file)
+            for options in MODES:
+                with self.subTest(grammar=file, **options):
+                    for name, text in samples(peg):
+                        t = pegtree.generate(peg, start=name)(text)
+                        t2 = pegtree.generate(peg, start=name, **options)(text)
+                        self.assertSame(t, t2, (name, text))
+
+
+class TestOptimizer(unittest.TestCase):
+    # each optimization leaves trees and error positions as they are
+
+    def assertUnchanged(self, flag):
+        generators = []
+        for file in GRAMMARS:
+            peg = pegtree.grammar(file)
+            g, g2 = Generator(), Generator()
+            setattr(g2, flag, False)
+            with self.subTest(grammar=file):
+                for name, text in samples(peg, seed=2):
+                    t = g.generate(peg, start=name)(text)
+                    t2 = g2.generate(peg, start=name)(text)
+                    self.assertEqual(outcome(t), outcome(t2), (name, text))
+                    if not t.isSyntaxError():
+                        self.assertEqual(canon(t), canon(t2), (name, text))
+            generators.append(g)
+        return generators
+
+    def test_factoring(self):
+        generators = self.assertUnchanged('Ofactor')
+        self.assertGreater(sum(sum(g.factored.values()) for g in generators), 0)
+
+    def test_prefix(self):
+        peg = pegtree.grammar('''
+A = 'ab' { [0-9] #D } / 'ad' { [a-z] #L } / 'abe'
+''')
+        g, g2 = Generator(), Generator()
+        g2.Ofactor = False
+        # string prefixes are split only in the untracked pass of two phases
+        parser = g.generate(peg, start='A', twophase=True)
+        parser2 = g2.generate(peg, start='A', twophase=True)
+        self.assertEqual(g.factored, {'A': 1})
+        for text in ['ab1', 'adx', 'abe', 'ab', 'a', 'x', 'abx', 'ad1', '']:
+            t, t2 = parser(text), parser2(text)
+            self.assertEqual(outcome(t), outcome(t2), text)
+            self.assertEqual(repr(t), repr(t2), text)
+
+    def test_counts(self):  # once, in the pass the parser matches with
+        for file, counts, tracked in [
+                ('java8.tpeg', {'OCTAL_ESCAPE': 2}, {'OCTAL_ESCAPE': 2}),
+                ('es4.tpeg', {'EOS': 1, 'UCHAR': 1, 'W': 1, 'IDENTIFIER_START': 1,
+                              'IDENTIFIER_PART': 1, 'ESCAPE_SEQUENCE': 1}, {'EOS': 1}),
+                ('tpeg.tpeg', {'COMMENT': 1}, {})]:
+            peg = pegtree.grammar(file)
+            g, g2 = Generator(), Generator()
+            g.generate(peg, twophase=True)
+            g2.generate(peg, twophase=False)
+            self.assertEqual(g.factored, counts, file)
+            self.assertEqual(g2.factored, tracked, file)
+
+    def test_fixed_prefix(self):  # { 'if' S e #If } => 'if' S { e #If } shifted
+        self.assertUnchanged('Ooox')
+
+    def test_cons(self):
+        self.assertUnchanged('Ocons')
+
+
+class TestCons(unittest.TestCase):
+    # hash-consed combinators are shared across generators, held weakly
+
+    GRAMMAR = '''
+A = { [p-z]+ ('#' / '@') [0-7]* #A }
+'''
+
+    def test_shared(self):
+        parsers = []
+        stats = [combinator_stats()]
+        for _ in range(2):  # the same subexpressions in another grammar
+            parsers.append(Generator().generate(pegtree.grammar(self.GRAMMAR), start='A'))
+            stats.append(combinator_stats())
+        self.assertGreater(stats[1]['misses'], stats[0]['misses'])
+        self.assertEqual(stats[2]['misses'], stats[1]['misses'])
+        self.assertGreater(stats[2]['hits'], stats[1]['hits'])
+        for text in ['pq@0', 'zz#', 'a#1', '']:
+            self.assertEqual(repr(parsers[0](text)), repr(parsers[1](text)))
+
+    def test_weak(self):  # combinators go away with their parsers
+        peg = pegtree.grammar(self.GRAMMAR.replace('p-z', 'k-n'))
+        gc.collect()
+        size = combinator_stats()['size']
+        parser = Generator().generate(peg, start='A')
+        self.assertEqual(repr(parser('kn@7')), repr(Generator().generate(peg, start='A')('kn@7')))
+        self.assertGreater(combinator_stats()['size'], size)
+        del parser
+        gc.collect()
+        self.assertLessEqual(combinator_stats()['size'], size)
+
+    def test_charsets(self):  # bounded, since frozensets are held strongly
+        for c in range(pasm.CHARSET_CACHE_SIZE + 100):
+            pasm.charset(chr(0x4e00 + c), ())
+        self.assertLessEqual(len(pasm.CharsetCache), pasm.CHARSET_CACHE_SIZE)
+
+
+class TestPool(unittest.TestCase):
+    # parsers reuse their contexts, with nothing left of the last parse
+
+    MEMO = '''
+S = A '+' A / A '-' A
+A = { [0-9]+ #A } / { '(' S ')' #P }
+packrat = 'A' / 'S'
+'''
+
+    def test_parse_many(self):
+        peg = pegtree.grammar('json.tpeg')
+        docs = [text for _, text in samples(peg)]
+        parser = pegtree.generate(peg, start='Value')
+        self.assertEqual([outcome(t) for t in parser.parse_many(docs)],
+                         [outcome(parser(text)) for text in docs])
+        self.assertEqual([canon(t) for t in parser.parse_many(docs) if not t.isSyntaxError()],
+                         [canon(parser(text)) for text in docs if not parser(text).isSyntaxError()])
+        recognizer = pegtree.generate(peg, start='Value', trees=False)
+        self.assertEqual(list(recognizer.parse_many(docs)), [recognizer(text) for text in docs])
+
+    def test_memo(self):  # memo entries of the last inputs are not reused
+        peg = pegtree.grammar(self.MEMO)
+        parser = pegtree.generate(peg, start='S')
+        docs = ['12-3', '(4+5)+6', '78-(9)', '(1-2', '34+5']
+        fresh = [canon(t) if not t.isSyntaxError() else outcome(t)
+                 for t in (Generator().generate(peg, start='S')(text) for text in docs)]
+        for results in [[parser(text) for text in docs], list(parser.parse_many(docs))]:
+            self.assertEqual([canon(t) if not t.isSyntaxError() else outcome(t) for t in results],
+                             fresh)
+
+    def test_clear(self):  # pooled contexts drop the inputs
+        for peg, start in [(pegtree.grammar('math.tpeg'), 'Expression'),
+                           (pegtree.grammar(self.MEMO), 'S')]:
+            for options in [{}, {'trees': False}]:
+                parser = pegtree.generate(peg, start=start, **options)
+                text = ''.join(['(1+2)', '-3'])  # not interned
+                refs = sys.getrefcount(text)
+                if options:
+                    parser(text)
+                else:
+                    parser(text, conv=lambda pt, urn, inputs: pt)
+                self.assertEqual(sys.getrefcount(text), refs, (start, options))
+
+
+class TestCache(unittest.TestCase):
+
+    def test_options(self):  # a parser for each set of options
+        peg = pegtree.grammar('math.tpeg')
+        parser = pegtree.generate(peg)
+        self.assertIs(pegtree.generate(peg), parser)
+        self.assertIs(pegtree.generate(peg, start=peg.start()), parser)
+        others = [pegtree.generate(peg, **options) for options in [
+            {'start': 'Int'}, {'twophase': False}, {'twophase': None}, {'stream': True},
+            {'trees': False}, {'expected': True}, {'logger': print}]]
+        self.assertEqual(len(set(map(id, [parser] + others))), len(others) + 1)
+        self.assertIs(pegtree.generate(peg, twophase=None), others[2])
+        self.assertEqual(outcome(others[6]('1+')), outcome(parser('1+')))
+
+    def test_unhashable(self):  # generated each time, from the same generator
+        peg = pegtree.grammar('math.tpeg')
+        pegtree.generate(peg, inputs=[])
+        size, generators = len(peg.parsers), len(peg.generators)
+        parser = pegtree.generate(peg, inputs=['a.txt'])
+        self.assertIsNot(pegtree.generate(peg, inputs=['a.txt']), parser)
+        self.assertEqual((len(peg.parsers), len(peg.generators)), (size, generators))
+        self.assertEqual(canon(parser('1+2*3')), canon(pegtree.generate(peg)('1+2*3')))
+
+
+class TestLink(unittest.TestCase):
+
+    def test_patched(self):  # parsers no longer look rules up by name
+        def unlinked(px):
+            raise AssertionError('not linked')
+        for file in GRAMMARS:
+            peg = pegtree.grammar(file)
+            parsers = {}
+            for name, text in samples(peg):
+                if name not in parsers:
+                    g = Generator()
+                    parsers[name] = g.generate(peg, start=name)
+                    for generated in (g.generated, g.untracked):
+                        for uname in generated:
+                            generated[uname] = unlinked
+                t = pegtree.generate(peg, start=name)(text)
+                self.assertEqual(outcome(parsers[name](text)), outcome(t), (file, name, text))
+
+
+class TestLazy(unittest.TestCase):
+
+    def test_on_demand(self):  # rules are compiled as they are first matched
+        peg = pegtree.grammar('java8.tpeg')
+        g = Generator(lazy=True)
+        parser = g.generate(peg)
+
+        def compiled():  # by both passes of two-phase parsing
+            return len(g.generated) + len(g.untracked)
+        counts = [compiled()]
+        text = 'class A { int x = 1; }'
+        self.assertEqual(canon(parser(text)), canon(pegtree.generate(peg)(text)))
+        counts.append(compiled())
+        parser.compile()
+        counts.append(compiled())
+        self.assertEqual(counts, sorted(set(counts)))
+        self.assertEqual(len(g.pending), 0)
+
+    def test_compile(self):
+        peg = pegtree.grammar('es4.tpeg')
+        g = Generator(lazy=True)
+        parser = g.generate(peg)
+        self.assertGreater(len(g.pending), 0)
+        self.assertIs(parser.compile(), parser)
+        self.assertEqual(len(g.pending), 0)
+        for name, text in samples(peg):
+            if name == peg.start():
+                self.assertEqual(outcome(parser(text)), outcome(pegtree.generate(peg)(text)))
+
+
+class TestExpected(unittest.TestCase):
+
+    def test_many_symbols(self):  # more bits than a C long
+        peg = pegtree.grammar('java8.tpeg')
+        g = Generator(expected=True)
+        parser = g.generate(peg)
+        self.assertGreater(len(g.symbols), 64)
+        t = parser('class A { int x = ; }')
+        self.assertTrue(t.isSyntaxError())
+        self.assertEqual(t.spos_, 18)
+        self.assertIn('NAME', t.expected_)
+        self.assertIn("'('", t.expected_)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from pegtree.server import ParseServer, ParseClient
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'pegtree.sock')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def serve(self, **options):
+        server = ParseServer(self.path, 'math.tpeg', **options)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_parse(self):
+        self.serve()
+        with ParseClient(self.path) as c:
+            res = c.parse('1+2', tree=True)
+            self.assertEqual((res['tag'], res['epos']), ('Infix', 3))
+            self.assertEqual(res['tree'][0], 'Infix')
+            self.assertNotIn('tree', c.parse('1+2'))
+            file = os.path.join(self.tmp.name, 'input.txt')
+            with open(file, 'w') as f:
+                f.write('(1+2)*3')
+            res = c.parse_file(file)
+            self.assertEqual((res['urn'], res['tag'], res['epos']), (file, 'Infix', 7))
+            res = c.parse_file(file + '.none')
+            self.assertEqual(res['tag'], 'exception')
+
+    def test_error(self):  # parsed once, reported with its position
+        server = self.serve(expected=True)
+        calls = []
+        parser = server.parsers.get('math.tpeg')
+
+        def counted(*args, **kw):
+            calls.append(args[0])
+            return parser(*args, **kw)
+        server.parsers.parsers[('math.tpeg', None)] = counted
+        with ParseClient(self.path) as c:
+            res = c.parse('(1+2', urn='a.txt')
+        self.assertEqual(calls, ['(1+2'])
+        self.assertEqual(res['tag'], 'err')
+        self.assertEqual(res['error']['pos'], 4)
+        self.assertEqual(res['error']['line'], 1)
+        self.assertIn('Syntax Error', res['error']['message'])
+        self.assertIn('a.txt', res['error']['message'])
+        self.assertIn("')'", res['error']['expected'])
+
+    def test_socket_path(self):
+        with open(self.path, 'w') as f:
+            f.write('data')
+        with self.assertRaises(FileExistsError):
+            ParseServer(self.path, 'math.tpeg')
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'data')
+        os.unlink(self.path)
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        self.serve()  # replaces the socket left behind
+        with ParseClient(self.path) as c:
+            self.assertEqual(c.parse('1')['tag'], 'Int')
+
+
+if __name__ == '__main__':
+    unittest.main()
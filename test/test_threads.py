@@ -0,0 +1,82 @@
+import sys
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import pegtree
+from pegtree.pegtree import Generator
+from test.test_parsers import canon, outcome, samples
+
+THREADS = 8
+
+
+def result(t):
+    return outcome(t) if t.isSyntaxError() else canon(t)
+
+
+def concurrently(parse, docs):
+    '''
+    parses docs from THREADS threads started together, each in its own order
+    '''
+    barrier = threading.Barrier(THREADS)
+
+    def run(i):
+        barrier.wait()
+        order = docs[i:] + docs[:i]
+        return [(text, parse(text)) for text in order]
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # switch threads as often as possible
+    try:
+        with ThreadPoolExecutor(THREADS) as pool:
+            return [dict(rs) for rs in pool.map(run, range(THREADS))]
+    finally:
+        sys.setswitchinterval(interval)
+
+
+class TestThreads(unittest.TestCase):
+    # parsers called from many threads give the results of one thread
+
+    def assertSequential(self, peg, start, **options):
+        docs = [text for name, text in samples(peg) if name == start]
+        docs = list(dict.fromkeys(docs))  # no duplicates
+        expected = Generator().generate(peg, start=start, **options)
+        expected = {text: result(expected(text)) for text in docs}
+        # a new parser, so that threads race on binding the rules too
+        parser = Generator().generate(peg, start=start, **options)
+        for results in concurrently(parser, docs):
+            self.assertEqual({text: result(t) for text, t in results.items()}, expected,
+                             (start, options))
+
+    def test_parse(self):
+        for file, start in [('json.tpeg', 'Value'), ('math.tpeg', 'Expression'),
+                            ('es4.tpeg', 'Statement')]:
+            peg = pegtree.grammar(file)
+            self.assertSequential(peg, start)
+            self.assertSequential(peg, start, twophase=False)
+
+    def test_lazy(self):  # the first matches compile the rules
+        for file, start in [('json.tpeg', 'Value'), ('es4.tpeg', 'Statement')]:
+            self.assertSequential(pegtree.grammar(file), start, lazy=True)
+
+    def test_memo(self):
+        peg = pegtree.grammar('''
+S = A '+' A / A '-' A
+A = { [0-9]+ #A } / { '(' S ')' #P }
+packrat = 'A' / 'S'
+''')
+        parser = pegtree.generate(peg, start='S')
+        docs = ['12-3', '(4+5)+6', '78-(9)', '(1-2', '34+5', '((1+2)-3)+4']
+        expected = {text: result(parser(text)) for text in docs}
+        for results in concurrently(parser, docs):
+            self.assertEqual({text: result(t) for text, t in results.items()}, expected)
+
+    def test_recognizer(self):
+        peg = pegtree.grammar('json.tpeg')
+        docs = list(dict.fromkeys(text for _, text in samples(peg)))
+        recognizer = pegtree.generate(peg, start='Value', trees=False)
+        expected = {text: recognizer(text) for text in docs}
+        for results in concurrently(recognizer, docs):
+            self.assertEqual(results, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,229 @@
+import io
+import json
+import unittest
+import pegtree
+from pegtree.pasm import ParseTree, TreeWriter, TreeReader, JSONWriter, PTree2Tuple
+from pegtree.pasm import TagVisitor, tag_id, tag_name
+from pegtree.visitor import Transformer
+from test.test_parsers import canon, samples
+
+GRAMMARS = ['math2.tpeg', 'json.tpeg', 'chibi.tpeg', 'tpeg.tpeg', 'es4.tpeg']
+
+
+def trees():
+    for file in GRAMMARS:
+        peg = pegtree.grammar(file)
+        for name, text in samples(peg):
+            yield pegtree.generate(peg, start=name)(text, f'{file}:{name}')
+
+
+class TestBytes(unittest.TestCase):
+
+    def test_roundtrip(self):
+        for t in trees():
+            t2 = ParseTree.from_bytes(t.to_bytes())
+            self.assertEqual(canon(t2), canon(t))
+            self.assertEqual(t2.inputs_, t.inputs_)
+            self.assertEqual(t2.urn_, t.urn_)
+            self.assertEqual(t2.isSyntaxError(), t.isSyntaxError())
+
+    def test_without_inputs(self):
+        for t in trees():
+            t2 = ParseTree.from_bytes(t.to_bytes(inputs=False), t.inputs_)
+            self.assertEqual(canon(t2), canon(t))
+            self.assertEqual(str(t2), str(t))
+
+    def test_stream(self):
+        ts = list(trees())
+        f = io.BytesIO()
+        w = TreeWriter(f)
+        for t in ts:
+            w.write(t)
+        f.seek(0)
+        ts2 = list(TreeReader(f))
+        self.assertEqual([canon(t) for t in ts2], [canon(t) for t in ts])
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            ParseTree.from_bytes(b'{"tag": "Int"}')
+        with self.assertRaises(ValueError):
+            TreeReader(io.BytesIO(b'{"tag": "Int"}'))
+
+
+def to_dict(t, positions=False, linecol=False, text=True, edge=''):
+    d = {'edge': edge} if edge != '' else {}
+    d['tag'] = t.tag_
+    if positions:
+        d['pos'] = [t.spos_, t.epos_]
+    if linecol:
+        before = t.inputs_[:t.spos_]
+        d['line'] = [before.count('\n') + 1, t.spos_ - (before.rfind('\n') + 1)]
+    edges = [(key, v) for key, v in t.__dict__.items() if isinstance(v, ParseTree)]
+    edges.sort(key=lambda e: e[1].spos_)
+    children = [to_dict(c, positions, linecol, text) for c in t]
+    children += [to_dict(v, positions, linecol, text, key) for key, v in edges]
+    if children:
+        d['children'] = children
+    elif text:
+        d['text'] = str(t)
+    return d
+
+
+class TestJSON(unittest.TestCase):
+
+    def test_options(self):
+        for options in [{}, {'positions': True}, {'linecol': True}, {'text': False},
+                        {'positions': True, 'linecol': True, 'text': False}]:
+            with self.subTest(**options):
+                for t in trees():
+                    if t.isSyntaxError():
+                        continue
+                    self.assertEqual(json.loads(t.to_json(**options)), to_dict(t, **options))
+
+    def test_conv(self):  # from PTree, without ParseTree
+        for file in GRAMMARS:
+            peg = pegtree.grammar(file)
+            for name, text in samples(peg):
+                parser = pegtree.generate(peg, start=name)
+                t = parser(text)
+                s = parser(text, conv=JSONWriter(positions=True, linecol=True))
+                if t.isSyntaxError():
+                    self.assertIsInstance(s, ParseTree)
+                    s = JSONWriter().write(s)
+                self.assertEqual(json.loads(s), json.loads(t.to_json(positions=True, linecol=True)))
+
+    def test_stream(self):
+        t = pegtree.generate(pegtree.grammar('es4.tpeg'))('var x = [1, 2, 3];\n' * 1000)
+        f = io.StringIO()
+        self.assertIsNone(t.to_json(f, positions=True))
+        self.assertEqual(f.getvalue(), t.to_json(positions=True))
+
+    def test_error(self):  # the position and a message are always there
+        parser = pegtree.generate(pegtree.grammar('json.tpeg'), expected=True)
+        d = json.loads(parser('{"a": 1,\n "b": }', 'a.txt').to_json())
+        self.assertEqual(d['tag'], 'err')
+        self.assertEqual(d['pos'], [15, 15])
+        self.assertEqual(d['line'], [2, 6])
+        self.assertEqual(d['message'], 'Syntax Error (a.txt:2:6+15)')
+        self.assertIn("'null'", d['expected'])
+        d = json.loads(pegtree.generate(pegtree.grammar('json.tpeg'))('[1, }').to_json())
+        self.assertEqual((d['pos'], d['line']), ([4, 4], [1, 4]))
+        self.assertNotIn('expected', d)
+
+
+class TestConversion(unittest.TestCase):
+
+    def test_deep(self):  # converted without recursion
+        n = 100000
+        t = pegtree.generate(pegtree.grammar('math.tpeg'))('1' + '+1' * n)
+        depth = 0
+        while len(t) > 0:
+            t = t[0]
+            depth += 1
+        self.assertEqual(depth, n)
+        self.assertEqual(str(t), '1')
+
+    def test_first_wins(self):  # es4's ForStmt labels the update and the loop as body
+        parser = pegtree.generate(pegtree.grammar('es4.tpeg'), start='Statement')
+        text = 'for (i = 0; i < n; i++) { f(i); }'
+        t = parser(text)
+        self.assertEqual(t.tag_, 'ForStmt')
+        self.assertEqual(str(t.body), 'i++')
+        labels = [c.get('edge') for c in json.loads(t.to_json())['children']]
+        self.assertEqual(labels.count('body'), 1)
+        self.assertEqual(json.loads(parser(text, conv=JSONWriter())), json.loads(t.to_json()))
+        edges = [child for edge, child in parser(text, conv=PTree2Tuple)[3] if edge == 'body']
+        self.assertEqual(text[edges[0][1]:edges[0][2]], 'i++')
+
+        class Body(Transformer):
+            def ForStmt(self, node):
+                return str(node.body)
+        self.assertEqual(parser(text, conv=Body()), 'i++')
+
+
+def leaves(t):
+    subs = list(t) + sorted((v for v in t.__dict__.values() if isinstance(v, ParseTree)),
+                            key=lambda v: v.spos_)
+    if len(subs) == 0:
+        return [(t.tag_, t.spos_, t.epos_)]
+    return [leaf for sub in subs for leaf in leaves(sub)]
+
+
+class TestTokens(unittest.TestCase):
+
+    def test_tokens(self):
+        for t in trees():
+            self.assertEqual(list(t.tokens()), leaves(t))
+
+    def test_text(self):  # sliced once
+        t = pegtree.generate(pegtree.grammar('math.tpeg'))('12+345')
+        self.assertEqual([str(c) for c in t], ['12', '345'])
+        self.assertIs(str(t[1]), str(t[1]))
+        self.assertEqual(t[1].view(), '345')
+
+    def test_view(self):  # bytes inputs are not copied
+        inputs = b'int x = 123;'
+        t = ParseTree('Int', inputs, 8, 11)
+        v = t.view()
+        self.assertIsInstance(v, memoryview)
+        self.assertIs(v.obj, inputs)
+        self.assertEqual(bytes(v), b'123')
+        self.assertEqual(str(t), '123')
+
+
+def nodes(t):
+    yield '', t
+    for c in t:
+        yield from nodes(c)
+    for key, v in t.__dict__.items():
+        if isinstance(v, ParseTree):
+            yield key, v
+            yield from nodes(v)
+
+
+class TestTags(unittest.TestCase):
+
+    def test_ids(self):
+        for file in GRAMMARS:
+            peg = pegtree.grammar(file)
+            tags = peg.tags()
+            self.assertEqual(sorted(tags.values()), sorted(set(tags.values())))
+            for name, text in samples(peg):
+                t = pegtree.generate(peg, start=name)(text)
+                if t.isSyntaxError():
+                    continue
+                for edge, node in nodes(t):
+                    self.assertEqual(node.tag_id, tag_id(node.tag_))
+                    self.assertEqual(tag_name(node.tag_id), node.tag_)
+                    if node.tag_ != '':
+                        self.assertEqual(tags[node.tag_], node.tag_id)
+                    if edge != '':
+                        self.assertEqual(tags[edge], tag_id(edge))
+
+    def test_ptree(self):  # PTree holds ids
+        pt = pegtree.generate(pegtree.grammar('math.tpeg'))('1+2', conv=lambda pt, urn, inputs: pt)
+        self.assertEqual(pt.tag, tag_id('Infix'))
+        self.assertEqual(tag_id(''), 0)
+
+    def test_dispatch(self):
+        class Count(TagVisitor):
+            def __init__(self):
+                self.counts = {}
+
+            def Int(self, t):
+                self.counts['Int'] = self.counts.get('Int', 0) + 1
+
+            def undefined(self, t):
+                self.counts[t.tag_] = self.counts.get(t.tag_, 0) + 1
+
+        t = pegtree.generate(pegtree.grammar('math.tpeg'))('1+2*3')
+        v = Count()
+        for _, node in nodes(t):
+            v.visit(node)
+        self.assertEqual(v.counts, {'Infix': 2, 'Int': 3})
+        v.visit(ParseTree('NewTagAfterTheTable', 'x'))  # interned after the table
+        self.assertEqual(v.counts['NewTagAfterTheTable'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
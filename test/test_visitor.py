@@ -0,0 +1,80 @@
+import unittest
+import pegtree
+from pegtree.pasm import ParseTree
+from pegtree.visitor import Visitor, Transformer
+from test.test_parsers import samples
+
+
+class Sum(Transformer):
+    def Int(self, node):
+        return int(str(node))
+
+    def Infix(self, node):
+        return sum(node.children)
+
+
+class Product(Sum):  # a table of its own
+    def Infix(self, node):
+        left, right = node.children
+        return left * right
+
+
+class Shape(Transformer):  # (tag, children, edges) of every node
+    def undefined(self, node):
+        return (node.tag, str(node) if not node.children and not node.edges else None,
+                node.children, sorted(node.edges.items()))
+
+
+def shape(t):
+    edges = [(key, shape(v)) for key, v in t.__dict__.items() if isinstance(v, ParseTree)]
+    leaf = len(t) == 0 and len(edges) == 0
+    return (t.tag_, str(t) if leaf else None, [shape(c) for c in t], sorted(edges))
+
+
+class TestTransformer(unittest.TestCase):
+
+    def test_shape(self):  # transform() and conv build the same values
+        for file in ['math2.tpeg', 'json.tpeg', 'tpeg.tpeg', 'es4.tpeg']:
+            peg = pegtree.grammar(file)
+            for name, text in samples(peg):
+                parser = pegtree.generate(peg, start=name)
+                t = parser(text)
+                if t.isSyntaxError():
+                    continue
+                self.assertEqual(Shape().transform(t), shape(t))
+                self.assertEqual(parser(text, conv=Shape()), shape(t))
+
+    def test_tables(self):
+        parser = pegtree.generate(pegtree.grammar('math.tpeg'))
+        t = parser('2+3+4')
+        self.assertEqual(Sum().transform(t), 9)
+        self.assertEqual(Product().transform(t), 24)
+        self.assertEqual(Sum().transform(t), 9)
+        self.assertEqual(parser('2+3+4', conv=Product()), 24)
+
+    def test_deep(self):
+        n = 100000
+        parser = pegtree.generate(pegtree.grammar('math.tpeg'))
+        text = '1' + '+1' * n
+        self.assertEqual(Sum().transform(parser(text)), n + 1)
+        self.assertEqual(parser(text, conv=Sum()), n + 1)
+
+
+class TestVisitor(unittest.TestCase):
+
+    def test_walk(self):  # in the pre-order
+        class Tags(Visitor):
+            def __init__(self):
+                self.tags = []
+
+            def undefined(self, t):
+                self.tags.append((t.tag_, str(t)))
+
+        v = Tags()
+        v.walk(pegtree.generate(pegtree.grammar('math.tpeg'))('1+2*3'))
+        self.assertEqual([tag for tag, _ in v.tags], ['Infix', 'Int', 'Infix', 'Int', 'Int'])
+        self.assertEqual([s for tag, s in v.tags if tag == 'Int'], ['1', '2', '3'])
+
+
+if __name__ == '__main__':
+    unittest.main()